@@ -1,8 +1,19 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
 from src.query_system import ExcelQuerySystem
-from src.logger_config import setup_logging
+from src.query_cache import QueryCache
+from src.dataset_registry import DatasetRegistry, dataset_name, parse_dataset_list
+from src.result_cache import ResultCache
+from src.result_store import ResultStore
+from src.session_store import SessionStore
+from src.query_pool import QueryPool
+from src.serializer import ARROW_STREAM_TYPE, arrow_stream, choose_encoding, compress, dumps, encode_columnar
+from src.llm_gateway import LLMGateway
+from src.async_runner import AsyncLoopRunner
+from src.telemetry import Telemetry, span
+from src.logger_config import configure_logging, setup_logging
 from config import Config
-from datetime import datetime
+import os
+import uuid
 
 # Initialize Flask application
 app = Flask(__name__, static_folder='static')
@@ -11,70 +22,191 @@ app = Flask(__name__, static_folder='static')
 app.config.from_object(Config)
 
 # Set up logging using common configuration
+configure_logging(
+    level=Config.LOG_LEVEL,
+    fmt=Config.LOG_FORMAT,
+    path=Config.LOG_FILE,
+    use_queue=Config.LOG_ASYNC
+)
 logger = setup_logging('FlaskApp')
 
-# Initialize the ExcelQuerySystem
-logger.info("Initializing ExcelQuerySystem")
+# Initialize the dataset registry; each dataset's ExcelQuerySystem is built on its first question
+logger.info("Initializing dataset registry")
 try:
-    query_system = ExcelQuerySystem(
-        Config.MODEL,
-        Config.CSV_FILE_PATH,
-        Config.OPENAI_API_KEY
+    query_cache = None
+    if Config.QUERY_CACHE_ENABLED:
+        query_cache = QueryCache(
+            path=Config.QUERY_CACHE_PATH,
+            max_entries=Config.QUERY_CACHE_MAX_ENTRIES,
+            ttl=Config.QUERY_CACHE_TTL,
+            similarity_threshold=Config.QUERY_CACHE_SIMILARITY_THRESHOLD,
+            save_interval=Config.QUERY_CACHE_SAVE_INTERVAL
+        )
+    result_cache = None
+    if Config.RESULT_CACHE_MAX_BYTES:
+        result_cache = ResultCache(max_bytes=Config.RESULT_CACHE_MAX_BYTES)
+    session_store = None
+    if Config.SESSIONS_ENABLED:
+        session_store = SessionStore(
+            max_bytes=Config.SESSION_MAX_BYTES,
+            max_sessions=Config.SESSION_MAX_SESSIONS,
+            ttl=Config.SESSION_TTL,
+            max_turns=Config.SESSION_MAX_TURNS,
+            digest_max_tokens=Config.SESSION_DIGEST_MAX_TOKENS
+        )
+    # Worker processes for generated pandas code, shared by every dataset
+    query_pool = None
+    if Config.QUERY_POOL_ENABLED and Config.QUERY_ENGINE == 'pandas':
+        if os.name == 'posix':
+            query_pool = QueryPool(workers=Config.QUERY_WORKERS, memory_limit=Config.QUERY_WORKER_MEMORY_LIMIT)
+        else:
+            logger.warning("The query pool needs a POSIX system; generated code runs in the web process")
+    
+    def build_llm_gateway(client=None, async_client=None):
+        """Create the LLM gateway, optionally around stand-in LLM clients"""
+        return LLMGateway(
+            Config.OPENAI_API_KEY,
+            timeout=Config.LLM_TIMEOUT,
+            client=client,
+            async_client=async_client,
+            max_connections=Config.LLM_MAX_CONNECTIONS,
+            max_retries=Config.LLM_MAX_RETRIES,
+            retry_base=Config.LLM_RETRY_BASE,
+            retry_max=Config.LLM_RETRY_MAX,
+            rate_limit=Config.LLM_RATE_LIMIT or None,
+            rate_burst=Config.LLM_RATE_BURST or None,
+            dedupe=Config.LLM_DEDUPE
+        )
+    
+    # One gateway for every dataset, so all LLM calls share its connections, rate limit and in-flight requests
+    llm_gateway = build_llm_gateway()
+    
+    def build_query_system(csv_path, gateway=None):
+        """Create the ExcelQuerySystem for one dataset"""
+        return ExcelQuerySystem(
+            Config.MODEL,
+            csv_path,
+            Config.OPENAI_API_KEY,
+            query_cache=query_cache,
+            pipeline_mode=Config.PIPELINE_MODE,
+            use_summary_template=Config.USE_SUMMARY_TEMPLATE,
+            llm_timeout=Config.LLM_TIMEOUT,
+            llm_max_concurrency=Config.LLM_MAX_CONCURRENCY,
+            speculative_codegen=Config.SPECULATIVE_CODEGEN,
+            dataset_cache_dir=Config.DATASET_CACHE_DIR if Config.DATASET_CACHE_ENABLED else None,
+            dataset_cache_hash=Config.DATASET_CACHE_HASH,
+            dataset_compact_dtypes=Config.DATASET_COMPACT_DTYPES,
+            dataset_watch_interval=Config.DATASET_WATCH_INTERVAL or None,
+            query_max_rows=Config.QUERY_MAX_ROWS,
+            query_timeout=Config.QUERY_TIMEOUT,
+            result_cache=result_cache,
+            query_engine=Config.QUERY_ENGINE,
+            duckdb_threads=Config.DUCKDB_THREADS,
+            duckdb_memory_limit=Config.DUCKDB_MEMORY_LIMIT,
+            summary_max_tokens=Config.SUMMARY_MAX_TOKENS,
+            schema_max_tokens=Config.SCHEMA_MAX_TOKENS,
+            schema_max_columns=Config.SCHEMA_MAX_COLUMNS,
+            llm_gateway=gateway or llm_gateway,
+            filter_index_min_rows=Config.FILTER_INDEX_MIN_ROWS,
+            filter_index_min_filters=Config.FILTER_INDEX_MIN_FILTERS,
+            filter_index_max_columns=Config.FILTER_INDEX_MAX_COLUMNS,
+            session_store=session_store,
+            query_pool=query_pool
+        )
+    
+    datasets = parse_dataset_list(Config.DATASETS) or {dataset_name(Config.CSV_FILE_PATH): Config.CSV_FILE_PATH}
+    dataset_registry = DatasetRegistry(
+        datasets,
+        build_query_system,
+        max_bytes=Config.DATASET_MEMORY_BUDGET or None,
+        default=Config.DEFAULT_DATASET
     )
-    logger.info("ExcelQuerySystem initialized successfully")
+    logger.info(f"Dataset registry initialized with datasets: {', '.join(dataset_registry.names())}")
 except Exception as e:
-    logger.error(f"Failed to initialize ExcelQuerySystem: {str(e)}", exc_info=True)
+    logger.error(f"Failed to initialize dataset registry: {str(e)}", exc_info=True)
     raise
 
+# Full query results, paged to the client on demand
+result_store = ResultStore(max_bytes=Config.RESULT_STORE_MAX_BYTES, ttl=Config.RESULT_STORE_TTL)
+
+# Per-stage latency, token and cache metrics, exported at /metrics
+telemetry = Telemetry(
+    slow_query_seconds=Config.SLOW_QUERY_SECONDS or None,
+    slow_query_log=Config.SLOW_QUERY_LOG
+)
+
+# Shared event loop for the async query path
+async_runner = AsyncLoopRunner()
+
 @app.route('/')
 def home():
     """Render the main page"""
     logger.info("Serving home page")
-    return render_template('index.html')
+    return render_template('index.html', page_size=Config.RESULT_PAGE_SIZE)
 
 @app.route('/query', methods=['POST'])
 def handle_query():
     """Handle the query request and return results"""
     # Log request
-    request_id = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+    request_id = uuid.uuid4().hex
     logger.info(f"Request ID {request_id}: Received query request")
     
-    # Get question from request
+    # Get question, dataset and conversation from request
     user_question = request.json.get('question')
-    logger.info(f"Request ID {request_id}: Question: {user_question}")
+    dataset = request.json.get('dataset')
+    session_id = request.json.get('session_id')
+    logger.info(f"Request ID {request_id}: Dataset: {dataset or dataset_registry.default}, Question: {user_question}")
     
     try:
-        # Get both the DataFrame result and natural language explanation
-        logger.debug(f"Request ID {request_id}: Processing query through ExcelQuerySystem")
-        result_df, explanation = query_system.query(user_question)
-        
-        if result_df is not None:
-            # Log successful data query
-            logger.info(f"Request ID {request_id}: Query successful with data")
-            logger.debug(f"Request ID {request_id}: DataFrame shape: {result_df.shape}")
-            
-            # Convert DataFrame to dictionary for JSON response
-            table_data = result_df.to_dict('records') if not result_df.empty else None
+        with telemetry.trace(request_id, 'query', question=user_question, dataset=dataset) as trace:
+            # Get both the DataFrame result and natural language explanation
+            logger.debug(f"Request ID {request_id}: Processing query through ExcelQuerySystem")
+            with dataset_registry.acquire(dataset) as query_system:
+                result_df, explanation = query_system.query(user_question, session_id=session_id)
             
-            response_data = {
-                'success': True,
-                'answer': explanation,
-                'table_data': table_data
-            }
-            logger.debug(f"Request ID {request_id}: Sending response with table data")
-            logger.debug(f"Request ID {request_id}: Response data: {response_data}")
+            with span('serialize'):
+                response = query_response(request_id, result_df, explanation)
+        logger.info(f"Request ID {request_id}: Request completed successfully in {trace.duration:.3f}s")
+        response.headers['X-Request-ID'] = request_id
+        return response
             
-        else:
-            # Log explanation-only response
-            logger.info(f"Request ID {request_id}: Query returned explanation only")
-            response_data = {
-                'success': True,
-                'answer': explanation,
-                'table_data': None
-            }
+    except Exception as error:
+        # Log error
+        logger.error(
+            f"Request ID {request_id}: Error processing query: {str(error)}", 
+            exc_info=True
+        )
+        return jsonify({
+            'success': False,
+            'request_id': request_id,
+            'error': str(error)
+        })
+
+@app.route('/aquery', methods=['POST'])
+async def handle_async_query():
+    """Handle the query request on the shared event loop with concurrent LLM calls"""
+    # Log request
+    request_id = uuid.uuid4().hex
+    logger.info(f"Request ID {request_id}: Received async query request")
+    
+    # Get question, dataset and conversation from request
+    user_question = request.json.get('question')
+    dataset = request.json.get('dataset')
+    session_id = request.json.get('session_id')
+    logger.info(f"Request ID {request_id}: Dataset: {dataset or dataset_registry.default}, Question: {user_question}")
+    
+    try:
+        with telemetry.trace(request_id, 'aquery', question=user_question, dataset=dataset) as trace:
+            with dataset_registry.acquire(dataset) as query_system:
+                result_df, explanation = await async_runner.run_async(
+                    query_system.aquery(user_question, session_id=session_id)
+                )
             
-        logger.info(f"Request ID {request_id}: Request completed successfully")
-        return jsonify(response_data)
+            with span('serialize'):
+                response = query_response(request_id, result_df, explanation)
+        logger.info(f"Request ID {request_id}: Request completed successfully in {trace.duration:.3f}s")
+        response.headers['X-Request-ID'] = request_id
+        return response
             
     except Exception as error:
         # Log error
@@ -84,9 +216,205 @@ def handle_query():
         )
         return jsonify({
             'success': False,
+            'request_id': request_id,
             'error': str(error)
         })
 
+@app.route('/query/stream', methods=['POST'])
+def handle_streaming_query():
+    """Handle the query request, streaming each stage as a server-sent event"""
+    # Log request
+    request_id = uuid.uuid4().hex
+    logger.info(f"Request ID {request_id}: Received streaming query request")
+    
+    # Get question, dataset and conversation from request
+    user_question = request.json.get('question')
+    dataset = request.json.get('dataset')
+    session_id = request.json.get('session_id')
+    logger.info(f"Request ID {request_id}: Dataset: {dataset or dataset_registry.default}, Question: {user_question}")
+    
+    def generate():
+        with telemetry.trace(request_id, 'query_stream', question=user_question, dataset=dataset) as trace:
+            try:
+                with dataset_registry.acquire(dataset) as query_system:
+                    events = query_system.query_stream(
+                        user_question,
+                        chunk_size=Config.STREAM_CHUNK_ROWS,
+                        result_store=result_store,
+                        page_size=Config.RESULT_PAGE_SIZE,
+                        session_id=session_id
+                    )
+                    for event, data in events:
+                        yield f"event: {event}\ndata: {dumps(data).decode('utf-8')}\n\n"
+            except Exception as error:
+                # query_stream reports its own errors; this covers unknown or unloadable datasets
+                logger.error(f"Request ID {request_id}: Error loading dataset: {str(error)}", exc_info=True)
+                trace.attributes['error'] = str(error)
+                yield f"event: error\ndata: {dumps({'error': str(error)}).decode('utf-8')}\n\n"
+        logger.info(f"Request ID {request_id}: Stream completed in {trace.duration:.3f}s")
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no', 'X-Request-ID': request_id}
+    )
+
+@app.route('/admin/reload', methods=['POST'])
+def reload_dataset():
+    """Reload the dataset in the background without dropping in-flight queries"""
+    if not Config.ADMIN_TOKEN or request.headers.get('X-Admin-Token') != Config.ADMIN_TOKEN:
+        logger.warning("Rejected unauthorized dataset reload request")
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 403
+    
+    dataset = request.args.get('dataset')
+    try:
+        with dataset_registry.acquire(dataset) as query_system:
+            started = query_system.dataset.reload_async(force=True)
+            current = query_system.dataset.current
+    except ValueError as error:
+        return jsonify({'success': False, 'error': str(error)}), 404
+    logger.info(f"Dataset {dataset or dataset_registry.default} reload {'started' if started else 'already in progress'}")
+    return jsonify({
+        'success': True,
+        'dataset': dataset or dataset_registry.default,
+        'reload_started': started,
+        'version': current.version,
+        'fingerprint': current.fingerprint
+    }), 202
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Expose latency, token and cache metrics in the Prometheus text format"""
+    exported = telemetry.render()
+    if exported is None:
+        return jsonify({'error': 'Metrics need the prometheus_client package'}), 501
+    body, content_type = exported
+    return Response(body, content_type=content_type)
+
+@app.route('/datasets', methods=['GET'])
+def list_datasets():
+    """List the datasets questions can be asked about"""
+    return jsonify({'success': True, 'datasets': dataset_registry.status()})
+
+@app.route('/results/<result_id>', methods=['GET'])
+def get_result_page(result_id):
+    """Return one page of a stored query result, optionally sorted on a column"""
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = min(int(request.args.get('limit', Config.RESULT_PAGE_SIZE)), Config.RESULT_PAGE_MAX)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'offset and limit must be integers'}), 400
+    sort_by = request.args.get('sort') or None
+    ascending = request.args.get('order', 'asc').lower() != 'desc'
+    
+    as_arrow = wants_arrow()
+    try:
+        page = result_store.page(result_id, offset=offset, limit=limit, sort_by=sort_by, ascending=ascending,
+                                 as_frame=as_arrow)
+    except KeyError:
+        logger.info(f"Result {result_id} expired or not found")
+        return jsonify({'success': False, 'error': 'Result expired, please run the query again'}), 404
+    except ValueError as error:
+        return jsonify({'success': False, 'error': str(error)}), 400
+    if as_arrow:
+        rows = page.pop('rows')
+        response = arrow_response(rows, {'success': True, **page})
+        if response is not None:
+            return response
+        page.update(encode_columnar(rows))
+    return json_response({'success': True, **page})
+
+def wants_arrow():
+    """Whether the client prefers an Arrow IPC stream to JSON"""
+    return request.accept_mimetypes.best_match(['application/json', ARROW_STREAM_TYPE]) == ARROW_STREAM_TYPE
+
+def json_response(payload):
+    """JSON response encoded by the serializer, which handles NumPy arrays, NaN and timestamps"""
+    return Response(dumps(payload), mimetype='application/json')
+
+def arrow_response(rows, metadata):
+    """Arrow IPC stream of rows with the other response fields as schema metadata, or None if rows can't be converted"""
+    body = arrow_stream(rows, metadata)
+    if body is None:
+        logger.warning("Could not encode the result as Arrow, sending JSON instead")
+        return None
+    return Response(body, mimetype=ARROW_STREAM_TYPE)
+
+def query_response(request_id, result_df, explanation):
+    """Encode a query result as JSON, or as Arrow for clients that ask for it"""
+    as_arrow = wants_arrow() and result_df is not None and not result_df.empty
+    payload = build_query_response(request_id, result_df, explanation, as_frame=as_arrow)
+    if as_arrow:
+        rows = payload['table'].pop('rows')
+        response = arrow_response(rows, payload)
+        if response is not None:
+            return response
+        payload['table'].update(encode_columnar(rows))
+    payload['table_data'] = table_records(payload['table'])
+    return json_response(payload)
+
+def table_records(table):
+    """
+    Rows of the first page as a list of records, the response's former 'table_data' field
+
+    Deprecated: kept for clients written before results were paged; new
+    clients read 'table', which also covers the rows not sent inline.
+    """
+    if table is None:
+        return None
+    return [dict(zip(table['columns'], row)) for row in zip(*table['data'])]
+
+@app.after_request
+def compress_response(response):
+    """Compress large responses with brotli or gzip when the client accepts it"""
+    if (not Config.RESPONSE_COMPRESSION or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None or len(body) < Config.RESPONSE_COMPRESSION_MIN_BYTES:
+        return response
+    response.set_data(compress(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def build_query_response(request_id, result_df, explanation, as_frame=False):
+    """
+    Build the payload for a query result
+
+    With as_frame the first page's rows are left as a DataFrame under
+    table['rows'] for an Arrow response.
+    """
+    if result_df is not None:
+        # Log successful data query
+        logger.info(f"Request ID {request_id}: Query successful with data")
+        logger.debug(f"Request ID {request_id}: DataFrame shape: {result_df.shape}")
+        
+        # Send the first page; the rest stays server-side under the result id
+        table = None
+        if not result_df.empty:
+            table = result_store.put_and_page(result_df, limit=Config.RESULT_PAGE_SIZE, as_frame=as_frame)
+        
+        response_data = {
+            'success': True,
+            'request_id': request_id,
+            'answer': explanation,
+            'table': table
+        }
+        logger.debug(f"Request ID {request_id}: Sending response with first page of table data")
+        
+    else:
+        # Log explanation-only response
+        logger.info(f"Request ID {request_id}: Query returned explanation only")
+        response_data = {
+            'success': True,
+            'request_id': request_id,
+            'answer': explanation,
+            'table': None
+        }
+    return response_data
+
 @app.errorhandler(404)
 def not_found_error(error):
     logger.error(f"404 Error: {request.url}")
@@ -0,0 +1,91 @@
+"""
+Compare two benchmark reports
+
+Lists every timing and throughput metric present in both reports with the
+relative change, and exits with status 1 when a metric regressed by more
+than the threshold, so it can gate CI runs.
+
+Usage:
+    python -m benchmarks.compare baseline.json candidate.json --threshold 0.1
+"""
+import argparse
+import json
+import sys
+
+# Metrics where larger is better; every other compared metric is a duration
+HIGHER_IS_BETTER = ('throughput_rps',)
+COMPARED_SUFFIXES = ('_ms', '_s', '_rps')
+# Only these summaries are compared, to keep noisy tail latencies out of the verdict
+COMPARED_STATS = ('p50_ms', 'cold_s', 'warm_s', 'throughput_rps')
+
+
+def flatten(value, prefix=''):
+    """Flatten nested report sections into {'a.b.c': number}"""
+    if isinstance(value, dict):
+        flat = {}
+        for key, item in value.items():
+            flat.update(flatten(item, f"{prefix}.{key}" if prefix else str(key)))
+        return flat
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {prefix: value}
+    return {}
+
+
+def metrics(report):
+    """Comparable metrics of a report, keyed by dataset size and engine"""
+    found = {}
+    for result in report['results']:
+        scope = f"{result['rows']} rows/{result['engine']}"
+        for name, value in flatten(result).items():
+            if name.endswith(COMPARED_SUFFIXES) and name.rsplit('.', 1)[-1] in COMPARED_STATS:
+                found[f"{scope}: {name}"] = value
+    return found
+
+
+def compare(baseline, candidate, threshold):
+    """
+    Returns:
+        tuple: (rows of (metric, baseline, candidate, change), regressed metric names)
+    """
+    before = metrics(baseline)
+    after = metrics(candidate)
+    rows = []
+    regressions = []
+    for name in sorted(before.keys() & after.keys()):
+        old, new = before[name], after[name]
+        change = (new - old) / old if old else 0.0
+        worse = -change if name.endswith(HIGHER_IS_BETTER) else change
+        rows.append((name, old, new, change))
+        if worse > threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare two benchmark reports")
+    parser.add_argument('baseline', help="Report of the reference version")
+    parser.add_argument('candidate', help="Report of the version under test")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="Relative slowdown reported as a regression (default: 0.1)")
+    args = parser.parse_args(argv)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    rows, regressions = compare(baseline, candidate, args.threshold)
+    print(f"Baseline:  {baseline.get('git_commit')} ({baseline.get('created')})")
+    print(f"Candidate: {candidate.get('git_commit')} ({candidate.get('created')})")
+    width = max((len(name) for name, *_ in rows), default=10)
+    for name, old, new, change in rows:
+        marker = '  REGRESSION' if name in regressions else ''
+        print(f"{name:<{width}}  {old:>12.3f}  {new:>12.3f}  {change:>+8.1%}{marker}")
+    if regressions:
+        print(f"\n{len(regressions)} metrics regressed by more than {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
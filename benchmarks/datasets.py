@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+REGIONS = np.array(['North', 'South', 'East', 'West', 'Central'])
+PRODUCTS = np.array([f"Product {chr(ord('A') + i)}" for i in range(20)])
+CHANNELS = np.array(['online', 'retail', 'partner'])
+
+# Rows generated and written at a time, so 10M-row files don't need 10M rows in memory
+CHUNK_ROWS = 1_000_000
+
+
+def _orders(rng, start, rows):
+    quantity = rng.integers(1, 11, rows)
+    price = np.round(rng.gamma(2.0, 25.0, rows), 2)
+    days = rng.integers(0, 730, rows)
+    return pd.DataFrame({
+        'order_id': np.arange(start, start + rows),
+        'order_date': (np.datetime64('2023-01-01') + days).astype(str),
+        'customer_id': rng.integers(1, max(rows // 10, 100), rows),
+        'region': REGIONS[rng.integers(0, len(REGIONS), rows)],
+        'product': PRODUCTS[rng.integers(0, len(PRODUCTS), rows)],
+        'channel': CHANNELS[rng.integers(0, len(CHANNELS), rows)],
+        'quantity': quantity,
+        'price': price,
+        'revenue': np.round(quantity * price, 2),
+    })
+
+
+def synthetic_csv(rows, data_dir, seed=0):
+    """
+    Write a synthetic orders CSV with the given number of rows, unless it exists
+
+    The same rows and seed always give the same file, so runs on different
+    versions of the code read identical data.
+
+    Returns:
+        str: Path to the CSV
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, f"orders_{rows}_{seed}.csv")
+    if os.path.exists(path):
+        return path
+
+    rng = np.random.default_rng(seed)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    for start in range(0, rows, CHUNK_ROWS):
+        chunk = _orders(rng, start, min(CHUNK_ROWS, rows - start))
+        chunk.to_csv(tmp_path, mode='a' if start else 'w', header=not start, index=False)
+    os.replace(tmp_path, path)
+    return path
+
+
+def parse_rows(value):
+    """Parse row counts such as '1k,100k,1m' or '1000,10000000'"""
+    counts = []
+    for item in value.split(','):
+        item = item.strip().lower()
+        if not item:
+            continue
+        multiplier = {'k': 1_000, 'm': 1_000_000}.get(item[-1], 1)
+        number = item[:-1] if multiplier > 1 else item
+        try:
+            counts.append(int(float(number) * multiplier))
+        except ValueError:
+            raise ValueError(f"Invalid row count: {item}")
+    return counts
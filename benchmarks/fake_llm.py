@@ -0,0 +1,166 @@
+import asyncio
+import json
+import re
+import time
+from types import SimpleNamespace
+
+QUESTION_PATTERN = re.compile(r"^(?:User )?Question: (.*)$", re.MULTILINE)
+
+# Questions about the synthetic orders dataset, with the plan the fake LLM returns for each
+SCENARIOS = {
+    "What is the total revenue by region?": {
+        'question_type': 'filter',
+        'query_code': "df.groupby('region', as_index=False)['revenue'].sum()",
+        'sql': 'SELECT "region", SUM("revenue") AS "revenue" FROM data GROUP BY "region"',
+    },
+    "Which 10 orders have the highest revenue?": {
+        'question_type': 'filter',
+        'query_code': "df.nlargest(10, 'revenue')",
+        'sql': 'SELECT * FROM data ORDER BY "revenue" DESC LIMIT 10',
+    },
+    "Show orders from the North region with more than 5 units": {
+        'question_type': 'filter',
+        'query_code': "df[(df['region'] == 'North') & (df['quantity'] > 5)]",
+        'sql': 'SELECT * FROM data WHERE "region" = \'North\' AND "quantity" > 5',
+    },
+    "What is the average price of each product?": {
+        'question_type': 'filter',
+        'query_code': "df.groupby('product', as_index=False)['price'].mean()",
+        'sql': 'SELECT "product", AVG("price") AS "price" FROM data GROUP BY "product"',
+    },
+    "Show every order for customer 42": {
+        'question_type': 'filter',
+        'query_code': "df[df['customer_id'] == 42]",
+        'sql': 'SELECT * FROM data WHERE "customer_id" = 42',
+    },
+    "What does the revenue column mean?": {
+        'question_type': 'explain',
+        'query_code': None,
+        'sql': None,
+    },
+}
+
+DEFAULT_PLAN = {'question_type': 'filter', 'query_code': 'df.head(10)', 'sql': 'SELECT * FROM data LIMIT 10'}
+
+ANSWER = "The result lists the rows that answer the question, summarised from the query output."
+EXPLANATION = "The column holds the value described by its name for each order in the dataset."
+
+
+def _usage(messages, completion):
+    prompt = sum(len(message['content']) for message in messages)
+    return SimpleNamespace(prompt_tokens=prompt // 4 + 1, completion_tokens=len(completion) // 4 + 1)
+
+
+def _completion(content, usage):
+    message = SimpleNamespace(content=content, role='assistant')
+    return SimpleNamespace(choices=[SimpleNamespace(message=message, index=0)], usage=usage)
+
+
+class FakeCompletions:
+    """Answers chat completion requests from recorded plans, without the network"""
+
+    def __init__(self, responses, latency, token_latency):
+        self.responses = responses
+        self.latency = latency
+        self.token_latency = token_latency
+        self.calls = 0
+
+    def respond(self, messages):
+        """Pick the response for a request from the prompt it was built from"""
+        system = messages[0]['content']
+        user = messages[-1]['content']
+        match = QUESTION_PATTERN.search(user)
+        question = match.group(1).strip() if match else ''
+        plan = self.responses.get(question, DEFAULT_PLAN)
+
+        if 'classifying questions' in system:
+            return plan['question_type']
+        if 'DuckDB SQL' in system:
+            return plan.get('sql') or DEFAULT_PLAN['sql']
+        if 'pandas code' in system:
+            return plan.get('query_code') or DEFAULT_PLAN['query_code']
+        if 'valid JSON' in system:
+            sql = 'SQL table' in user
+            explain = plan['question_type'] == 'explain'
+            return json.dumps({
+                'question_type': plan['question_type'],
+                'query_code': None if explain else (plan.get('sql') if sql else plan.get('query_code')),
+                'explanation': EXPLANATION if explain else None,
+                'summary_template': None if explain else "The query returned {row_count} rows.",
+            })
+        if 'Explain what we can learn' in user:
+            return ANSWER
+        return EXPLANATION
+
+    def _chunks(self, content, usage):
+        for word in re.findall(r"\S+\s*", content):
+            if self.token_latency:
+                time.sleep(self.token_latency)
+            delta = SimpleNamespace(content=word, role='assistant')
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta, index=0)], usage=None)
+        yield SimpleNamespace(choices=[], usage=usage)
+
+    def create(self, model=None, messages=None, stream=False, **kwargs):
+        self.calls += 1
+        content = self.respond(messages)
+        usage = _usage(messages, content)
+        if self.latency:
+            time.sleep(self.latency)
+        if stream:
+            return self._chunks(content, usage)
+        return _completion(content, usage)
+
+
+class AsyncFakeCompletions(FakeCompletions):
+    """Async version of FakeCompletions"""
+
+    async def create(self, model=None, messages=None, stream=False, **kwargs):
+        self.calls += 1
+        content = self.respond(messages)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return _completion(content, _usage(messages, content))
+
+
+class FakeLLM:
+    """
+    Stand-in for the OpenAI client with a fixed latency per call
+
+    Has the client.chat.completions.create interface the query system uses.
+    Plans come from responses (question to question_type, query_code and
+    sql), by default the SCENARIOS for the synthetic dataset; other questions
+    get DEFAULT_PLAN. Streamed answers wait token_latency per word.
+    """
+
+    completions_class = FakeCompletions
+
+    def __init__(self, responses=None, latency=0.0, token_latency=0.0):
+        """
+        Args:
+            responses (dict): Recorded plans by question (defaults to SCENARIOS)
+            latency (float): Seconds every call takes before it answers
+            token_latency (float): Seconds between streamed words
+        """
+        self.chat = SimpleNamespace(completions=self.completions_class(
+            SCENARIOS if responses is None else responses, latency, token_latency
+        ))
+
+    @property
+    def calls(self):
+        return self.chat.completions.calls
+
+
+class AsyncFakeLLM(FakeLLM):
+    """Stand-in for the AsyncOpenAI client"""
+
+    completions_class = AsyncFakeCompletions
+
+
+def load_responses(path):
+    """Load recorded plans from a JSON file of {question: {question_type, query_code, sql}}"""
+    with open(path) as f:
+        responses = json.load(f)
+    for question, plan in responses.items():
+        if plan.get('question_type') not in ('filter', 'explain'):
+            raise ValueError(f"Recorded plan for {question!r} needs a question_type of 'filter' or 'explain'")
+    return responses
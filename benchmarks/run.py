@@ -0,0 +1,317 @@
+"""
+Offline benchmarks for the query system
+
+Runs against synthetic order datasets with a local stand-in for the OpenAI
+client, so no API key or network is needed and LLM latency is fixed. For
+every dataset size and query engine it measures startup (cold and with the
+columnar cache), schema building, query execution, result serialization and
+end-to-end /query throughput under concurrent load, and writes the results
+to a JSON report that benchmarks.compare can diff against another run.
+
+Usage:
+    python -m benchmarks.run --rows 1k,100k,1m --engines pandas,duckdb
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from .datasets import parse_rows, synthetic_csv
+from .fake_llm import AsyncFakeLLM, FakeLLM, SCENARIOS, load_responses
+
+REPORT_VERSION = 1
+
+# Settings left out of reports
+SECRET_SETTINGS = {'OPENAI_API_KEY', 'ADMIN_TOKEN'}
+
+
+def timings(samples):
+    """Summarise durations in seconds as milliseconds"""
+    values = np.array(samples) * 1000
+    return {
+        'n': len(samples),
+        'mean_ms': round(float(values.mean()), 3),
+        'p50_ms': round(float(np.percentile(values, 50)), 3),
+        'p95_ms': round(float(np.percentile(values, 95)), 3),
+        'p99_ms': round(float(np.percentile(values, 99)), 3),
+        'max_ms': round(float(values.max()), 3),
+    }
+
+
+def measure(func, repeat):
+    """Call func repeat times, returning its last result and the duration of each call"""
+    samples = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        samples.append(time.perf_counter() - start)
+    return result, samples
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def environment():
+    versions = {'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__}
+    for package in ('duckdb', 'pyarrow', 'orjson', 'brotli'):
+        try:
+            versions[package] = __import__(package).__version__
+        except ImportError:
+            pass
+    return {'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'versions': versions}
+
+
+def bench_startup(build, cache_dir):
+    """Build the query system from the CSV, then again from the columnar cache"""
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    start = time.perf_counter()
+    system = build()
+    cold = time.perf_counter() - start
+    system.dataset.stop()
+
+    start = time.perf_counter()
+    system = build()
+    warm = time.perf_counter() - start
+    return system, {'cold_s': round(cold, 4), 'warm_s': round(warm, 4)}
+
+
+def bench_schema(system, repeat):
+    """Time profiling the dataset, rendering the schema prompt and indexing its columns"""
+    from src.profiler import profile_dataframe
+    from src.schema_index import ColumnIndex
+
+    df = system.df
+    if df is None:
+        # The duckdb engine profiles the file without loading it
+        fingerprint = system.dataset_fingerprint
+        profile, profile_samples = measure(lambda: system.executor.profile(fingerprint), repeat)
+    else:
+        profile, profile_samples = measure(lambda: profile_dataframe(df), repeat)
+    _, describe_samples = measure(lambda: system._render_schema(profile), repeat)
+    _, index_samples = measure(lambda: ColumnIndex(profile), repeat)
+    return {
+        'profile': timings(profile_samples),
+        'describe': timings(describe_samples),
+        'index': timings(index_samples),
+        'schema_chars': len(system.schema),
+    }
+
+
+def bench_execute(system, responses, repeat):
+    """Time each recorded query on the executor directly, bypassing the result cache but not filter indexes"""
+    results = {}
+    timed = {}
+    code_key = 'sql' if system.query_engine == 'duckdb' else 'query_code'
+    for question, plan in responses.items():
+        code = plan.get(code_key)
+        if plan['question_type'] != 'filter' or not code:
+            continue
+        snapshot = system.dataset.current
+        result, samples = measure(lambda: system.executor.execute(code, snapshot.df, snapshot.filter_index), repeat)
+        results[question] = result
+        timed[question] = {**timings(samples), 'result_rows': len(result)}
+    return results, timed
+
+
+def bench_serialize(results, page_size, repeat):
+    """Time encoding the first page and the whole result of each query as columnar JSON and as Arrow"""
+    from src.result_store import ResultStore
+    from src.serializer import arrow_stream, dumps, encode_columnar
+
+    timed = {}
+    for question, result in results.items():
+        _, page_samples = measure(lambda: dumps(encode_columnar(result.head(page_size))), repeat)
+        body, full_samples = measure(lambda: dumps(encode_columnar(result)), repeat)
+        arrow_body, arrow_samples = measure(lambda: arrow_stream(result), repeat)
+        store = ResultStore()
+        _, store_samples = measure(lambda: store.put_and_page(result, limit=page_size), repeat)
+        timed[question] = {
+            'first_page': timings(page_samples),
+            'full_result': timings(full_samples),
+            'store_and_page': timings(store_samples),
+            'full_result_bytes': len(body),
+        }
+        if arrow_body is not None:
+            timed[question]['full_result_arrow'] = timings(arrow_samples)
+            timed[question]['full_result_arrow_bytes'] = len(arrow_body)
+    return timed
+
+
+def bench_end_to_end(app_module, csv_path, responses, args):
+    """Send questions to the Flask app from concurrent clients and measure throughput"""
+    from src.dataset_registry import DatasetRegistry, dataset_name
+
+    client = FakeLLM(responses, latency=args.llm_latency, token_latency=args.token_latency)
+    async_client = AsyncFakeLLM(responses, latency=args.llm_latency, token_latency=args.token_latency)
+    gateway = app_module.build_llm_gateway(client=client, async_client=async_client)
+    registry = DatasetRegistry(
+        {dataset_name(csv_path): csv_path},
+        lambda path: app_module.build_query_system(path, gateway=gateway)
+    )
+    app_module.dataset_registry = registry
+    test_client = app_module.app.test_client()
+    questions = list(responses)
+
+    def send(index):
+        question = questions[index % len(questions)]
+        start = time.perf_counter()
+        response = test_client.post(args.endpoint, json={'question': question})
+        if args.endpoint == '/query/stream':
+            ok = b'event: done' in response.get_data()
+        else:
+            ok = bool(response.get_json().get('success'))
+        return time.perf_counter() - start, ok
+
+    try:
+        # Warm up: load the dataset before the clock starts
+        send(0)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            outcomes = list(pool.map(send, range(args.requests)))
+        elapsed = time.perf_counter() - start
+    finally:
+        registry.stop()
+
+    latencies = [latency for latency, _ in outcomes]
+    return {
+        'endpoint': args.endpoint,
+        'concurrency': args.concurrency,
+        'requests': args.requests,
+        'errors': sum(1 for _, ok in outcomes if not ok),
+        'throughput_rps': round(args.requests / elapsed, 2),
+        'latency': timings(latencies),
+        # Upstream calls; fewer than the questions asked when identical requests were coalesced
+        'llm_calls': client.calls + async_client.calls,
+    }
+
+
+def run(args):
+    responses = load_responses(args.responses) if args.responses else SCENARIOS
+    work_dir = tempfile.mkdtemp(prefix='excel-query-bench-')
+
+    # Settings are read when config is imported, so point the app at scratch paths first
+    os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+    os.environ.setdefault('DATASET_WATCH_INTERVAL', '0')
+    os.environ.setdefault('QUERY_CACHE_PATH', os.path.join(work_dir, 'query_cache.json'))
+    os.environ.setdefault('DATASET_CACHE_DIR', os.path.join(work_dir, 'datasets'))
+    os.environ.setdefault('LOG_FILE', os.path.join(work_dir, 'application.log'))
+    os.environ.setdefault('SLOW_QUERY_LOG', os.path.join(work_dir, 'slow_queries.log'))
+    os.environ['CSV_FILE_PATH'] = synthetic_csv(min(args.rows), args.data_dir, args.seed)
+    os.environ.pop('DATASETS', None)
+    os.environ.pop('DEFAULT_DATASET', None)
+
+    import app as app_module
+    from config import Config
+    from src.logger_config import configure_logging
+
+    # Keep the console readable; the log file still receives everything at LOG_LEVEL
+    configure_logging(console_level=args.console_log_level)
+
+    settings = {name: getattr(Config, name) for name in dir(Config)
+                if name.isupper() and name not in SECRET_SETTINGS}
+    commit, dirty = git_revision()
+    report = {
+        'report_version': REPORT_VERSION,
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'git_commit': commit,
+        'git_dirty': dirty,
+        'environment': environment(),
+        'arguments': {key: value for key, value in vars(args).items()},
+        'settings': settings,
+        'results': [],
+    }
+
+    try:
+        for rows in args.rows:
+            start = time.perf_counter()
+            csv_path = synthetic_csv(rows, args.data_dir, args.seed)
+            generate_s = time.perf_counter() - start
+            for engine in args.engines:
+                print(f"Benchmarking {rows} rows with the {engine} engine", file=sys.stderr)
+                Config.QUERY_ENGINE = engine
+                cache_dir = os.path.join(work_dir, f"startup_{rows}_{engine}")
+
+                def build():
+                    return app_module.ExcelQuerySystem(
+                        Config.MODEL, csv_path, None,
+                        dataset_cache_dir=cache_dir,
+                        query_engine=engine,
+                        client=FakeLLM(responses),
+                        async_client=AsyncFakeLLM(responses)
+                    )
+
+                system, startup = bench_startup(build, cache_dir)
+                results, execute = bench_execute(system, responses, args.repeat)
+                entry = {
+                    'rows': rows,
+                    'engine': engine,
+                    'csv_bytes': os.path.getsize(csv_path),
+                    'generate_s': round(generate_s, 4),
+                    'memory_bytes': int(system.df.memory_usage(deep=True).sum()) if system.df is not None else 0,
+                    'startup': startup,
+                    'schema': bench_schema(system, args.repeat),
+                    'execute': execute,
+                    'serialize': bench_serialize(results, Config.RESULT_PAGE_SIZE, args.repeat),
+                }
+                system.dataset.stop()
+                del system, results
+                if args.requests:
+                    entry['end_to_end'] = bench_end_to_end(app_module, csv_path, responses, args)
+                report['results'].append(entry)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the query system")
+    parser.add_argument('--rows', type=parse_rows, default=parse_rows('1k,100k,1m'),
+                        help="Dataset sizes, e.g. 1k,100k,1m,10m (default: 1k,100k,1m)")
+    parser.add_argument('--engines', type=lambda value: value.split(','), default=['pandas'],
+                        help="Query engines to compare, e.g. pandas,duckdb (default: pandas)")
+    parser.add_argument('--repeat', type=int, default=5, help="Repetitions of each timed operation")
+    parser.add_argument('--requests', type=int, default=200, help="End-to-end requests (0 skips them)")
+    parser.add_argument('--concurrency', type=int, default=8, help="Concurrent end-to-end clients")
+    parser.add_argument('--endpoint', default='/query', choices=['/query', '/aquery', '/query/stream'])
+    parser.add_argument('--llm-latency', type=float, default=0.05, help="Seconds per stand-in LLM call")
+    parser.add_argument('--token-latency', type=float, default=0.0, help="Seconds per streamed word")
+    parser.add_argument('--responses', help="JSON file of recorded plans by question (default: built-in scenarios)")
+    parser.add_argument('--data-dir', default='./cache/benchmarks', help="Where synthetic CSVs are kept")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the synthetic data")
+    parser.add_argument('--output', help="Report path (default: benchmarks/reports/<time>-<commit>.json)")
+    parser.add_argument('--console-log-level', default='WARNING', help="Console log level during the run")
+    args = parser.parse_args(argv)
+    if not args.rows:
+        parser.error("--rows needs at least one size")
+
+    report = run(args)
+    output = args.output
+    if output is None:
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        output = os.path.join('benchmarks', 'reports', f"{stamp}-{(report['git_commit'] or 'unknown')[:8]}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"Report written to {output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
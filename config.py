@@ -10,6 +10,118 @@ class Config:
     MODEL = os.getenv("MODEL", "gpt-4o-mini")
     # CSV file configuration
     CSV_FILE_PATH = os.getenv("CSV_FILE_PATH", "./TechCompanyInsights - Sheet1.csv")
+    # Datasets served side by side as 'name=path,name2=path2' (unset serves only CSV_FILE_PATH)
+    DATASETS = os.getenv("DATASETS")
+    DEFAULT_DATASET = os.getenv("DEFAULT_DATASET")  # defaults to the first dataset
+    # Memory budget for loaded datasets; idle ones are unloaded beyond it (0 disables)
+    DATASET_MEMORY_BUDGET = int(os.getenv("DATASET_MEMORY_BUDGET", str(2 * 1024 * 1024 * 1024)))
+    # Memory-mapped columnar copy of the CSV shared by all worker processes,
+    # stored alongside the cached dataset profile used for the schema prompt
+    DATASET_CACHE_ENABLED = os.getenv("DATASET_CACHE_ENABLED", "True").lower() == "true"
+    DATASET_CACHE_DIR = os.getenv("DATASET_CACHE_DIR", "./cache/datasets")
+    # Detect CSV changes by content hash instead of size and modification time
+    DATASET_CACHE_HASH = os.getenv("DATASET_CACHE_HASH", "False").lower() == "true"
+    # Downcast integers and store repetitive text as categoricals to save memory;
+    # off by default because it changes overflow and string behaviour in queries
+    DATASET_COMPACT_DTYPES = os.getenv("DATASET_COMPACT_DTYPES", "False").lower() == "true"
+    # Seconds between checks of the CSV for changes to hot-reload (0 disables)
+    DATASET_WATCH_INTERVAL = float(os.getenv("DATASET_WATCH_INTERVAL", "5"))
+    # Required in the X-Admin-Token header of admin endpoints (unset disables them)
+    ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+    
+    # Query plan cache configuration
+    QUERY_CACHE_ENABLED = os.getenv("QUERY_CACHE_ENABLED", "True").lower() == "true"
+    QUERY_CACHE_PATH = os.getenv("QUERY_CACHE_PATH", "./cache/query_cache.json")
+    QUERY_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_CACHE_MAX_ENTRIES", "1000"))
+    QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", "86400"))  # seconds
+    # Minimum n-gram similarity for paraphrased questions (0 disables)
+    QUERY_CACHE_SIMILARITY_THRESHOLD = float(os.getenv("QUERY_CACHE_SIMILARITY_THRESHOLD", "0.9"))
+    # Seconds new plans may wait before the cache file is rewritten (0 writes on every change)
+    QUERY_CACHE_SAVE_INTERVAL = float(os.getenv("QUERY_CACHE_SAVE_INTERVAL", "5"))
+    
+    # LLM pipeline configuration
+    # 'multi' classifies and generates code in separate calls, 'fused' uses one JSON completion
+    PIPELINE_MODE = os.getenv("PIPELINE_MODE", "multi")
+    # In fused mode, answer with the returned summary template instead of a summary call
+    USE_SUMMARY_TEMPLATE = os.getenv("USE_SUMMARY_TEMPLATE", "False").lower() == "true"
+    LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))  # seconds per LLM call attempt; failed attempts are retried
+    # Maximum in-flight LLM calls on the async (/aquery) path
+    LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+    # On the async path, generate code while the question is still being classified
+    SPECULATIVE_CODEGEN = os.getenv("SPECULATIVE_CODEGEN", "True").lower() == "true"
+    # Identical concurrent LLM requests share one upstream call
+    LLM_DEDUPE = os.getenv("LLM_DEDUPE", "True").lower() == "true"
+    LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))  # HTTP connection pool size
+    # Retries with jittered exponential backoff on rate limits, connection errors and 5xx
+    LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+    LLM_RETRY_BASE = float(os.getenv("LLM_RETRY_BASE", "0.5"))  # seconds before the first retry
+    LLM_RETRY_MAX = float(os.getenv("LLM_RETRY_MAX", "20"))  # longest wait between retries
+    # Upstream requests per second across the process, and burst size (0 disables)
+    LLM_RATE_LIMIT = float(os.getenv("LLM_RATE_LIMIT", "0"))
+    LLM_RATE_BURST = int(os.getenv("LLM_RATE_BURST", "0"))
+    
+    # Approximate token budget for the result statistics sent to the LLM for the answer
+    SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "800"))
+    
+    # Schema prompts larger than this many tokens only describe the columns most
+    # relevant to the question, up to SCHEMA_MAX_COLUMNS (0 always sends every column)
+    SCHEMA_MAX_TOKENS = int(os.getenv("SCHEMA_MAX_TOKENS", "1500")) or None
+    SCHEMA_MAX_COLUMNS = int(os.getenv("SCHEMA_MAX_COLUMNS", "40"))
+    
+    # Limits applied when running generated pandas code
+    QUERY_MAX_ROWS = int(os.getenv("QUERY_MAX_ROWS", "1000000"))
+    QUERY_TIMEOUT = float(os.getenv("QUERY_TIMEOUT", "30"))  # seconds
+    # Run generated pandas code in worker processes that are killed at the timeout (POSIX only)
+    QUERY_POOL_ENABLED = os.getenv("QUERY_POOL_ENABLED", "True").lower() == "true"
+    QUERY_WORKERS = int(os.getenv("QUERY_WORKERS", "0")) or None  # 0 allows one per core
+    QUERY_WORKER_MEMORY_LIMIT = int(os.getenv("QUERY_WORKER_MEMORY_LIMIT", "0")) or None  # heap bytes per worker
+    # Secondary indexes over the columns generated code filters on most, for
+    # datasets of at least FILTER_INDEX_MIN_ROWS rows (0 disables them)
+    FILTER_INDEX_MIN_ROWS = int(os.getenv("FILTER_INDEX_MIN_ROWS", "100000")) or None
+    FILTER_INDEX_MIN_FILTERS = int(os.getenv("FILTER_INDEX_MIN_FILTERS", "3"))  # filters before a column is indexed
+    FILTER_INDEX_MAX_COLUMNS = int(os.getenv("FILTER_INDEX_MAX_COLUMNS", "8"))
+    
+    # 'pandas' runs generated pandas code in memory, 'duckdb' runs generated SQL over the file
+    QUERY_ENGINE = os.getenv("QUERY_ENGINE", "pandas")
+    DUCKDB_THREADS = int(os.getenv("DUCKDB_THREADS", "0")) or None  # 0 uses every core
+    DUCKDB_MEMORY_LIMIT = os.getenv("DUCKDB_MEMORY_LIMIT")  # e.g. 4GB; larger operations spill to disk
+    
+    # Memory budget for cached query results (0 disables the result cache)
+    RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+    
+    # Query results kept server-side for paging through /results/<result_id>
+    RESULT_PAGE_SIZE = int(os.getenv("RESULT_PAGE_SIZE", "100"))  # rows in the first page
+    RESULT_PAGE_MAX = int(os.getenv("RESULT_PAGE_MAX", "1000"))  # largest page a client may request
+    RESULT_STORE_MAX_BYTES = int(os.getenv("RESULT_STORE_MAX_BYTES", str(512 * 1024 * 1024)))
+    RESULT_STORE_TTL = int(os.getenv("RESULT_STORE_TTL", "1800"))  # seconds since last read
+    
+    # Conversations: follow-up questions see a digest of the earlier turns and can
+    # query the previous result; sessions are dropped after SESSION_TTL idle seconds
+    # or once their kept results use more than SESSION_MAX_BYTES
+    SESSIONS_ENABLED = os.getenv("SESSIONS_ENABLED", "True").lower() == "true"
+    SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(256 * 1024 * 1024)))
+    SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "1000"))
+    SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))
+    SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", "10"))  # turns remembered per session
+    SESSION_DIGEST_MAX_TOKENS = int(os.getenv("SESSION_DIGEST_MAX_TOKENS", "400"))
+    
+    # Log file shared by every worker process; 'text' or 'json' (one object per line).
+    # With LOG_ASYNC records are written by a background thread instead of the request.
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG")
+    LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+    LOG_FILE = os.getenv("LOG_FILE", "./logs/application.log")
+    LOG_ASYNC = os.getenv("LOG_ASYNC", "True").lower() == "true"
+    
+    # Requests slower than this many seconds are written to the slow query log (0 disables)
+    SLOW_QUERY_SECONDS = float(os.getenv("SLOW_QUERY_SECONDS", "10"))
+    SLOW_QUERY_LOG = os.getenv("SLOW_QUERY_LOG", "./logs/slow_queries.log")
+    
+    # Rows per event on the streaming /query/stream endpoint
+    STREAM_CHUNK_ROWS = int(os.getenv("STREAM_CHUNK_ROWS", "100"))
+    
+    # Response compression (brotli needs the brotli package, otherwise gzip)
+    RESPONSE_COMPRESSION = os.getenv("RESPONSE_COMPRESSION", "True").lower() == "true"
+    RESPONSE_COMPRESSION_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESSION_MIN_BYTES", "1024"))
     
     # Flask configuration
     DEBUG = os.getenv("FLASK_DEBUG", "True").lower() == "true"
@@ -0,0 +1,45 @@
+import asyncio
+import threading
+
+from .logger_config import setup_logging
+
+
+class AsyncLoopRunner:
+    """
+    Runs a single asyncio event loop in a background thread
+
+    Flask runs every async view on its own short-lived event loop, so async
+    clients, connection pools and semaphores created there can't be shared
+    between requests. Submitting coroutines to one long-lived loop instead lets
+    all in-flight questions share the same async OpenAI client and the same
+    concurrency limit.
+    """
+
+    def __init__(self, name='AsyncLoopRunner'):
+        self.logger = setup_logging('FlaskApp')
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        self.logger.info(f"Started background event loop: {name}")
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        """Schedule a coroutine on the background loop and return a concurrent future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def run_async(self, coro):
+        """Await a coroutine on the background loop from another event loop"""
+        return await asyncio.wrap_future(self.submit(coro))
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the background loop and block until it finishes"""
+        return self.submit(coro).result(timeout)
+
+    def stop(self):
+        """Stop the background loop and wait for its thread to exit"""
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
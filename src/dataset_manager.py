@@ -0,0 +1,195 @@
+import os
+import threading
+import time
+
+from .dataset_store import dataset_fingerprint, load_dataset
+from .logger_config import setup_logging
+from .profiler import load_or_build_profile
+
+
+class DatasetSnapshot:
+    """
+    One loaded version of a dataset: its DataFrame, profile, schema prompt and indexes
+
+    df is None when the query engine reads the dataset file itself.
+    """
+
+    def __init__(self, df, profile, schema, fingerprint, version, column_index=None, filter_index=None,
+                 cache_path=None):
+        self.df = df
+        self.profile = profile
+        self.schema = schema
+        self.column_index = column_index
+        self.filter_index = filter_index
+        self.fingerprint = fingerprint
+        self.version = version
+        # Memory-mapped columnar file df was read from, if any
+        self.cache_path = cache_path
+        self.loaded_at = time.time()
+
+
+class DatasetManager:
+    """
+    Owns the current snapshot of a CSV dataset and swaps in new versions
+
+    Queries read `current` once and keep using that snapshot, so a reload never
+    changes the data underneath a question that is already running. New
+    versions are loaded and profiled off the request path, either by the file
+    watcher or by an explicit reload, and only become visible once they are
+    complete. Listeners registered with add_listener are called with
+    (old_snapshot, new_snapshot) after each swap so dependent caches can drop
+    entries for the old version.
+    """
+
+    def __init__(self, csv_path, describe, cache_dir=None, use_hash=False, watch_interval=None, index=None,
+                 filter_index=None, compact_dtypes=False, profiler=None):
+        """
+        Args:
+            csv_path (str): Path to the CSV file
+            describe (callable): Builds the schema prompt from a dataset profile
+            cache_dir (str): Directory for the columnar copy and profile sidecar
+            use_hash (bool): Detect source changes by content hash instead of mtime
+            watch_interval (float): Seconds between checks of the CSV for changes
+                (None disables the watcher)
+            index (callable): Builds a column search index from a dataset profile
+            filter_index (callable): Builds row filter indexes from a DataFrame
+            compact_dtypes (bool): Load the dataset with compact dtypes (see optimize_dtypes)
+            profiler (callable): Profiles a dataset version, given its fingerprint,
+                without loading it into pandas, e.g. for a query engine that
+                reads the file itself; snapshots then have no DataFrame
+        """
+        self.logger = setup_logging('ExcelQuerySystem')
+        self.csv_path = csv_path
+        self.describe = describe
+        self.index = index
+        self.filter_index = filter_index
+        self.cache_dir = cache_dir
+        self.use_hash = use_hash
+        self.compact_dtypes = compact_dtypes
+        self.profiler = profiler
+
+        self._listeners = []
+        self._swap_lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._reload_thread = None
+        self._stop = threading.Event()
+        self._watch_thread = None
+
+        self._stat = self._source_stat()
+        self._current = self._load(version=1)
+
+        if watch_interval:
+            self._watch_thread = threading.Thread(
+                target=self._watch, args=(watch_interval,), name='DatasetWatcher', daemon=True
+            )
+            self._watch_thread.start()
+            self.logger.info(f"Watching {csv_path} for changes every {watch_interval}s")
+
+    @property
+    def current(self):
+        """The snapshot new queries should use"""
+        return self._current
+
+    def add_listener(self, callback):
+        """Call callback(old_snapshot, new_snapshot) after every swap"""
+        self._listeners.append(callback)
+
+    def _source_stat(self):
+        try:
+            stat = os.stat(self.csv_path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def _load(self, version):
+        self.logger.info(f"Loading CSV file from: {self.csv_path}")
+        if self.profiler is not None:
+            fingerprint = dataset_fingerprint(self.csv_path, self.use_hash, self.compact_dtypes)
+            df, cache_path = None, None
+            profile = load_or_build_profile(None, fingerprint, cache_dir=self.cache_dir, name=self.csv_path,
+                                            build=lambda: self.profiler(fingerprint), kind='sql')
+        else:
+            df, fingerprint, cache_path = load_dataset(self.csv_path, cache_dir=self.cache_dir,
+                                                     use_hash=self.use_hash, compact=self.compact_dtypes)
+            profile = load_or_build_profile(df, fingerprint, cache_dir=self.cache_dir, name=self.csv_path)
+        schema = self.describe(profile)
+        column_index = self.index(profile) if self.index is not None else None
+        filter_index = self.filter_index(df) if self.filter_index is not None and df is not None else None
+        return DatasetSnapshot(df, profile, schema, fingerprint, version, column_index, filter_index, cache_path)
+
+    def reload(self, force=False):
+        """
+        Load the current version of the CSV and swap it in
+
+        Blocks until the new version is ready. Concurrent callers wait for the
+        reload in progress instead of loading the file twice.
+
+        Args:
+            force (bool): Reload even if the file's fingerprint hasn't changed
+
+        Returns:
+            bool: True if a new snapshot was swapped in
+        """
+        with self._reload_lock:
+            old = self._current
+            self._stat = self._source_stat()
+            try:
+                if not force and dataset_fingerprint(self.csv_path, self.use_hash, self.compact_dtypes) == old.fingerprint:
+                    self.logger.info("Dataset unchanged, skipping reload")
+                    return False
+                new = self._load(version=old.version + 1)
+            except Exception as e:
+                # Keep serving the old version rather than failing queries
+                self.logger.error(f"Failed to reload dataset, keeping version {old.version}: {str(e)}", exc_info=True)
+                return False
+
+            with self._swap_lock:
+                self._current = new
+            self.logger.info(
+                f"Swapped dataset to version {new.version} "
+                f"(fingerprint {new.fingerprint}, {new.profile['rows']} rows)"
+            )
+
+        for callback in self._listeners:
+            try:
+                callback(old, new)
+            except Exception as e:
+                self.logger.error(f"Dataset reload listener failed: {str(e)}", exc_info=True)
+        return True
+
+    def reload_async(self, force=False):
+        """
+        Start a reload in a background thread
+
+        Returns:
+            bool: False if a background reload is already running
+        """
+        with self._swap_lock:
+            if self._reload_thread is not None and self._reload_thread.is_alive():
+                return False
+            self._reload_thread = threading.Thread(
+                target=self.reload, kwargs={'force': force}, name='DatasetReload', daemon=True
+            )
+            self._reload_thread.start()
+        return True
+
+    def _watch(self, interval):
+        pending = None
+        while not self._stop.wait(interval):
+            stat = self._source_stat()
+            if stat is None or stat == self._stat:
+                pending = None
+                continue
+            # Wait until the file has stopped changing so a half-written CSV isn't loaded
+            if stat != pending:
+                pending = stat
+                continue
+            pending = None
+            self.logger.info(f"Detected change to {self.csv_path}, reloading")
+            self.reload()
+
+    def stop(self):
+        """Stop the file watcher"""
+        self._stop.set()
+        if self._watch_thread is not None:
+            self._watch_thread.join()
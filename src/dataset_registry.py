@@ -0,0 +1,185 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .logger_config import setup_logging
+
+
+def dataset_name(csv_path):
+    """Default dataset name for a file: its name without the extension"""
+    return os.path.splitext(os.path.basename(csv_path))[0]
+
+
+def parse_dataset_list(value):
+    """
+    Parse a DATASETS setting of the form 'name=path,name2=path2'
+
+    Entries without a name are named after their file, so a plain
+    comma-separated list of paths also works.
+
+    Returns:
+        dict: Dataset name to CSV path, in the order given
+    """
+    datasets = {}
+    for item in (value or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        name, separator, path = item.partition('=')
+        if not separator:
+            path = name
+            name = dataset_name(path)
+        name, path = name.strip(), path.strip()
+        if name in datasets:
+            raise ValueError(f"Duplicate dataset name: {name}")
+        datasets[name] = path
+    return datasets
+
+
+class RegisteredDataset:
+    """A dataset the registry can serve, and its query system once loaded"""
+
+    def __init__(self, name, csv_path):
+        self.name = name
+        self.csv_path = csv_path
+        self.system = None
+        self.size = 0
+        self.active = 0
+        self.last_used = 0.0
+        self.load_lock = threading.Lock()
+
+
+class DatasetRegistry:
+    """
+    Serves several CSV datasets from one process
+
+    Each dataset gets its own ExcelQuerySystem, built by the factory the first
+    time a question is asked about it, so every dataset has its own schema
+    prompt, snapshot and query executor. Plan and result caches are keyed by
+    schema and dataset fingerprint, so they can safely be shared between
+    systems. Once the loaded DataFrames together use more than max_bytes
+    (measured with memory_usage(deep=True)), the least recently used datasets
+    with no query in flight are unloaded; they load again on their next
+    question.
+    """
+
+    def __init__(self, datasets, factory, max_bytes=None, default=None):
+        """
+        Args:
+            datasets (dict): Dataset name to CSV path
+            factory (callable): Builds an ExcelQuerySystem for a CSV path
+            max_bytes (int): Memory budget for loaded datasets (None for no limit)
+            default (str): Dataset used when a request doesn't name one
+                (defaults to the first dataset)
+        """
+        if not datasets:
+            raise ValueError("At least one dataset must be configured")
+        self.logger = setup_logging('ExcelQuerySystem')
+        self.factory = factory
+        self.max_bytes = max_bytes
+        self._datasets = {name: RegisteredDataset(name, path) for name, path in datasets.items()}
+        self.default = default if default is not None else next(iter(self._datasets))
+        if self.default not in self._datasets:
+            raise ValueError(f"Unknown default dataset: {self.default}")
+        self._lock = threading.Lock()
+
+    def names(self):
+        """Return the names of every registered dataset"""
+        return list(self._datasets)
+
+    def _get(self, name):
+        entry = self._datasets.get(name or self.default)
+        if entry is None:
+            raise ValueError(f"Unknown dataset: {name}")
+        return entry
+
+    def _measure(self, entry, df):
+        # Datasets DuckDB reads from disk hold no DataFrame
+        size = int(df.memory_usage(deep=True, index=True).sum()) if df is not None else 0
+        with self._lock:
+            entry.size = size
+
+    def _load(self, entry):
+        """Build the dataset's query system unless another request already has"""
+        with entry.load_lock:
+            if entry.system is not None:
+                return
+            self.logger.info(f"Loading dataset '{entry.name}' from {entry.csv_path}")
+            system = self.factory(entry.csv_path)
+            entry.system = system
+            self._measure(entry, system.df)
+
+            def on_reload(old, new):
+                # Reloads replace the DataFrame, so account for the new version
+                if entry.system is system:
+                    self._measure(entry, new.df)
+
+            system.dataset.add_listener(on_reload)
+            self.logger.info(f"Dataset '{entry.name}' loaded ({entry.size} bytes)")
+
+    def _enforce_budget(self):
+        """Unload idle datasets, least recently used first, until within max_bytes"""
+        if self.max_bytes is None:
+            return
+        evicted = []
+        with self._lock:
+            loaded = [entry for entry in self._datasets.values() if entry.system is not None]
+            total = sum(entry.size for entry in loaded)
+            for entry in sorted(loaded, key=lambda entry: entry.last_used):
+                if total <= self.max_bytes:
+                    break
+                if entry.active:
+                    continue
+                evicted.append(entry.system)
+                entry.system = None
+                total -= entry.size
+                entry.size = 0
+                self.logger.info(f"Unloaded idle dataset '{entry.name}' to stay within the memory budget")
+        if total > self.max_bytes:
+            self.logger.warning(f"Datasets in use need {total} bytes, over the {self.max_bytes} byte budget")
+        for system in evicted:
+            system.dataset.stop()
+
+    @contextmanager
+    def acquire(self, name=None):
+        """
+        Use a dataset's query system, loading it first if needed
+
+        The dataset can't be unloaded while the block runs.
+
+        Args:
+            name (str): Dataset name (None for the default dataset)
+
+        Raises:
+            ValueError: If no dataset has that name
+        """
+        entry = self._get(name)
+        with self._lock:
+            entry.active += 1
+            entry.last_used = time.time()
+        try:
+            if entry.system is None:
+                self._load(entry)
+                self._enforce_budget()
+            yield entry.system
+        finally:
+            with self._lock:
+                entry.active -= 1
+                entry.last_used = time.time()
+
+    def status(self):
+        """Describe every registered dataset for the /datasets endpoint"""
+        with self._lock:
+            return [{
+                'name': entry.name,
+                'default': entry.name == self.default,
+                'loaded': entry.system is not None,
+                'memory_bytes': entry.size,
+            } for entry in self._datasets.values()]
+
+    def stop(self):
+        """Stop the file watchers of every loaded dataset"""
+        for entry in self._datasets.values():
+            if entry.system is not None:
+                entry.system.dataset.stop()
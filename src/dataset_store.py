@@ -0,0 +1,173 @@
+import glob
+import hashlib
+import os
+
+import pandas as pd
+
+from .logger_config import setup_logging
+
+try:
+    import pyarrow.feather as feather
+except ImportError:  # pragma: no cover - pyarrow is optional
+    feather = None
+
+logger = setup_logging('ExcelQuerySystem')
+
+# Object columns with at most this share of distinct values become categoricals
+CATEGORY_MAX_RATIO = 0.5
+# Bump when what goes into a cache file changes so old cache files are rebuilt
+CACHE_FORMAT_VERSION = 2
+
+
+def source_signature(csv_path, use_hash=False, compact=False):
+    """
+    Describe the current version of a source file
+
+    Args:
+        csv_path (str): Path to the CSV file
+        use_hash (bool): Include a SHA-256 of the contents instead of trusting mtime alone
+        compact (bool): The dataset is loaded with optimize_dtypes
+    """
+    stat = os.stat(csv_path)
+    signature = f"{os.path.abspath(csv_path)}|{stat.st_size}|{stat.st_mtime_ns}|v{CACHE_FORMAT_VERSION}"
+    if use_hash:
+        digest = hashlib.sha256()
+        with open(csv_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        signature = f"{os.path.abspath(csv_path)}|{digest.hexdigest()}|v{CACHE_FORMAT_VERSION}"
+    if compact:
+        signature += '|compact'
+    return signature
+
+
+def dataset_fingerprint(csv_path, use_hash=False, compact=False):
+    """Return a short fingerprint that changes whenever the source file or its dtypes do"""
+    return hashlib.sha256(source_signature(csv_path, use_hash, compact).encode('utf-8')).hexdigest()[:16]
+
+
+def cache_file_prefix(source_path):
+    """
+    Prefix for the names of cache files built from a source file
+
+    Includes a hash of the absolute path, so files with the same name in
+    different directories never share (or clean up) each other's caches.
+    """
+    stem = os.path.splitext(os.path.basename(source_path))[0].replace(' ', '_')
+    path_hash = hashlib.sha256(os.path.abspath(source_path).encode('utf-8')).hexdigest()[:8]
+    return f"{stem}-{path_hash}"
+
+
+def _downcast_float(series):
+    """Downcast a float column to float32 only when no value changes"""
+    downcast = series.astype('float32')
+    same = (downcast.astype(series.dtype) == series) | series.isna()
+    return downcast if same.all() else series
+
+
+def optimize_dtypes(df):
+    """
+    Return a copy of df with compact dtypes
+
+    Low-cardinality string columns become categoricals, integers are downcast to
+    the smallest type that holds them, and floats are downcast to float32 when
+    that is lossless.
+
+    This changes how queries behave, not just memory use: arithmetic on
+    downcast integers wraps around instead of widening, and categoricals
+    reject comparisons and string concatenation and list unused categories
+    in value_counts. Only applied when a dataset opts in.
+    """
+    optimized = {}
+    for col in df.columns:
+        series = df[col]
+        if pd.api.types.is_bool_dtype(series):
+            optimized[col] = series
+        elif pd.api.types.is_integer_dtype(series):
+            optimized[col] = pd.to_numeric(series, downcast='integer')
+        elif pd.api.types.is_float_dtype(series):
+            optimized[col] = _downcast_float(series)
+        elif pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series):
+            non_null = series.count()
+            if non_null and series.nunique() / non_null <= CATEGORY_MAX_RATIO:
+                optimized[col] = series.astype('category')
+            else:
+                optimized[col] = series
+        else:
+            optimized[col] = series
+    return pd.DataFrame(optimized, index=df.index)
+
+
+def _cache_path(csv_path, cache_dir, fingerprint):
+    return os.path.join(cache_dir, f"{cache_file_prefix(csv_path)}-{fingerprint}.arrow")
+
+
+def _read_csv(csv_path, compact=False):
+    df = pd.read_csv(csv_path)
+    return optimize_dtypes(df) if compact else df
+
+
+def _build_cache(csv_path, cache_path, compact=False):
+    """Parse the CSV once and write it as an uncompressed Arrow IPC (Feather v2) file"""
+    logger.info(f"Building columnar cache for {csv_path}")
+    df = _read_csv(csv_path, compact)
+
+    # Uncompressed so readers can memory-map the file without decoding it
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    feather.write_feather(df, tmp_path, compression='uncompressed')
+    os.replace(tmp_path, cache_path)
+
+    # Drop caches built from older versions of the same source file
+    prefix = os.path.join(os.path.dirname(cache_path), cache_file_prefix(csv_path))
+    for stale_path in glob.glob(f"{glob.escape(prefix)}-{'?' * 16}.arrow"):
+        if stale_path != cache_path:
+            try:
+                os.remove(stale_path)
+            except OSError:
+                pass
+    logger.info(f"Columnar cache written to {cache_path}")
+
+
+def read_cache(cache_path):
+    """Memory-map a columnar cache file as a DataFrame"""
+    table = feather.read_table(cache_path, memory_map=True)
+    # split_blocks keeps null-free numeric columns as zero-copy views of the mapped file
+    return table.to_pandas(split_blocks=True)
+
+
+def load_dataset(csv_path, cache_dir=None, use_hash=False, compact=False):
+    """
+    Load a CSV file, going through a memory-mapped columnar cache when possible
+
+    The first load converts the CSV into an Arrow IPC file in cache_dir. Later
+    loads, including those from other worker processes, memory-map that file,
+    so numeric columns share the operating system's page cache instead of
+    each process parsing and holding its own copy. The cache is rebuilt when
+    the source file's signature (size and mtime, or its hash) changes.
+
+    Args:
+        csv_path (str): Path to the CSV file
+        cache_dir (str): Directory for columnar cache files (None reads the CSV directly)
+        use_hash (bool): Detect source changes by content hash instead of mtime
+        compact (bool): Shrink dtypes with optimize_dtypes, which changes
+            integer overflow and string semantics
+
+    Returns:
+        tuple: (DataFrame, dataset fingerprint, path of the columnar cache file or None)
+    """
+    fingerprint = dataset_fingerprint(csv_path, use_hash, compact)
+
+    if cache_dir is None:
+        return _read_csv(csv_path, compact), fingerprint, None
+    if feather is None:
+        logger.warning("pyarrow is not installed, reading the CSV without a columnar cache")
+        return _read_csv(csv_path, compact), fingerprint, None
+
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = _cache_path(csv_path, cache_dir, fingerprint)
+    if not os.path.exists(cache_path):
+        _build_cache(csv_path, cache_path, compact)
+    else:
+        logger.info(f"Using columnar cache {cache_path}")
+
+    return read_cache(cache_path), fingerprint, cache_path
@@ -0,0 +1,384 @@
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from .logger_config import setup_logging
+
+# Substring patterns are matched against the distinct values of a column, not
+# its rows; columns with at most this many also get a trigram index to narrow
+# down which distinct values can match
+NGRAM_SIZE = 3
+NGRAM_MAX_VALUES = 200000
+
+EMPTY = np.array([], dtype=np.intp)
+
+# Position sets larger than 1/DENSE_FRACTION of the rows are sorted and combined
+# through a boolean mask, which is linear in the rows, instead of by sorting
+DENSE_FRACTION = 16
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _is_nan(value):
+    return isinstance(value, float) and value != value
+
+
+def _is_dense(count, length):
+    return count * DENSE_FRACTION >= length
+
+
+def sort_positions(positions, length):
+    """Sort distinct row positions of a frame with length rows"""
+    if not _is_dense(len(positions), length):
+        return np.sort(positions)
+    mask = np.zeros(length, dtype=bool)
+    mask[positions] = True
+    return np.flatnonzero(mask)
+
+
+def intersect_positions(left, right, length):
+    """Sorted positions in both of two sorted position arrays"""
+    if len(left) == 0 or len(right) == 0:
+        return EMPTY
+    if not _is_dense(len(left) + len(right), length):
+        return np.intersect1d(left, right, assume_unique=True)
+    mask = np.zeros(length, dtype=bool)
+    mask[left] = True
+    return right[mask[right]]
+
+
+def union_positions(left, right, length):
+    """Sorted positions in either of two sorted position arrays"""
+    if not _is_dense(len(left) + len(right), length):
+        return np.union1d(left, right)
+    mask = np.zeros(length, dtype=bool)
+    mask[left] = True
+    mask[right] = True
+    return np.flatnonzero(mask)
+
+
+def plan_columns(plan):
+    """Columns a filter plan reads"""
+    if plan[0] in ('and', 'or'):
+        return [column for child in plan[1:] for column in plan_columns(child)]
+    return [plan[1]]
+
+
+class SortedIndex:
+    """Row positions of a numeric column ordered by value, for equality and range filters"""
+
+    def __init__(self, series):
+        self.length = len(series)
+        values = series.to_numpy()
+        if values.dtype.kind in 'iu':
+            values = values.astype(np.int64)
+        positions = np.arange(len(values), dtype=np.intp)
+        if values.dtype.kind == 'f':
+            valid = ~np.isnan(values)
+            values, positions = values[valid], positions[valid]
+        order = np.argsort(values, kind='stable')
+        self.values = values[order]
+        self.positions = positions[order]
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.positions.nbytes
+
+    def _slice(self, start, stop):
+        return sort_positions(self.positions[start:stop], self.length) if stop > start else EMPTY
+
+    def _key(self, value):
+        # Pandas compares a float32 column with a Python number in float32, not float64
+        if self.values.dtype.kind == 'f':
+            with np.errstate(over='ignore'):
+                return self.values.dtype.type(value)
+        return value
+
+    def compare(self, op, value):
+        value = self._key(value)
+        if op == '==':
+            return self._slice(np.searchsorted(self.values, value, 'left'), np.searchsorted(self.values, value, 'right'))
+        if op == '<':
+            return self._slice(0, np.searchsorted(self.values, value, 'left'))
+        if op == '<=':
+            return self._slice(0, np.searchsorted(self.values, value, 'right'))
+        if op == '>':
+            return self._slice(np.searchsorted(self.values, value, 'right'), len(self.values))
+        return self._slice(np.searchsorted(self.values, value, 'left'), len(self.values))
+
+    def between(self, low, high):
+        low, high = self._key(low), self._key(high)
+        return self._slice(np.searchsorted(self.values, low, 'left'), np.searchsorted(self.values, high, 'right'))
+
+    def isin(self, values):
+        rows = [self.compare('==', value) for value in values]
+        return sort_positions(np.unique(np.concatenate(rows)), self.length) if rows else EMPTY
+
+
+class StringIndex:
+    """
+    Hash index from each distinct value of a column to its row positions
+
+    Equality and isin filters are dictionary lookups. Substring filters run
+    str.contains over the distinct values, narrowed down by a trigram index
+    when there is one, and then take the rows of the values that matched.
+    """
+
+    def __init__(self, series):
+        self.length = len(series)
+        codes, uniques = pd.factorize(series)
+        self.values = np.asarray(uniques, dtype=object)
+        self._codes = {value: code for code, value in enumerate(self.values)}
+        order = np.argsort(codes, kind='stable').astype(np.intp)
+        missing = int((codes < 0).sum())
+        # Missing values sort first, with code -1
+        self.null_positions = np.sort(order[:missing])
+        self.positions = order[missing:]
+        counts = np.bincount(codes[codes >= 0], minlength=len(self.values))
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+        self.all_strings = all(isinstance(value, str) for value in self.values)
+
+        self._grams = None
+        if self.all_strings and len(self.values) <= NGRAM_MAX_VALUES:
+            grams = {}
+            for code, value in enumerate(self.values):
+                value = value.lower()
+                for gram in {value[i:i + NGRAM_SIZE] for i in range(len(value) - NGRAM_SIZE + 1)}:
+                    grams.setdefault(gram, []).append(code)
+            self._grams = {gram: np.array(found, dtype=np.intp) for gram, found in grams.items()}
+
+    @property
+    def nbytes(self):
+        grams = sum(found.nbytes for found in self._grams.values()) if self._grams else 0
+        return self.positions.nbytes + self.null_positions.nbytes + self.offsets.nbytes + grams
+
+    @property
+    def has_nulls(self):
+        return len(self.null_positions) > 0
+
+    def _rows(self, codes):
+        if len(codes) == 0:
+            return EMPTY
+        rows = [self.positions[self.offsets[code]:self.offsets[code + 1]] for code in codes]
+        if len(rows) == 1:
+            # The stable sort kept each value's rows in order
+            return rows[0]
+        return sort_positions(np.concatenate(rows), self.length)
+
+    def equals(self, value):
+        code = self._codes.get(value)
+        return EMPTY if code is None else self._rows([code])
+
+    def isin(self, values):
+        codes = {self._codes[value] for value in values if value in self._codes}
+        return self._rows(sorted(codes))
+
+    def _candidates(self, pattern):
+        """Codes of the distinct values that can contain pattern"""
+        if self._grams is None or len(pattern) < NGRAM_SIZE or not pattern.isascii():
+            return np.arange(len(self.values), dtype=np.intp)
+        pattern = pattern.lower()
+        candidates = None
+        for gram in {pattern[i:i + NGRAM_SIZE] for i in range(len(pattern) - NGRAM_SIZE + 1)}:
+            found = self._grams.get(gram)
+            if found is None:
+                return EMPTY
+            candidates = found if candidates is None else np.intersect1d(candidates, found, assume_unique=True)
+        return candidates
+
+    def contains(self, pattern, case=True, regex=True, na=None):
+        candidates = self._candidates(pattern)
+        matched = pd.Series(self.values[candidates], dtype=object).str.contains(
+            pattern, case=case, regex=regex, na=bool(na)
+        ).to_numpy(dtype=bool)
+        rows = self._rows(candidates[matched])
+        if na and self.has_nulls:
+            rows = union_positions(rows, self.null_positions, self.length)
+        return rows
+
+
+class FilterStats:
+    """How often each column is filtered on by the queries that ran"""
+
+    def __init__(self):
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, columns):
+        """Count filters on columns: column names, or a {column: count} mapping"""
+        with self._lock:
+            self._counts.update(columns)
+
+    def counts(self):
+        """Filters per column so far"""
+        with self._lock:
+            return dict(self._counts)
+
+    def hot(self, columns, min_count, limit):
+        """The most filtered of columns, at least min_count times each"""
+        columns = set(columns)
+        with self._lock:
+            ranked = self._counts.most_common()
+        return [column for column, count in ranked if count >= min_count and column in columns][:limit]
+
+
+class FilterIndex:
+    """
+    Secondary indexes over the most filtered columns of one DataFrame
+
+    Numeric columns get a sorted index for equality, range, between and isin
+    filters; text and categorical columns get a hash index for equality and
+    isin, plus trigrams for str.contains. The executor rewrites filters it
+    can answer from these indexes, e.g. df[df['Company'] == 'Tesla'], into
+    a positional take of just the matching rows, instead of comparing every
+    row.
+
+    Which columns are indexed comes from FilterStats: the columns filtered
+    on at least min_filters times, up to max_columns of them, are indexed when
+    the DataFrame is loaded, and columns that become popular later are indexed
+    in the background. DataFrames shorter than min_rows are never indexed,
+    since scanning them is already cheap.
+
+    Filter plans are tuples produced by the executor:
+    ('cmp', column, op, value) with op one of ==, <, <=, >, >=;
+    ('isin', column, values); ('between', column, low, high);
+    ('contains', column, pattern, case, regex, na); and ('and' | 'or', plan, plan).
+    """
+
+    def __init__(self, df, stats=None, min_filters=3, max_columns=8, min_rows=100000):
+        """
+        Args:
+            df (DataFrame): The DataFrame to index; never modified
+            stats (FilterStats): Filter counts that decide which columns to index
+            min_filters (int): Filters on a column before it is indexed
+            max_columns (int): Most columns indexed
+            min_rows (int): Smallest DataFrame worth indexing
+        """
+        self.logger = setup_logging('ExcelQuerySystem')
+        self.frame = df
+        self.stats = stats if stats is not None else FilterStats()
+        self.min_filters = min_filters
+        self.max_columns = max_columns
+        self.enabled = len(df) >= min_rows
+        self._indexes = {}
+        self._skipped = set()
+        self._lock = threading.Lock()
+        self._building = False
+        if self.enabled:
+            self._build(self._wanted())
+
+    @property
+    def columns(self):
+        return list(self._indexes)
+
+    @property
+    def nbytes(self):
+        return sum(index.nbytes for index in list(self._indexes.values()))
+
+    def _wanted(self):
+        hot = self.stats.hot(self.frame.columns, self.min_filters, self.max_columns)
+        return [column for column in hot if column not in self._indexes and column not in self._skipped]
+
+    def _build(self, columns):
+        for column in columns:
+            series = self.frame[column]
+            if not isinstance(series, pd.Series):
+                # Duplicate column names
+                self._skipped.add(column)
+                continue
+            start = time.perf_counter()
+            index = None
+            dtype = series.dtype
+            if pd.api.types.is_bool_dtype(dtype):
+                index = None
+            elif isinstance(dtype, np.dtype) and dtype.kind in 'iuf' and dtype != np.uint64:
+                index = SortedIndex(series)
+            elif pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype) \
+                    or isinstance(dtype, pd.CategoricalDtype):
+                try:
+                    index = StringIndex(series)
+                except TypeError:
+                    # Unhashable values such as lists
+                    index = None
+            if index is None:
+                self._skipped.add(column)
+                continue
+            self._indexes[column] = index
+            self.logger.info(f"Indexed column '{column}' for filtering in "
+                             f"{time.perf_counter() - start:.2f}s ({index.nbytes} bytes)")
+
+    def _build_in_background(self):
+        try:
+            self._build(self._wanted())
+        except Exception as e:
+            self.logger.error(f"Error building filter indexes: {str(e)}", exc_info=True)
+        finally:
+            with self._lock:
+                self._building = False
+
+    def observe(self, plans):
+        """Count the columns a query filtered on, indexing any that became popular"""
+        if not plans:
+            return
+        self.stats.record(column for plan in plans for column in plan_columns(plan))
+        if not self.enabled or len(self._indexes) >= self.max_columns:
+            return
+        with self._lock:
+            if self._building or not self._wanted():
+                return
+            self._building = True
+        threading.Thread(target=self._build_in_background, name='FilterIndexBuilder', daemon=True).start()
+
+    def covers(self, plan):
+        """Whether the filter can be answered from the indexes exactly as pandas would"""
+        kind = plan[0]
+        if kind in ('and', 'or'):
+            return all(self.covers(child) for child in plan[1:])
+        index = self._indexes.get(plan[1])
+        if kind == 'cmp':
+            _, _, op, value = plan
+            if _is_nan(value):
+                return False
+            if isinstance(index, SortedIndex):
+                return _is_number(value)
+            return isinstance(index, StringIndex) and op == '=='
+        if kind == 'isin':
+            values = plan[2]
+            if isinstance(index, SortedIndex):
+                return all(_is_number(value) and not _is_nan(value) for value in values)
+            return isinstance(index, StringIndex) and not any(_is_nan(value) for value in values)
+        if kind == 'between':
+            return isinstance(index, SortedIndex) and _is_number(plan[2]) and _is_number(plan[3]) \
+                and not (_is_nan(plan[2]) or _is_nan(plan[3]))
+        if kind == 'contains':
+            na = plan[5]
+            # Without na, pandas can't filter on a column with missing or non-text values
+            return isinstance(index, StringIndex) and (na is not None or (index.all_strings and not index.has_nulls))
+        return False
+
+    def positions(self, plan):
+        """Sorted row positions matching a covered filter plan"""
+        kind = plan[0]
+        if kind == 'and':
+            return intersect_positions(self.positions(plan[1]), self.positions(plan[2]), len(self.frame))
+        if kind == 'or':
+            return union_positions(self.positions(plan[1]), self.positions(plan[2]), len(self.frame))
+        index = self._indexes[plan[1]]
+        if kind == 'cmp':
+            if isinstance(index, StringIndex):
+                return index.equals(plan[3])
+            return index.compare(plan[2], plan[3])
+        if kind == 'isin':
+            return index.isin(plan[2])
+        if kind == 'between':
+            return index.between(plan[2], plan[3])
+        return index.contains(plan[2], case=plan[3], regex=plan[4], na=plan[5])
+
+    def select(self, df, plan):
+        """The rows of df matching a covered filter plan, in their original order"""
+        return df.iloc[self.positions(plan)]
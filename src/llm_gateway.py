@@ -0,0 +1,316 @@
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+import weakref
+
+import openai
+from openai import AsyncOpenAI, OpenAI
+
+from .logger_config import setup_logging
+from .telemetry import record_cache, record_tokens
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover - openai's default connection limits are used instead
+    httpx = None
+
+# Errors worth retrying: rate limits, dropped connections, timeouts and 5xx responses
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+
+def request_key(model, request):
+    """Hash of a chat request; identical prompts and parameters share a key"""
+    payload = json.dumps({'model': model, **request}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def retry_after(error):
+    """Seconds the API asked us to wait in a 429 or 503 response, if it said"""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return None
+
+
+class TokenBucket:
+    """
+    Request rate limiter shared by every thread and event loop
+
+    Callers reserve a token and sleep until it is theirs, so bursts are
+    smoothed to rate requests per second after the first capacity requests.
+    pause() holds every caller back, e.g. for the Retry-After of a 429, so
+    one rate limit response doesn't turn into a storm of them.
+    """
+
+    def __init__(self, rate=None, capacity=None):
+        """
+        Args:
+            rate (float): Requests per second (None for no limit)
+            capacity (int): Requests allowed in a burst (defaults to one second's worth)
+        """
+        self.rate = rate
+        self.capacity = capacity or (max(1, int(rate)) if rate else None)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """Take a token and return how long to wait before using it"""
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self._paused_until - now)
+            if self.rate:
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                self._tokens -= 1
+                if self._tokens < 0:
+                    wait = max(wait, -self._tokens / self.rate)
+            return wait
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait:
+            time.sleep(wait)
+
+    async def aacquire(self):
+        wait = self._reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        """Hold back every caller for the next seconds"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class _Flight:
+    """One in-flight upstream call that identical requests wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class _AsyncFlight:
+    """One in-flight upstream call on an event loop, and how many callers await it"""
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class LLMGateway:
+    """
+    Shared path for every chat completion the query systems send
+
+    Concurrent identical requests (same model, prompt and parameters) share
+    one upstream call, whether they come from worker threads or the async
+    event loop. Calls are paced by a token bucket, retried with jittered
+    exponential backoff on rate limits, connection errors and 5xx responses,
+    and a 429 pauses every caller for its Retry-After. One gateway, and so
+    one connection pool, serves all datasets in the process.
+
+    The gateway owns the deadline of a call: each attempt gets timeout
+    seconds, so callers shouldn't add a timeout of their own that would cut
+    the retries short.
+    """
+
+    def __init__(self, api_key=None, timeout=60, client=None, async_client=None,
+                 max_connections=100, max_retries=3, retry_base=0.5, retry_max=20,
+                 rate_limit=None, rate_burst=None, dedupe=True):
+        """
+        Args:
+            api_key (str): OpenAI API key
+            timeout (float): Seconds before a single upstream attempt is abandoned
+                and retried
+            client (OpenAI): Chat client to use instead of one built from api_key
+            async_client (AsyncOpenAI): Async chat client to use on every event loop
+            max_connections (int): Size of the HTTP connection pool
+            max_retries (int): Retries after the first attempt fails
+            retry_base (float): Backoff before the first retry; doubles on each retry
+            retry_max (float): Longest backoff between retries
+            rate_limit (float): Upstream requests per second (None for no limit)
+            rate_burst (int): Requests allowed in a burst above rate_limit
+            dedupe (bool): Share one upstream call between identical concurrent requests
+        """
+        self.logger = setup_logging('ExcelQuerySystem')
+        self.api_key = api_key
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.dedupe = dedupe
+        self.bucket = TokenBucket(rate_limit, rate_burst)
+        # Retries happen here, where they can respect the shared rate limit
+        self.client = client if client is not None else OpenAI(
+            api_key=api_key, timeout=timeout, max_retries=0,
+            http_client=self._http_client(openai.DefaultHttpxClient)
+        )
+        self._injected_async_client = async_client
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._inflight = {}
+        self._async_inflight = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _http_client(self, factory):
+        if httpx is None:
+            return None
+        limits = httpx.Limits(max_connections=self.max_connections,
+                              max_keepalive_connections=self.max_connections)
+        return factory(limits=limits, timeout=self.timeout)
+
+    def async_client(self):
+        """Return the async client for the running event loop"""
+        if self._injected_async_client is not None:
+            return self._injected_async_client
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                # httpx async connections belong to the loop that opened them
+                client = AsyncOpenAI(
+                    api_key=self.api_key, timeout=self.timeout, max_retries=0,
+                    http_client=self._http_client(openai.DefaultAsyncHttpxClient)
+                )
+                self._async_clients[loop] = client
+        return client
+
+    def _backoff(self, attempt, error):
+        """Jittered exponential backoff, or the wait the API asked for"""
+        delay = retry_after(error)
+        if delay is None:
+            delay = random.uniform(0, min(self.retry_max, self.retry_base * 2 ** attempt))
+        if isinstance(error, openai.RateLimitError):
+            self.bucket.pause(delay)
+        return delay
+
+    def _call(self, model, request):
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                response = self.client.chat.completions.create(model=model, **request)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e)
+                self.logger.warning(f"LLM call failed ({type(e).__name__}), retrying in {delay:.2f}s")
+                time.sleep(delay)
+                continue
+            record_tokens(getattr(response, 'usage', None))
+            return response
+
+    async def _acall(self, model, request):
+        client = self.async_client()
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.aacquire()
+            try:
+                # Also bounds stand-in clients that have no timeout of their own
+                response = await asyncio.wait_for(client.chat.completions.create(model=model, **request),
+                                                  timeout=self.timeout)
+            except (*RETRYABLE_ERRORS, asyncio.TimeoutError) as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e)
+                self.logger.warning(f"LLM call failed ({type(e).__name__}), retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                continue
+            record_tokens(getattr(response, 'usage', None))
+            return response
+
+    def create(self, model, request):
+        """
+        Send a chat completion, sharing the call with identical concurrent requests
+
+        Returns:
+            The completion; shared callers get the same object, so treat it as read-only
+        """
+        if not self.dedupe:
+            return self._call(model, request)
+        key = request_key(model, request)
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+        record_cache('llm', not leader)
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.response
+
+        try:
+            flight.response = self._call(model, request)
+            return flight.response
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.done.set()
+
+    async def acreate(self, model, request):
+        """Async version of create"""
+        if not self.dedupe:
+            return await self._acall(model, request)
+        key = request_key(model, request)
+        loop = asyncio.get_running_loop()
+        inflight = self._async_inflight.setdefault(loop, {})
+        flight = inflight.get(key)
+        record_cache('llm', flight is not None)
+        if flight is None:
+            # A task of its own, so a caller that is cancelled doesn't cancel
+            # the call for the others sharing it
+            flight = inflight[key] = _AsyncFlight(loop.create_task(self._acall(model, request)))
+
+            def finished(task):
+                if inflight.get(key) is flight:
+                    del inflight[key]
+                if not task.cancelled():
+                    task.exception()  # Retrieved here in case every caller gave up
+
+            flight.task.add_done_callback(finished)
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                # The last caller gave up, so nobody wants the response
+                if inflight.get(key) is flight:
+                    del inflight[key]
+                flight.task.cancel()
+
+    def stream(self, model, request):
+        """
+        Start a streamed chat completion
+
+        Streams aren't shared, but are rate limited and retried until the
+        first response arrives.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                return self.client.chat.completions.create(model=model, stream=True, **request)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e)
+                self.logger.warning(f"LLM stream failed to start ({type(e).__name__}), retrying in {delay:.2f}s")
+                time.sleep(delay)
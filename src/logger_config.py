@@ -1,53 +1,268 @@
+import atexit
+import copy
+import json
 import logging
 import os
-from datetime import datetime
-from logging.handlers import RotatingFileHandler
+import queue
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+# Largest DataFrame preview written to the log
+PREVIEW_ROWS = 5
+PREVIEW_COLUMNS = 10
+PREVIEW_VALUE_CHARS = 40
+
+# Defaults for loggers set up before configure_logging is called
+_settings = {
+    'level': os.getenv('LOG_LEVEL', 'DEBUG'),
+    'fmt': os.getenv('LOG_FORMAT', 'text'),
+    'path': os.getenv('LOG_FILE', './logs/application.log'),
+    'use_queue': os.getenv('LOG_ASYNC', 'True').lower() == 'true',
+    'console_level': 'INFO',
+}
+_loggers = {}
+_handlers = []
+_listener = None
+_lock = threading.RLock()
+
+
+class FramePreview:
+    """
+    Size-capped rendering of a DataFrame for log messages
+
+    Pass it as a logging argument instead of formatting the DataFrame into the
+    message, so nothing is rendered when the level is disabled and at most
+    the first few rows and columns are rendered when it isn't.
+    """
+
+    def __init__(self, df, max_rows=PREVIEW_ROWS, max_columns=PREVIEW_COLUMNS):
+        self.df = df
+        self.max_rows = max_rows
+        self.max_columns = max_columns
+
+    def __str__(self):
+        rows, columns = self.df.shape
+        if rows == 0:
+            return f"Empty DataFrame ({columns} columns)"
+        head = self.df.iloc[:self.max_rows, :self.max_columns]
+        text = head.to_string(max_colwidth=PREVIEW_VALUE_CHARS)
+        if rows > self.max_rows or columns > self.max_columns:
+            text += f"\n... {rows} rows x {columns} columns"
+        return text
+
+
+class _RecordQueueHandler(QueueHandler):
+    """Queues records with their message and traceback rendered, but not yet formatted"""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # Kept apart from the message so JSON output can put it in its own field
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as one JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SharedRotatingFileHandler(RotatingFileHandler):
+    """
+    Rotating log file that several worker processes can append to
+
+    Writes and rollovers take an exclusive lock on a sidecar lock file, and a
+    process that finds the file was rotated by another one reopens it, so
+    workers share one log instead of each opening its own.
+    """
+
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, **kwargs)
+        self._lock_file = None
+        self.reopen_lock()
+
+    def reopen_lock(self):
+        """Open the lock file; forked processes need their own handle for flock to exclude them"""
+        if fcntl is None:
+            return
+        if self._lock_file is not None:
+            self._lock_file.close()
+        self._lock_file = open(f"{self.baseFilename}.lock", 'a')
+
+    def _reopen_if_rotated(self):
+        if self.stream is None:
+            return
+        try:
+            rotated = os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+        except FileNotFoundError:
+            rotated = True
+        if rotated:
+            self.stream.close()
+            self.stream = self._open()
+
+    def emit(self, record):
+        if self._lock_file is None:
+            return super().emit(record)
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            self._reopen_if_rotated()
+            super().emit(record)
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def close(self):
+        super().close()
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+
+def _level(name):
+    level = logging.getLevelName(str(name).upper())
+    if not isinstance(level, int):
+        raise ValueError(f"Unknown log level: {name}")
+    return level
+
+
+def _build_handlers(level, fmt, path, console_level):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    file_handler = SharedRotatingFileHandler(
+        path,
+        maxBytes=10485760,  # 10MB
+        backupCount=5
+    )
+    file_handler.setLevel(level)
+    if fmt == 'json':
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter(
+            '%(asctime)s - %(name)s - %(process)d - %(levelname)s - %(message)s'
+        ))
+
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(console_level)
+    console_handler.setFormatter(logging.Formatter('%(levelname)s - %(message)s'))
+    return [file_handler, console_handler]
+
+
+def _attach(logger):
+    """Point a logger at the current handlers, through the queue when one is running"""
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    if _listener is not None:
+        logger.addHandler(_queue_handler)
+    else:
+        for handler in _handlers:
+            logger.addHandler(handler)
+    # Skip creating records for levels no handler would write
+    logger.setLevel(min(handler.level for handler in _handlers))
+    logger.propagate = False
+
+
+def _start():
+    global _handlers, _listener, _queue_handler
+    if _settings['fmt'] not in ('text', 'json'):
+        raise ValueError(f"Unknown log format: {_settings['fmt']}")
+    _handlers = _build_handlers(
+        _level(_settings['level']), _settings['fmt'], _settings['path'], _level(_settings['console_level'])
+    )
+    _listener = None
+    if _settings['use_queue']:
+        _queue_handler = _RecordQueueHandler(queue.SimpleQueue())
+        _listener = QueueListener(_queue_handler.queue, *_handlers, respect_handler_level=True)
+        _listener.start()
+
+
+def _stop():
+    global _listener
+    if _listener is not None:
+        # Flushes the records still queued
+        _listener.stop()
+        _listener = None
+    for handler in _handlers:
+        handler.close()
+
+
+def _restart_in_child():
+    # The listener thread doesn't survive fork; give each worker its own
+    global _listener
+    for handler in _handlers:
+        if isinstance(handler, SharedRotatingFileHandler):
+            handler.reopen_lock()
+    if _listener is not None:
+        _queue_handler.queue = queue.SimpleQueue()
+        _listener = QueueListener(_queue_handler.queue, *_handlers, respect_handler_level=True)
+        _listener.start()
+
+
+def configure_logging(level=None, fmt=None, path=None, use_queue=None, console_level=None):
+    """
+    Apply logging settings to every logger set up with setup_logging
+
+    Args:
+        level (str): Lowest level written to the log file, e.g. 'DEBUG' or 'INFO'
+        fmt (str): 'text' or 'json' (one JSON object per line) for the log file
+        path (str): Log file shared by every worker process
+        use_queue (bool): Hand records to a background thread instead of
+            writing them on the thread that logs
+        console_level (str): Lowest level written to the console (default 'INFO')
+    """
+    with _lock:
+        for key, value in (('level', level), ('fmt', fmt), ('path', path),
+                           ('use_queue', use_queue), ('console_level', console_level)):
+            if value is not None:
+                _settings[key] = value
+        if _handlers:
+            _stop()
+            _start()
+            for logger in _loggers.values():
+                _attach(logger)
+
+
+def logging_settings():
+    """Current settings, in the form configure_logging takes, e.g. for a child process"""
+    with _lock:
+        return dict(_settings)
+
 
 def setup_logging(name):
     """
     Set up logging configuration that can be used across the application
-    
+
     Args:
         name (str): Logger name ('FlaskApp' or 'ExcelQuerySystem')
     """
-    # Create logs directory if it doesn't exist
-    if not os.path.exists('logs'):
-        os.makedirs('logs')
-    
-    # Create logger
-    logger = logging.getLogger(name)
-    
-    # Only add handlers if they haven't been added already
-    if not logger.handlers:
-        logger.setLevel(logging.DEBUG)
-        
-        # Create handlers
-        current_time = datetime.now().strftime('%Y%m%d_%H%M%S')
-        
-        # Create rotating file handler
-        file_handler = RotatingFileHandler(
-            f'logs/application_{current_time}.log',
-            maxBytes=10485760,  # 10MB
-            backupCount=5
-        )
-        file_handler.setLevel(logging.DEBUG)
-        
-        # Console handler
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.INFO)
-        
-        # Create formatters
-        detailed_formatter = logging.Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-        )
-        simple_formatter = logging.Formatter('%(levelname)s - %(message)s')
-        
-        # Add formatters to handlers
-        file_handler.setFormatter(detailed_formatter)
-        console_handler.setFormatter(simple_formatter)
-        
-        # Add handlers to logger
-        logger.addHandler(file_handler)
-        logger.addHandler(console_handler)
-    
-    return logger
\ No newline at end of file
+    with _lock:
+        if not _handlers:
+            _start()
+            atexit.register(_stop)
+            if hasattr(os, 'register_at_fork'):
+                os.register_at_fork(after_in_child=_restart_in_child)
+        logger = _loggers.get(name)
+        if logger is None:
+            logger = logging.getLogger(name)
+            _attach(logger)
+            _loggers[name] = logger
+        return logger
@@ -0,0 +1,282 @@
+import glob
+import json
+import math
+import os
+import re
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from .dataset_store import cache_file_prefix
+from .logger_config import setup_logging
+
+logger = setup_logging('ExcelQuerySystem')
+
+# Bump when the profile layout changes so old sidecar files are rebuilt
+PROFILE_FORMAT_VERSION = 1
+
+# Rows profile_sql counts top values over; larger tables are sampled
+SQL_SAMPLE_ROWS = 100000
+
+# DuckDB column types profiled with a numeric or date range, like numeric and datetime dtypes
+SQL_INTEGER_TYPE = re.compile(r"^U?(TINYINT|SMALLINT|INTEGER|BIGINT|HUGEINT)$")
+SQL_FLOAT_TYPE = re.compile(r"^(FLOAT|DOUBLE|REAL|DECIMAL.*)$")
+SQL_TEMPORAL_TYPE = re.compile(r"^(DATE|TIME|TIMESTAMP).*$")
+
+
+class HyperLogLog:
+    """
+    Cardinality estimator over 64-bit hashes
+
+    Uses 2**precision one-byte registers (4 KiB at the default precision 12)
+    for a typical relative error of about 1.6%, however many values are added.
+    """
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def add_hashes(self, hashes):
+        """Add a numpy array of uint64 hashes"""
+        if len(hashes) == 0:
+            return
+        p = self.precision
+        index = (hashes >> np.uint64(64 - p)).astype(np.int64)
+        remaining = hashes & np.uint64((1 << (64 - p)) - 1)
+        # Rank is the position of the leftmost 1-bit in the remaining 64-p bits
+        _, bit_length = np.frexp(remaining.astype(np.float64))
+        rank = (64 - p) - bit_length + 1
+        np.maximum.at(self.registers, index, rank.astype(np.uint8))
+
+    def estimate(self):
+        """Return the estimated number of distinct values added"""
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small cardinalities
+            return int(round(m * math.log(m / zeros)))
+        return int(round(raw))
+
+
+def _to_json_value(value):
+    """Convert numpy and pandas scalars to something json can store"""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+def _has_order(series):
+    return (pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series)) \
+        or pd.api.types.is_datetime64_any_dtype(series)
+
+
+def profile_dataframe(df, chunk_size=100000, top_k=5, sample_size=3):
+    """
+    Compute per-column statistics in a single chunked pass over the rows
+
+    For every column this records the dtype, null ratio, a HyperLogLog
+    cardinality estimate, min/max for numeric and datetime columns, the top_k
+    most frequent values and a few sample values. Top values are tracked with
+    a bounded counter, so they are exact for low-cardinality columns and an
+    approximation otherwise.
+
+    Returns:
+        dict: Profile with 'rows' and a 'columns' list of per-column stats
+    """
+    # Keep extra candidates so heavy hitters survive trimming between chunks
+    counter_capacity = top_k * 20
+    states = {
+        col: {
+            'nulls': 0,
+            'hll': HyperLogLog(),
+            'min': None,
+            'max': None,
+            'counts': Counter(),
+            'samples': [],
+        }
+        for col in df.columns
+    }
+
+    for start in range(0, len(df), chunk_size):
+        chunk = df.iloc[start:start + chunk_size]
+        for col in df.columns:
+            series = chunk[col]
+            state = states[col]
+            non_null = series.dropna()
+            state['nulls'] += len(series) - len(non_null)
+            if non_null.empty:
+                continue
+
+            state['hll'].add_hashes(pd.util.hash_pandas_object(non_null, index=False).to_numpy())
+
+            if _has_order(series):
+                chunk_min, chunk_max = non_null.min(), non_null.max()
+                state['min'] = chunk_min if state['min'] is None else min(state['min'], chunk_min)
+                state['max'] = chunk_max if state['max'] is None else max(state['max'], chunk_max)
+
+            counts = state['counts']
+            chunk_counts = non_null.value_counts(sort=False)
+            chunk_counts = chunk_counts[chunk_counts > 0].nlargest(counter_capacity)
+            counts.update(chunk_counts.to_dict())
+            if len(counts) > counter_capacity:
+                state['counts'] = Counter(dict(counts.most_common(counter_capacity)))
+
+            if len(state['samples']) < sample_size:
+                for value in non_null.head(sample_size * 20).unique():
+                    if value not in state['samples']:
+                        state['samples'].append(value)
+                    if len(state['samples']) >= sample_size:
+                        break
+
+    rows = len(df)
+    columns = []
+    for col in df.columns:
+        state = states[col]
+        columns.append({
+            'name': str(col),
+            'dtype': str(df[col].dtype),
+            'null_ratio': round(state['nulls'] / rows, 4) if rows else 0.0,
+            'cardinality': state['hll'].estimate(),
+            'min': _to_json_value(state['min']),
+            'max': _to_json_value(state['max']),
+            'top_values': [[_to_json_value(value), int(count)]
+                           for value, count in state['counts'].most_common(top_k)],
+            'samples': [_to_json_value(value) for value in state['samples']],
+        })
+    return {'version': PROFILE_FORMAT_VERSION, 'rows': rows, 'columns': columns}
+
+
+def _quote(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _sql_range_value(value, column_type):
+    """Convert a SUMMARIZE min or max, which DuckDB returns as text, for the profile"""
+    if value is None:
+        return None
+    if SQL_INTEGER_TYPE.match(column_type):
+        return int(value)
+    if SQL_FLOAT_TYPE.match(column_type):
+        return float(value)
+    if SQL_TEMPORAL_TYPE.match(column_type):
+        return value
+    # Text and booleans have no range, as in profile_dataframe
+    return None
+
+
+def profile_sql(conn, table, top_k=5, sample_size=3, sample_rows=SQL_SAMPLE_ROWS):
+    """
+    Profile a DuckDB table or view in the layout of profile_dataframe
+
+    Nothing is loaded into pandas. SUMMARIZE computes null ratios, approximate
+    distinct counts and ranges in one scan; top values are counted over a
+    reservoir sample of sample_rows rows and scaled to the whole table, so
+    they are exact for tables no larger than the sample. Types are DuckDB's,
+    e.g. BIGINT or VARCHAR.
+
+    Args:
+        conn: DuckDB connection the table is visible on
+        table (str): Table or view to profile
+    """
+    summary = conn.execute(f"SUMMARIZE {table}")
+    fields = [description[0] for description in summary.description]
+    summary = [dict(zip(fields, row)) for row in summary.fetchall()]
+    rows = conn.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+
+    conn.execute(f"CREATE OR REPLACE TEMP TABLE profile_sample AS "
+                 f"SELECT * FROM {table} USING SAMPLE reservoir({int(sample_rows)} ROWS) REPEATABLE (0)")
+    try:
+        sampled = conn.execute("SELECT count(*) FROM profile_sample").fetchone()[0]
+        scale = rows / sampled if sampled else 0
+        top_values = {}
+        for column in summary:
+            name = _quote(column['column_name'])
+            counts = conn.execute(
+                f"SELECT {name}, count(*) AS n FROM profile_sample WHERE {name} IS NOT NULL "
+                f"GROUP BY 1 ORDER BY n DESC, 1 LIMIT {int(top_k)}"
+            ).fetchall()
+            top_values[column['column_name']] = [[_to_json_value(value), int(round(count * scale))]
+                                                 for value, count in counts]
+    finally:
+        conn.execute("DROP TABLE IF EXISTS profile_sample")
+
+    head = conn.execute(f"SELECT * FROM {table} LIMIT {int(sample_size) * 20}").fetchall()
+    columns = []
+    for position, column in enumerate(summary):
+        column_type = column['column_type']
+        samples = []
+        for row in head:
+            value = row[position]
+            if value is not None and value not in samples:
+                samples.append(value)
+                if len(samples) >= sample_size:
+                    break
+        columns.append({
+            'name': str(column['column_name']),
+            'dtype': column_type,
+            'null_ratio': round(float(column['null_percentage'] or 0) / 100, 4),
+            'cardinality': int(column['approx_unique'] or 0),
+            'min': _sql_range_value(column['min'], column_type),
+            'max': _sql_range_value(column['max'], column_type),
+            'top_values': top_values[column['column_name']],
+            'samples': [_to_json_value(value) for value in samples],
+        })
+    return {'version': PROFILE_FORMAT_VERSION, 'rows': rows, 'columns': columns}
+
+
+def load_or_build_profile(df, fingerprint, cache_dir=None, name='dataset', build=None, kind=None):
+    """
+    Return the profile for a dataset, reusing the sidecar cached for its fingerprint
+
+    Args:
+        df (DataFrame): The loaded dataset (None when build is given)
+        fingerprint (str): Dataset fingerprint from dataset_store.dataset_fingerprint
+        cache_dir (str): Directory for the sidecar profile (None always profiles in memory)
+        name (str): Path of the dataset's source file, used in the sidecar file name
+        build (callable): Returns the profile when there is no sidecar, instead
+            of profile_dataframe(df)
+        kind (str): Kind of profile build returns, e.g. 'sql', kept in its own
+            sidecar next to the DataFrame profile
+    """
+    path = None
+    suffix = f".{kind}.profile.json" if kind else ".profile.json"
+    if cache_dir is not None:
+        prefix = os.path.join(cache_dir, f"{cache_file_prefix(name)}-")
+        path = f"{prefix}{fingerprint}{suffix}"
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                profile = json.load(f)
+            if profile.get('version') == PROFILE_FORMAT_VERSION and profile.get('fingerprint') == fingerprint:
+                logger.info(f"Using cached dataset profile {path}")
+                return profile
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable dataset profile {path}: {str(e)}")
+
+    logger.info("Profiling dataset")
+    profile = build() if build is not None else profile_dataframe(df)
+    profile['fingerprint'] = fingerprint
+
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(profile, f)
+            os.replace(tmp_path, path)
+            logger.info(f"Dataset profile written to {path}")
+            # Drop profiles of older versions of the same source file
+            for stale_path in glob.glob(f"{glob.escape(prefix)}{'?' * 16}{suffix}"):
+                if stale_path != path:
+                    os.remove(stale_path)
+        except OSError as e:
+            logger.warning(f"Could not persist dataset profile to {path}: {str(e)}")
+    return profile
@@ -0,0 +1,331 @@
+import atexit
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from .logger_config import setup_logging
+
+# Filler words that don't change what a question asks for
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'about', 'can', 'could', 'display', 'do', 'does',
+    'for', 'give', 'i', 'in', 'is', 'list', 'me', 'of', 'please', 'show', 'tell',
+    'the', 'to', 'us', 'we', 'what', 'whats', 'which', 'would', 'you',
+}
+
+
+def normalize_question(question):
+    """Lowercase the question, drop punctuation and collapse whitespace"""
+    question = question.lower().replace("'", "")
+    question = re.sub(r"[^\w\s.<>=!-]", " ", question)
+    return " ".join(question.split()).strip(" .!")
+
+
+def schema_fingerprint(schema):
+    """Return a short, stable fingerprint of a schema description"""
+    return hashlib.sha256(schema.encode('utf-8')).hexdigest()[:16]
+
+
+class QueryCache:
+    """
+    Persistent question -> (question_type, query_code) cache
+
+    Entries are keyed on the normalized question plus a fingerprint of the
+    schema, so a changed dataset never serves code generated for an old one.
+    Eviction is LRU bounded by max_entries, and entries older than ttl
+    seconds are dropped on access.
+
+    When similarity_threshold is set, a miss on the exact key falls back to a
+    character n-gram index over the content words of cached questions, so
+    paraphrases such as "What is the revenue of Tesla?" and "Tesla revenue"
+    resolve to the same entry. A similarity hit also needs exactly the same
+    content words, so questions that differ by one meaningful word, such as
+    "ascending" and "descending", never share a plan; the n-gram score only
+    tolerates differences in word order, filler words and plurals.
+
+    Changes are written to the file by a background timer at most once every
+    save_interval seconds, so a query never waits on rewriting the whole
+    file; pending changes are also written when the process exits.
+    """
+
+    def __init__(self, path=None, max_entries=1000, ttl=86400,
+                 similarity_threshold=None, ngram_size=3, save_interval=5):
+        """
+        Args:
+            path (str): JSON file the cache is persisted to (None keeps it in memory)
+            max_entries (int): Maximum number of cached questions
+            ttl (int): Seconds an entry stays valid (0 or None disables expiry)
+            similarity_threshold (float): Minimum n-gram Jaccard similarity for
+                a paraphrase hit (None or 0 disables the similarity tier)
+            ngram_size (int): Character n-gram length used by the similarity index
+            save_interval (float): Seconds changes may wait before they are
+                written to path (0 writes on every change)
+        """
+        self.logger = setup_logging('ExcelQuerySystem')
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold or None
+        self.ngram_size = ngram_size
+        self.save_interval = save_interval
+
+        self._lock = threading.Lock()
+        # Serializes writers of the file; taken before _lock, never inside it
+        self._save_lock = threading.Lock()
+        self._save_timer = None
+        self._entries = OrderedDict()
+        # n-gram -> keys of the entries that contain it
+        self._ngram_index = {}
+        # Keys removed by this process, so saving doesn't merge them back in
+        self._dropped = set()
+
+        if self.path:
+            self._load()
+            atexit.register(self.flush)
+
+    def _key(self, fingerprint, normalized):
+        return f"{fingerprint}:{normalized}"
+
+    def _tokens(self, normalized):
+        """The words that carry meaning, with plural endings dropped"""
+        return {token.rstrip('s') if len(token) > 3 else token
+                for token in normalized.split() if token not in STOPWORDS}
+
+    def _content(self, normalized):
+        """Order-insensitive string of the words that carry meaning"""
+        return " ".join(sorted(self._tokens(normalized)))
+
+    def _ngrams(self, fingerprint, content):
+        padded = f" {content} "
+        size = self.ngram_size
+        return {f"{fingerprint}|{padded[i:i + size]}" for i in range(max(len(padded) - size + 1, 1))}
+
+    def _numbers(self, normalized):
+        return sorted(re.findall(r"\d+(?:\.\d+)?", normalized))
+
+    def _expired(self, entry, now):
+        return bool(self.ttl) and now - entry['created_at'] > self.ttl
+
+    def _index(self, key, entry):
+        for gram in self._ngrams(entry['fingerprint'], self._content(entry['normalized'])):
+            self._ngram_index.setdefault(gram, set()).add(key)
+
+    def _unindex(self, key, entry):
+        for gram in self._ngrams(entry['fingerprint'], self._content(entry['normalized'])):
+            keys = self._ngram_index.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._ngram_index[gram]
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._dropped.add(key)
+            if self.similarity_threshold:
+                self._unindex(key, entry)
+        return entry
+
+    def _insert(self, key, entry):
+        self._remove(key)
+        self._dropped.discard(key)
+        self._entries[key] = entry
+        if self.similarity_threshold:
+            self._index(key, entry)
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+
+    def _find_similar(self, fingerprint, normalized, now):
+        """Return the key of the most similar cached question, if any"""
+        tokens = self._tokens(normalized)
+        grams = self._ngrams(fingerprint, " ".join(sorted(tokens)))
+        overlaps = Counter()
+        for gram in grams:
+            overlaps.update(self._ngram_index.get(gram, ()))
+
+        numbers = self._numbers(normalized)
+        best_key, best_score = None, 0.0
+        for key, overlap in overlaps.items():
+            entry = self._entries[key]
+            if self._expired(entry, now) or self._numbers(entry['normalized']) != numbers:
+                continue
+            if self._tokens(entry['normalized']) != tokens:
+                continue
+            other = len(self._ngrams(fingerprint, self._content(entry['normalized'])))
+            score = overlap / (len(grams) + other - overlap)
+            if score > best_score:
+                best_key, best_score = key, score
+
+        if best_key is not None and best_score >= self.similarity_threshold:
+            self.logger.debug(f"Similarity cache match ({best_score:.2f}): {self._entries[best_key]['question']}")
+            return best_key
+        return None
+
+    def get(self, question, schema):
+        """
+        Look up a cached plan for the question
+
+        Returns:
+            tuple: (question_type, query_code) or None on a miss
+        """
+        fingerprint = schema_fingerprint(schema)
+        normalized = normalize_question(question)
+        key = self._key(fingerprint, normalized)
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry, now):
+                self._remove(key)
+                entry = None
+            if entry is None and self.similarity_threshold:
+                similar_key = self._find_similar(fingerprint, normalized, now)
+                if similar_key is not None:
+                    key, entry = similar_key, self._entries[similar_key]
+            if entry is None:
+                self.logger.debug(f"Query cache miss: {question}")
+                return None
+
+            entry['last_used'] = now
+            self._entries.move_to_end(key)
+            self.logger.info(f"Query cache hit: {question}")
+            return entry['question_type'], entry['query_code']
+
+    def put(self, question, schema, question_type, query_code=None):
+        """Store the plan generated for a question"""
+        fingerprint = schema_fingerprint(schema)
+        normalized = normalize_question(question)
+        now = time.time()
+        entry = {
+            'fingerprint': fingerprint,
+            'normalized': normalized,
+            'question': question,
+            'question_type': question_type,
+            'query_code': query_code,
+            'created_at': now,
+            'last_used': now,
+        }
+        with self._lock:
+            self._insert(self._key(fingerprint, normalized), entry)
+        self._changed()
+
+    def invalidate(self, question, schema):
+        """Drop the cached plan for a question, e.g. after its code failed"""
+        fingerprint = schema_fingerprint(schema)
+        normalized = normalize_question(question)
+        key = self._key(fingerprint, normalized)
+        with self._lock:
+            if key not in self._entries and self.similarity_threshold:
+                key = self._find_similar(fingerprint, normalized, time.time()) or key
+            removed = self._remove(key) is not None
+        if removed:
+            self.logger.info(f"Invalidated query cache entry: {question}")
+            self._changed()
+
+    def discard_schema(self, schema):
+        """Drop every plan generated for a schema, e.g. after the dataset was reloaded"""
+        fingerprint = schema_fingerprint(schema)
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if entry['fingerprint'] == fingerprint]
+            for key in stale:
+                self._remove(key)
+        if stale:
+            self.logger.info(f"Discarded {len(stale)} query cache entries for the previous schema")
+            self._changed()
+
+    def query_codes(self):
+        """Generated code of every unexpired plan, e.g. to learn which columns queries filter on"""
+        now = time.time()
+        with self._lock:
+            return [entry['query_code'] for entry in self._entries.values()
+                    if entry.get('query_code') and not self._expired(entry, now)]
+
+    def clear(self):
+        """Remove every cached entry"""
+        with self._lock:
+            self._dropped.update(self._entries)
+            self._entries.clear()
+            self._ngram_index.clear()
+        self._changed()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _read_file(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f).get('entries', [])
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Ignoring unreadable query cache {self.path}: {str(e)}")
+            return []
+
+    def _load(self):
+        now = time.time()
+        entries = sorted(self._read_file(), key=lambda entry: entry['last_used'])
+        for entry in entries:
+            if not self._expired(entry, now):
+                self._insert(self._key(entry['fingerprint'], entry['normalized']), entry)
+        self.logger.info(f"Loaded {len(self._entries)} query cache entries from {self.path}")
+
+    def _changed(self):
+        """Write the cache now, or schedule a write if none is pending"""
+        if not self.path:
+            return
+        if not self.save_interval:
+            self.flush()
+            return
+        with self._lock:
+            if self._save_timer is not None:
+                return
+            self._save_timer = threading.Timer(self.save_interval, self.flush)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def flush(self):
+        """Write pending changes to the file, merged with entries other processes wrote"""
+        if not self.path:
+            return
+        with self._save_lock:
+            with self._lock:
+                if self._save_timer is not None:
+                    self._save_timer.cancel()
+                    self._save_timer = None
+            # Read outside the lock so lookups don't wait on the disk
+            on_disk = self._read_file()
+            with self._lock:
+                self._merge(on_disk)
+                entries = list(self._entries.values())
+            self._write(entries)
+
+    def _merge(self, on_disk):
+        """Pick up entries written by other worker processes"""
+        now = time.time()
+        for entry in on_disk:
+            key = self._key(entry['fingerprint'], entry['normalized'])
+            if key not in self._entries and key not in self._dropped and not self._expired(entry, now):
+                self._entries[key] = entry
+                if self.similarity_threshold:
+                    self._index(key, entry)
+        ordered = sorted(self._entries.items(), key=lambda item: item[1]['last_used'])
+        self._entries = OrderedDict(ordered)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def _write(self, entries):
+        """Write entries to the file atomically"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': 1, 'entries': entries}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            self.logger.warning(f"Could not persist query cache to {self.path}: {str(e)}")
@@ -0,0 +1,584 @@
+import ast
+import copy
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import pandas as pd
+from pandas.core.groupby import DataFrameGroupBy, SeriesGroupBy
+
+from .logger_config import setup_logging
+
+# AST node types generated pandas code may contain
+ALLOWED_NODES = (
+    ast.Module, ast.Expr, ast.Assign, ast.Name, ast.Load, ast.Store,
+    ast.Attribute, ast.Subscript, ast.Slice, ast.Call, ast.keyword,
+    ast.Constant, ast.List, ast.Tuple, ast.Dict,
+    ast.Compare, ast.BoolOp, ast.BinOp, ast.UnaryOp,
+    ast.And, ast.Or, ast.Not, ast.Invert, ast.USub, ast.UAdd,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow,
+    ast.BitAnd, ast.BitOr,
+    ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+    ast.In, ast.NotIn, ast.Is, ast.IsNot,
+)
+
+# DataFrame, Series, GroupBy, .str and .dt members generated code may use
+ALLOWED_ATTRIBUTES = {
+    # Selection
+    'loc', 'iloc', 'at', 'iat', 'head', 'tail', 'columns', 'index', 'values',
+    'shape', 'empty', 'size', 'T', 'get', 'filter', 'where', 'mask', 'nth',
+    'first', 'last', 'name', 'dtype', 'dtypes',
+    # Filtering and comparison
+    'isin', 'between', 'isna', 'isnull', 'notna', 'notnull', 'duplicated',
+    'eq', 'ne', 'lt', 'le', 'gt', 'ge', 'any', 'all',
+    # Grouping and aggregation
+    'groupby', 'agg', 'aggregate', 'count', 'sum', 'mean', 'median', 'min', 'max',
+    'std', 'var', 'prod', 'nunique', 'unique', 'value_counts', 'describe',
+    'quantile', 'mode', 'idxmax', 'idxmin', 'cumsum', 'cumcount', 'ngroups',
+    'corr', 'pct_change', 'diff', 'rank', 'pivot_table', 'pivot', 'melt',
+    'stack', 'unstack', 'explode',
+    # Sorting and reshaping
+    'sort_values', 'sort_index', 'nlargest', 'nsmallest', 'reset_index',
+    'set_index', 'rename', 'drop', 'drop_duplicates', 'dropna', 'fillna',
+    'astype', 'round', 'abs', 'clip', 'to_frame', 'transpose', 'copy',
+    'tolist', 'to_list', 'item',
+    # Arithmetic
+    'add', 'sub', 'mul', 'div',
+    # String and datetime accessors
+    'str', 'contains', 'startswith', 'endswith', 'lower', 'upper', 'strip',
+    'len', 'replace', 'split', 'dt', 'year', 'month', 'day', 'quarter', 'date',
+}
+
+# Top-level pandas functions generated code may call through `pd`
+ALLOWED_PANDAS_FUNCTIONS = {
+    'to_datetime', 'to_numeric', 'Timestamp', 'Timedelta', 'isna', 'notna',
+    'concat', 'DataFrame', 'Series', 'NA', 'NaT', 'Grouper',
+}
+
+# Names every query can read; assignments add their targets for later statements
+BASE_NAMES = {'df', 'pd'}
+
+# Names bound to a DataFrame when a query starts, the only objects whose
+# unknown attributes are read as columns
+FRAME_NAMES = {'df', 'prev'}
+
+# str.format and format_map read attributes of their arguments, e.g. '{0.__class__}'.format(df)
+FORBIDDEN_ATTRIBUTES = {'format', 'format_map'}
+
+# String literals that reach dunder members or walk attributes in a format template
+UNSAFE_STRING = re.compile(r"__|\{\w*[.\[]")
+
+# Methods that look functions up by name, e.g. df.agg('sum'); any method of the
+# object could be named, including ones that write files such as to_csv
+FUNCTION_NAME_METHODS = {'agg', 'aggregate', 'transform', 'apply'}
+
+# Function names those methods, and pivot_table's aggfunc, may be given
+ALLOWED_FUNCTION_NAMES = {
+    'sum', 'mean', 'min', 'max', 'count', 'median', 'std', 'var', 'nunique',
+    'first', 'last', 'size',
+}
+
+# Methods returning a boolean mask, so df[mask] is rows of df and still a DataFrame
+MASK_METHODS = {
+    'isin', 'between', 'isna', 'isnull', 'notna', 'notnull', 'duplicated',
+    'eq', 'ne', 'lt', 'le', 'gt', 'ge', 'contains', 'startswith', 'endswith',
+}
+
+RESULT_NAME = '__result__'
+
+# Function the indexed form of a query calls to take the rows matching a filter
+SELECT_NAME = '__select__'
+
+# Comparisons a filter index can answer, keyed by the operator with the column on the left
+INDEXED_COMPARISONS = {ast.Eq: '==', ast.Lt: '<', ast.LtE: '<=', ast.Gt: '>', ast.GtE: '>='}
+SWAPPED_COMPARISONS = {'==': '==', '<': '>', '<=': '>=', '>': '<', '>=': '<='}
+REGEX_SPECIAL = re.compile(r"[.^$*+?{}\[\]\\|()]")
+
+CODE_FENCE = re.compile(r"^\s*```(?:python|py)?\s*\n?(.*?)\n?\s*```\s*$", re.DOTALL)
+
+
+@lru_cache(maxsize=1024)
+def is_column_attribute(name):
+    """
+    Whether `obj.name` can only mean column access, as in df.Revenue
+
+    Pandas resolves methods before columns, so a name is only safe to allow
+    when no pandas object the query can reach has a member called that.
+    """
+    if name.startswith('_'):
+        return False
+    return not any(hasattr(cls, name) for cls in (pd.DataFrame, pd.Series, DataFrameGroupBy, SeriesGroupBy))
+
+
+class QueryValidationError(ValueError):
+    """Raised when generated code uses syntax or operations outside the whitelist"""
+
+
+class QueryTimeoutError(ValueError):
+    """Raised when a query runs longer than the executor's time limit"""
+
+
+class QueryCancelledError(ValueError):
+    """Raised when a query is cancelled before it finishes"""
+
+
+class QueryMemoryError(ValueError):
+    """Raised when a query needs more memory than its worker may use"""
+
+
+class CompiledQuery:
+    """Validated, compiled form of a generated pandas query"""
+
+    def __init__(self, code, source, result_name, indexed_code=None, filters=()):
+        self.code = code
+        # Canonical source; formatting differences in the generated code don't change it
+        self.source = source
+        self.result_name = result_name
+        # Same query with its row filters replaced by __select__(df, i) calls,
+        # where filters[i] is the plan of the filter that was replaced
+        self.indexed_code = indexed_code
+        self.filters = filters
+
+
+def _row_selection(node, frames):
+    """Whether node is df[mask] or df.loc[mask] on a DataFrame, which is a DataFrame again"""
+    if not isinstance(node, ast.Subscript):
+        return False
+    target = node.value
+    if isinstance(target, ast.Attribute) and target.attr == 'loc':
+        target = target.value
+    # Indexing a groupby selects columns, not rows
+    if isinstance(target, ast.Call) or not _is_frame(target, frames):
+        return False
+    mask = node.slice
+    if isinstance(mask, ast.Compare):
+        return True
+    if isinstance(mask, ast.BinOp):
+        return isinstance(mask.op, (ast.BitAnd, ast.BitOr))
+    if isinstance(mask, ast.UnaryOp):
+        return isinstance(mask.op, ast.Invert)
+    return isinstance(mask, ast.Call) and isinstance(mask.func, ast.Attribute) and mask.func.attr in MASK_METHODS
+
+
+def _is_function_names(node):
+    """Whether node is an allowed function name, or a list, tuple or dict of them"""
+    if isinstance(node, ast.Constant):
+        return isinstance(node.value, str) and node.value in ALLOWED_FUNCTION_NAMES
+    if isinstance(node, (ast.List, ast.Tuple)):
+        return bool(node.elts) and all(_is_function_names(element) for element in node.elts)
+    if isinstance(node, ast.Dict):
+        # {'Revenue': 'sum', 'Units': ['min', 'max']}
+        return None not in node.keys and all(_is_function_names(value) for value in node.values)
+    return False
+
+
+def _function_arguments(call):
+    """The arguments of a method call that name functions for it to look up"""
+    method = call.func.attr
+    if method == 'pivot_table':
+        # pivot_table(values, index, columns, aggfunc, ...)
+        return call.args[3:4] + [keyword.value for keyword in call.keywords if keyword.arg == 'aggfunc']
+    specs = call.args[:1] + [keyword.value for keyword in call.keywords if keyword.arg == 'func']
+    if specs:
+        return specs
+    # Named aggregation: agg(total=('Revenue', 'sum'))
+    for keyword in call.keywords:
+        value = keyword.value
+        if not isinstance(value, ast.Tuple) or len(value.elts) != 2:
+            raise QueryValidationError(f"Unsupported argument to '.{method}': '{keyword.arg}'")
+        specs.append(value.elts[1])
+    return specs
+
+
+def _is_frame(node, frames):
+    """Whether node can only be a DataFrame or its groupby, whose unknown attributes are columns"""
+    if isinstance(node, ast.Name):
+        return node.id in frames
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == 'groupby':
+        return _is_frame(node.func.value, frames)
+    return _row_selection(node, frames)
+
+
+def strip_code_fences(query_code):
+    """Remove the markdown code fence LLMs sometimes wrap code in"""
+    match = CODE_FENCE.match(query_code)
+    return match.group(1).strip() if match else query_code.strip()
+
+
+def to_dataframe(result):
+    """Convert whatever a query evaluated to into a DataFrame"""
+    if isinstance(result, pd.DataFrame):
+        frame = result
+    elif isinstance(result, pd.Series):
+        frame = result.to_frame(name=result.name if result.name is not None else 'value')
+    elif isinstance(result, (pd.Index, list, tuple)) or hasattr(result, 'ndim'):
+        frame = pd.DataFrame({'value': list(result) if getattr(result, 'ndim', 1) else [result]})
+    else:
+        frame = pd.DataFrame({'value': [result]})
+
+    # Keep group keys and other named index levels as visible columns
+    if any(name is not None for name in frame.index.names):
+        frame = frame.reset_index()
+    return frame
+
+
+def _constant(node):
+    """Value of a number or string literal, or None"""
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        value = _constant(node.operand)
+        return -value if isinstance(value, (int, float)) else None
+    if isinstance(node, ast.Constant) and isinstance(node.value, (str, int, float)) \
+            and not isinstance(node.value, bool):
+        return node.value
+    return None
+
+
+def _column(node):
+    """Name of the column in df['name'] or df.name, or None"""
+    if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == 'df' \
+            and isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str):
+        return node.slice.value
+    if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == 'df' \
+            and node.attr not in ALLOWED_ATTRIBUTES and is_column_attribute(node.attr):
+        return node.attr
+    return None
+
+
+def _method(node, name):
+    """Column a call of Series.name is made on, as in df['Company'].isin(...), or None"""
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == name:
+        return _column(node.func.value)
+    return None
+
+
+def filter_plan(node):
+    """
+    Plan of a row filter a FilterIndex can answer, or None
+
+    Recognises comparisons of a column with a literal, isin with a list of
+    literals, between with literal bounds, literal str.contains, and those
+    combined with & and |.
+    """
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr)):
+        left, right = filter_plan(node.left), filter_plan(node.right)
+        if left is None or right is None:
+            return None
+        return ('and' if isinstance(node.op, ast.BitAnd) else 'or', left, right)
+
+    if isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in INDEXED_COMPARISONS:
+        op = INDEXED_COMPARISONS[type(node.ops[0])]
+        left, right = node.left, node.comparators[0]
+        column, value = _column(left), _constant(right)
+        if column is None:
+            column, value = _column(right), _constant(left)
+            op = SWAPPED_COMPARISONS[op]
+        if column is None or value is None:
+            return None
+        return ('cmp', column, op, value)
+
+    column = _method(node, 'isin')
+    if column is not None:
+        if len(node.args) != 1 or node.keywords or not isinstance(node.args[0], (ast.List, ast.Tuple)):
+            return None
+        values = tuple(_constant(element) for element in node.args[0].elts)
+        if any(value is None for value in values):
+            return None
+        return ('isin', column, values)
+
+    column = _method(node, 'between')
+    if column is not None:
+        if len(node.args) != 2 or any(keyword.arg != 'inclusive' for keyword in node.keywords):
+            return None
+        if any(_constant(keyword.value) != 'both' for keyword in node.keywords):
+            return None
+        low, high = _constant(node.args[0]), _constant(node.args[1])
+        if low is None or high is None:
+            return None
+        return ('between', column, low, high)
+
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == 'contains' \
+            and isinstance(node.func.value, ast.Attribute) and node.func.value.attr == 'str':
+        column = _column(node.func.value.value)
+        if column is None or len(node.args) != 1 or not isinstance(_constant(node.args[0]), str):
+            return None
+        options = {'case': True, 'regex': True, 'na': None}
+        for keyword in node.keywords:
+            if keyword.arg not in options or not isinstance(keyword.value, ast.Constant) \
+                    or not isinstance(keyword.value.value, bool):
+                return None
+            options[keyword.arg] = keyword.value.value
+        pattern = node.args[0].value
+        if options['regex'] and REGEX_SPECIAL.search(pattern):
+            return None
+        # A pattern without special characters matches the same as a regex or literally
+        return ('contains', column, pattern, options['case'], False, options['na'])
+    return None
+
+
+class _FilterRewriter(ast.NodeTransformer):
+    """Replace df[FILTER], df.loc[FILTER] and df.loc[FILTER, columns] with __select__(df, i)"""
+
+    def __init__(self):
+        self.filters = []
+
+    def _select(self, plan):
+        self.filters.append(plan)
+        return ast.Call(
+            func=ast.Name(id=SELECT_NAME, ctx=ast.Load()),
+            args=[ast.Name(id='df', ctx=ast.Load()), ast.Constant(len(self.filters) - 1)],
+            keywords=[]
+        )
+
+    def visit_Subscript(self, node):
+        target = node.value
+        is_df = isinstance(target, ast.Name) and target.id == 'df'
+        is_loc = isinstance(target, ast.Attribute) and target.attr == 'loc' \
+            and isinstance(target.value, ast.Name) and target.value.id == 'df'
+        if is_df or is_loc:
+            plan = filter_plan(node.slice)
+            if plan is not None:
+                return ast.copy_location(self._select(plan), node)
+            if is_loc and isinstance(node.slice, ast.Tuple) and len(node.slice.elts) == 2:
+                plan = filter_plan(node.slice.elts[0])
+                if plan is not None:
+                    columns = self.visit(node.slice.elts[1])
+                    rows = ast.Attribute(value=self._select(plan), attr='loc', ctx=ast.Load())
+                    return ast.copy_location(ast.Subscript(
+                        value=rows,
+                        slice=ast.Tuple(elts=[ast.Slice(), columns], ctx=ast.Load()),
+                        ctx=node.ctx
+                    ), node)
+        return self.generic_visit(node)
+
+
+def rewrite_filters(tree):
+    """
+    Copy of a validated query with its indexable row filters replaced by __select__ calls
+
+    Only statements that still see the original df are rewritten: once the
+    query assigns to df, later filters run on the new value as written.
+
+    Returns:
+        tuple: (rewritten tree or None when nothing was replaced, filter plans)
+    """
+    tree = copy.deepcopy(tree)
+    rewriter = _FilterRewriter()
+    for statement in tree.body:
+        statement.value = rewriter.visit(statement.value)
+        if isinstance(statement, ast.Assign) and statement.targets[0].id == 'df':
+            break
+    if not rewriter.filters:
+        return None, ()
+    return tree, tuple(rewriter.filters)
+
+
+class QueryExecutor:
+    """
+    Validates, compiles and runs LLM-generated pandas code
+
+    Generated code is parsed into an AST and checked against a whitelist of
+    node types, names, pandas methods and pandas functions before it is ever
+    executed. Compiled code objects are cached by a hash of the source, so a
+    repeated query skips parsing and validation entirely. Code may be a single
+    expression or a few assignments followed by an expression, e.g.
+    `df = df[df['Company'] == 'Tesla']`.
+
+    Row filters on df that a FilterIndex can answer are also compiled into an
+    indexed form; execute() runs that form when given an index covering them.
+    """
+
+    def __init__(self, max_rows=None, timeout=None, cache_size=512):
+        """
+        Args:
+            max_rows (int): Results longer than this are truncated (None for no limit)
+            timeout (float): Seconds a query may run before it is abandoned (None for no limit)
+            cache_size (int): Number of compiled queries to keep
+        """
+        self.logger = setup_logging('ExcelQuerySystem')
+        self.max_rows = max_rows
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _validate(self, tree, names=()):
+        """Reject any node, name or attribute outside the whitelist"""
+        if not tree.body:
+            raise QueryValidationError("Query is empty")
+
+        names = set(BASE_NAMES) | set(names)
+        # Names known to hold a DataFrame; anything else may be a NumPy array,
+        # scalar or string whose members aren't covered by the whitelist
+        frames = FRAME_NAMES & names
+        for index, statement in enumerate(tree.body):
+            if isinstance(statement, ast.Assign):
+                if len(statement.targets) != 1 or not isinstance(statement.targets[0], ast.Name):
+                    raise QueryValidationError("Only simple assignments like 'df = ...' are allowed")
+                self._validate_expression(statement.value, names, frames)
+                target = statement.targets[0].id
+                if target.startswith('_') or target == 'pd':
+                    raise QueryValidationError(f"Cannot assign to '{target}'")
+                names.add(target)
+                if _row_selection(statement.value, frames):
+                    frames.add(target)
+                else:
+                    frames.discard(target)
+            elif isinstance(statement, ast.Expr):
+                if index != len(tree.body) - 1:
+                    raise QueryValidationError("Only the last statement may be a bare expression")
+                self._validate_expression(statement.value, names, frames)
+            else:
+                raise QueryValidationError(f"Unsupported statement: {type(statement).__name__}")
+
+    def _validate_expression(self, expression, names, frames):
+        for node in ast.walk(expression):
+            if not isinstance(node, ALLOWED_NODES):
+                raise QueryValidationError(f"Unsupported syntax: {type(node).__name__}")
+            if isinstance(node, ast.Name) and node.id not in names:
+                raise QueryValidationError(f"Unknown name: '{node.id}'")
+            if isinstance(node, ast.Constant) and isinstance(node.value, str) and UNSAFE_STRING.search(node.value):
+                raise QueryValidationError(f"Unsupported string literal: {node.value!r}")
+            if isinstance(node, ast.Attribute):
+                on_frame = _is_frame(node.value, frames)
+                if node.attr in FORBIDDEN_ATTRIBUTES:
+                    raise QueryValidationError(f"Unauthorized operation: '.{node.attr}'")
+                if isinstance(node.value, ast.Name) and node.value.id == 'pd':
+                    if node.attr not in ALLOWED_PANDAS_FUNCTIONS:
+                        raise QueryValidationError(f"Unauthorized pandas function: 'pd.{node.attr}'")
+                elif node.attr not in ALLOWED_ATTRIBUTES and not (on_frame and is_column_attribute(node.attr)):
+                    # df.Revenue is a column; on any other object an unknown
+                    # attribute could be a method outside the whitelist
+                    raise QueryValidationError(f"Unauthorized operation: '.{node.attr}'")
+            if isinstance(node, ast.Call):
+                # Only methods and pandas functions may be called, never bare names
+                if not isinstance(node.func, ast.Attribute):
+                    raise QueryValidationError("Only pandas methods and functions may be called")
+                if any(keyword.arg is None for keyword in node.keywords):
+                    raise QueryValidationError("Keyword argument unpacking is not allowed")
+                if node.func.attr in FUNCTION_NAME_METHODS or node.func.attr == 'pivot_table':
+                    # Only literal reduction names; a computed one could be any method
+                    if not all(_is_function_names(spec) for spec in _function_arguments(node)):
+                        raise QueryValidationError(
+                            f"'.{node.func.attr}' may only be given the functions "
+                            f"{', '.join(sorted(ALLOWED_FUNCTION_NAMES))}"
+                        )
+
+    def compile(self, query_code, names=()):
+        """
+        Validate and compile generated code, reusing the cached result when possible
+
+        Args:
+            query_code (str): Generated pandas code
+            names (tuple): Variables the code may read besides df and pd, e.g. ('prev',)
+
+        Returns:
+            CompiledQuery
+        """
+        names = tuple(sorted(names))
+        key = hashlib.sha256('\0'.join((query_code,) + names).encode('utf-8')).hexdigest()
+        with self._lock:
+            compiled = self._cache.get(key)
+            if compiled is not None:
+                self._cache.move_to_end(key)
+                return compiled
+
+        source = strip_code_fences(query_code)
+        try:
+            tree = ast.parse(source, mode='exec')
+        except SyntaxError as e:
+            raise QueryValidationError(f"Invalid Python syntax: {e.msg}")
+        self._validate(tree, names)
+
+        canonical = ast.unparse(tree)
+        last = tree.body[-1]
+        if isinstance(last, ast.Expr):
+            # Capture the final expression's value
+            tree.body[-1] = ast.copy_location(
+                ast.Assign(targets=[ast.Name(id=RESULT_NAME, ctx=ast.Store())], value=last.value),
+                last
+            )
+            result_name = RESULT_NAME
+        else:
+            result_name = last.targets[0].id
+        ast.fix_missing_locations(tree)
+        indexed_tree, filters = rewrite_filters(tree)
+        indexed_code = None
+        if indexed_tree is not None:
+            indexed_code = compile(ast.fix_missing_locations(indexed_tree), '<generated query>', 'exec')
+        compiled = CompiledQuery(
+            compile(tree, '<generated query>', 'exec'), canonical, result_name, indexed_code, filters
+        )
+
+        with self._lock:
+            self._cache[key] = compiled
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return compiled
+
+    def _run(self, compiled, df, index=None, variables=None):
+        namespace = {'__builtins__': {}, **(variables or {}), 'df': df, 'pd': pd}
+        code = compiled.code
+        if index is not None:
+            filters = compiled.filters
+            namespace[SELECT_NAME] = lambda frame, i: index.select(frame, filters[i])
+            code = compiled.indexed_code
+        exec(code, namespace)
+        return namespace[compiled.result_name]
+
+    def _run_with_timeout(self, compiled, df, index=None, variables=None):
+        """Run the query in a helper thread so the caller stops waiting after the timeout"""
+        outcome = {}
+
+        def target():
+            try:
+                outcome['result'] = self._run(compiled, df, index, variables)
+            except BaseException as e:
+                outcome['error'] = e
+
+        worker = threading.Thread(target=target, name='QueryExecutor', daemon=True)
+        worker.start()
+        worker.join(self.timeout)
+        if worker.is_alive():
+            # Threads can't be killed; the computation finishes in the background
+            raise QueryTimeoutError(f"Query exceeded the {self.timeout}s time limit")
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome['result']
+
+    def execute(self, query_code, df, index=None, variables=None, cancel=None):
+        """
+        Run generated code against df
+
+        cancel is accepted for symmetry with PooledQueryExecutor; a query
+        running in this process can't be stopped.
+
+        Args:
+            query_code (str): Generated pandas code
+            df (DataFrame): Data the code runs against
+            index (FilterIndex): Filter indexes over df; filters it covers are
+                answered from it instead of scanning their columns
+            variables (dict): Further DataFrames the code may read by name, e.g.
+                {'prev': previous_result} for a follow-up question
+
+        Returns:
+            DataFrame: The query result, truncated to max_rows
+        """
+        compiled = self.compile(query_code, tuple(variables or ()))
+        if index is not None and compiled.filters:
+            index.observe(compiled.filters)
+            if index.frame is not df or not all(index.covers(plan) for plan in compiled.filters):
+                index = None
+        else:
+            index = None
+        if self.timeout:
+            result = self._run_with_timeout(compiled, df, index, variables)
+        else:
+            result = self._run(compiled, df, index, variables)
+
+        result = to_dataframe(result)
+        if self.max_rows is not None and len(result) > self.max_rows:
+            self.logger.warning(f"Truncating query result from {len(result)} to {self.max_rows} rows")
+            result = result.head(self.max_rows)
+        return result
@@ -0,0 +1,326 @@
+import atexit
+import json
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing.connection import Connection
+
+from .dataset_store import read_cache
+from .filter_index import FilterIndex, FilterStats, plan_columns
+from .logger_config import configure_logging, logging_settings, setup_logging
+from .query_executor import QueryCancelledError, QueryExecutor, QueryMemoryError, QueryTimeoutError
+
+try:
+    import resource
+except ImportError:  # pragma: no cover - not available on Windows
+    resource = None
+
+# Datasets each worker keeps memory-mapped, most recently used first
+WORKER_MAX_DATASETS = 4
+
+# Seconds between checks for cancellation while waiting on a worker
+POLL_INTERVAL = 0.1
+
+
+class QueryWorker:
+    """One worker process and the pipes queries and results travel over"""
+
+    def __init__(self, memory_limit=None):
+        task_read, task_write = os.pipe()
+        result_read, result_write = os.pipe()
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')]))}
+        settings = {'memory_limit': memory_limit, 'logging': logging_settings()}
+        try:
+            # A fresh interpreter rather than a fork: the web process has threads
+            # and locks a forked child would inherit mid-use
+            self.process = subprocess.Popen(
+                [sys.executable, '-m', __name__, str(task_read), str(result_write), json.dumps(settings)],
+                pass_fds=(task_read, result_write), env=env, stdin=subprocess.DEVNULL
+            )
+        finally:
+            os.close(task_read)
+            os.close(result_write)
+        self.tasks = Connection(task_write, readable=False)
+        self.results = Connection(result_read, writable=False)
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def kill(self):
+        """Stop the process, whatever it's doing"""
+        self.process.kill()
+        self.process.wait()
+        self.tasks.close()
+        self.results.close()
+
+
+class QueryPool:
+    """
+    Worker processes that run generated pandas code outside the web process
+
+    Each worker memory-maps the columnar cache file of the datasets it is
+    asked about, so numeric columns are shared through the operating system's
+    page cache instead of being copied into every process. A query that runs
+    past its time limit or is cancelled has its worker killed and replaced,
+    which stops it for good; the web process never waits on it again. With a
+    memory_limit each worker's heap is capped, so a query that would exhaust
+    the machine fails with a memory error instead.
+
+    Workers are started as queries need them, up to one per core, and shared
+    by every dataset. Only available on POSIX systems.
+    """
+
+    def __init__(self, workers=None, memory_limit=None):
+        """
+        Args:
+            workers (int): Most worker processes (None for one per core)
+            memory_limit (int): Bytes of heap each worker may allocate, not
+                counting the memory-mapped dataset (None for no limit)
+        """
+        self.logger = setup_logging('ExcelQuerySystem')
+        self.size = workers or os.cpu_count() or 1
+        self.memory_limit = memory_limit
+        # LIFO, so recently used workers with the dataset already mapped stay busy
+        self._idle = queue.LifoQueue()
+        self._workers = set()
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _spawn(self):
+        worker = QueryWorker(self.memory_limit)
+        self.logger.info(f"Started query worker {worker.pid}")
+        return worker
+
+    def _checkout(self, cancel=None):
+        """Take an idle worker, starting one if the pool isn't full yet"""
+        while True:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            with self._lock:
+                if len(self._workers) < self.size:
+                    worker = self._spawn()
+                    self._workers.add(worker)
+                    return worker
+            try:
+                return self._idle.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if cancel is not None and cancel.is_set():
+                    raise QueryCancelledError("Query was cancelled")
+
+    def _replace(self, worker):
+        """Kill a worker and start another in its place"""
+        worker.kill()
+        replacement = self._spawn()
+        with self._lock:
+            self._workers.discard(worker)
+            self._workers.add(replacement)
+        return replacement
+
+    def run(self, task, timeout=None, cancel=None):
+        """
+        Run a query in a worker process and return its result
+
+        Args:
+            task (dict): Query for the worker, built by PooledQueryExecutor
+            timeout (float): Seconds the query may run before its worker is killed
+            cancel (threading.Event): Set to stop the query early
+
+        Raises:
+            QueryTimeoutError: The query ran past the timeout
+            QueryCancelledError: cancel was set before the query finished
+            QueryMemoryError: The query ran out of worker memory
+        """
+        worker = self._checkout(cancel)
+        try:
+            try:
+                worker.tasks.send(task)
+            except OSError:
+                # The idle worker died, e.g. killed by the OOM killer
+                worker = self._replace(worker)
+                worker.tasks.send(task)
+
+            deadline = time.monotonic() + timeout if timeout else None
+            while True:
+                wait = POLL_INTERVAL if deadline is None else min(POLL_INTERVAL, deadline - time.monotonic())
+                if worker.results.poll(max(wait, 0)):
+                    break
+                if cancel is not None and cancel.is_set():
+                    self.logger.warning(f"Killing query worker {worker.pid}: query cancelled")
+                    worker = self._replace(worker)
+                    raise QueryCancelledError("Query was cancelled")
+                if deadline is not None and time.monotonic() >= deadline:
+                    self.logger.warning(f"Killing query worker {worker.pid}: query exceeded {timeout}s")
+                    worker = self._replace(worker)
+                    raise QueryTimeoutError(f"Query exceeded the {timeout}s time limit")
+
+            try:
+                status, value = worker.results.recv()
+            except (EOFError, OSError):
+                code = worker.process.wait()
+                worker = self._replace(worker)
+                if code == -signal.SIGKILL:
+                    raise QueryMemoryError("Query worker was killed, most likely out of memory")
+                raise ValueError(f"Query worker exited with code {code}")
+        finally:
+            self._idle.put(worker)
+
+        if status == 'error':
+            raise value
+        return value
+
+    def close(self):
+        """Stop every worker"""
+        with self._lock:
+            workers, self._workers = self._workers, set()
+        for worker in workers:
+            worker.kill()
+
+
+class PooledQueryExecutor(QueryExecutor):
+    """
+    QueryExecutor that runs queries in a QueryPool's worker processes
+
+    Generated code is still validated here, so rejected code never reaches a
+    worker. Queries against the attached DataFrame are sent to the pool along
+    with the path of the columnar cache file it was read from; queries on any
+    other DataFrame, e.g. a snapshot replaced while the query was planned, or
+    when the dataset has no columnar cache, run in this process as usual.
+
+    Filter indexes are kept by each worker over its own mapping of the
+    dataset, seeded with the filter counts collected here.
+    """
+
+    def __init__(self, pool, max_rows=None, timeout=None, filter_stats=None, filter_index_settings=None):
+        """
+        Args:
+            pool (QueryPool): Worker processes shared with other datasets
+            max_rows (int): Results longer than this are truncated (None for no limit)
+            timeout (float): Seconds a query may run before its worker is killed (None for no limit)
+            filter_stats (FilterStats): Filter counts new worker indexes start from
+            filter_index_settings (dict): FilterIndex arguments (min_filters,
+                max_columns, min_rows) for the workers; None disables their indexes
+        """
+        super().__init__(max_rows=max_rows, timeout=timeout)
+        self.pool = pool
+        self.filter_stats = filter_stats
+        self.filter_index_settings = filter_index_settings
+        self.frame = None
+        self.path = None
+
+    def attach(self, df, path):
+        """
+        Send later queries on df to the workers, which read it from path
+
+        Args:
+            df (DataFrame): The dataset queries will be asked about
+            path (str): Columnar cache file df was read from (None runs queries in this process)
+        """
+        if path is None:
+            self.logger.warning("Dataset has no columnar cache; queries run in the web process")
+        self.frame = df
+        self.path = path
+
+    def execute(self, query_code, df, index=None, variables=None, cancel=None):
+        """
+        Run generated code against df, in a worker process when df is the attached dataset
+
+        Args:
+            cancel (threading.Event): Set to kill the worker and stop the query
+
+        Returns:
+            DataFrame: The query result, truncated to max_rows
+        """
+        if self.path is None or df is not self.frame:
+            return super().execute(query_code, df, index=index, variables=variables)
+
+        # Reject invalid code before it reaches a worker
+        compiled = self.compile(query_code, tuple(variables or ()))
+        if self.filter_stats is not None:
+            self.filter_stats.record(column for plan in compiled.filters for column in plan_columns(plan))
+        task = {
+            'path': self.path,
+            'query_code': query_code,
+            'variables': variables,
+            'max_rows': self.max_rows,
+            'filter_index': self.filter_index_settings,
+            'filter_counts': self.filter_stats.counts() if self.filter_stats is not None else None,
+        }
+        return self.pool.run(task, timeout=self.timeout, cancel=cancel)
+
+
+def _limit_memory(limit):
+    if not limit or resource is None:
+        return
+    # RLIMIT_DATA counts the heap and anonymous mappings but not the read-only
+    # mapping of the dataset file, which RLIMIT_AS would
+    kind = getattr(resource, 'RLIMIT_DATA', resource.RLIMIT_AS)
+    resource.setrlimit(kind, (limit, limit))
+
+
+def _dataset(datasets, task):
+    """Return the mapped DataFrame and filter index for a task's dataset"""
+    path = task['path']
+    entry = datasets.get(path)
+    if entry is None:
+        df = read_cache(path)
+        index = None
+        if task['filter_index'] is not None:
+            stats = FilterStats()
+            stats.record(task['filter_counts'] or {})
+            index = FilterIndex(df, stats, **task['filter_index'])
+        entry = datasets[path] = (df, index)
+        while len(datasets) > WORKER_MAX_DATASETS:
+            datasets.popitem(last=False)
+    datasets.move_to_end(path)
+    return entry
+
+
+def _serve(tasks, results, memory_limit):
+    """Worker process loop: run each query received and send back its result"""
+    # The web process handles interrupts and stops workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _limit_memory(memory_limit)
+    # No timeout: a query that runs too long is stopped by killing this process
+    executor = QueryExecutor()
+    datasets = OrderedDict()
+    while True:
+        try:
+            task = tasks.recv()
+        except EOFError:
+            # The web process exited
+            return
+        try:
+            df, index = _dataset(datasets, task)
+            executor.max_rows = task['max_rows']
+            reply = ('result', executor.execute(task['query_code'], df, index=index, variables=task['variables']))
+        except MemoryError:
+            reply = ('error', QueryMemoryError("Query exceeded the worker memory limit"))
+        except Exception as e:
+            reply = ('error', e)
+        del task
+
+        try:
+            results.send(reply)
+        except MemoryError:
+            results.send(('error', QueryMemoryError("Query result exceeded the worker memory limit")))
+        except Exception as e:
+            # Exceptions or result values that can't be pickled
+            message = str(reply[1]) if reply[0] == 'error' else f"Query result can't be sent: {str(e)}"
+            results.send(('error', ValueError(message)))
+        del reply
+
+
+if __name__ == '__main__':
+    task_fd, result_fd, worker_settings = int(sys.argv[1]), int(sys.argv[2]), json.loads(sys.argv[3])
+    configure_logging(**worker_settings['logging'])
+    _serve(Connection(task_fd, writable=False), Connection(result_fd, readable=False),
+           worker_settings['memory_limit'])
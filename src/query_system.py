@@ -1,67 +1,443 @@
+import asyncio
+import json
+import threading
 import pandas as pd
-from openai import OpenAI
-from .logger_config import setup_logging
+from .logger_config import FramePreview, setup_logging
+from .llm_gateway import LLMGateway
+from .dataset_manager import DatasetManager
+from .filter_index import FilterIndex, FilterStats, plan_columns
+from .query_executor import QueryExecutor, QueryValidationError
+from .query_pool import PooledQueryExecutor
+from .sql_engine import TABLE_NAME, SqlQueryEngine
+from .result_digest import digest_result, estimate_tokens
+from .serializer import encode_columnar
+from .schema_index import ColumnIndex, SchemaSelection, column_references
+from .session_store import PREVIOUS_RESULT_NAME, Turn, describe_result, is_follow_up, reads_previous_result
+from .telemetry import annotate, record_cache, record_tokens, span
 import os
 from datetime import datetime
 
+# Pandas code generation rules shared by the codegen and fused prompts
+QUERY_CODE_GUIDELINES = """Important: Only use these pandas operations:
+- Basic indexing and selection: df[...], df.loc[...], df.iloc[...]
+- Filtering: df[df['column'] condition]
+- Grouping: df.groupby()
+- Aggregation: .count(), .sum(), .mean(), .min(), .max()
+- Sorting: .sort_values()
+- Basic arithmetic: +, -, *, /
+- Comparisons: >, <, >=, <=, ==, !=
+- String operations: .str.contains(), .str.startswith(), .str.endswith()
+
+Return only the python code that starts with 'df' and uses proper python syntax. 
+The code should NOT be wrapped in any other code or comments.
+When the code is executed using eval(), it should return a pandas DataFrame with the filtered results.
+Don't include any explanations or print statements.
+
+Here are some examples of how to interepret user questions:
+
+1. "Show me everything about Apple" -> df = df['Apple']
+2. "Show me the revenue of Tesla" -> df[df['Company'] == 'Tesla']['Revenue']
+3. "What is the market capitalization of Alphabet" -> df[df['Company'] == 'Alphabet']['Market Capitalization']
+"""
+
+# SQL generation rules for the duckdb query engine
+SQL_CODE_GUIDELINES = f"""Important: Write a single DuckDB SQL SELECT statement:
+- Read from the table named {TABLE_NAME}
+- Quote column names with double quotes, e.g. "Market Capitalization"
+- Filtering: WHERE, with =, <>, >, <, >=, <=, IN, BETWEEN, LIKE, ILIKE
+- Grouping and aggregation: GROUP BY with COUNT, SUM, AVG, MIN, MAX
+- Sorting and limiting: ORDER BY, LIMIT
+- CTEs (WITH ...) and subqueries are allowed
+
+Return only the SQL statement, without comments, explanations or a trailing semicolon.
+Never use INSERT, UPDATE, DELETE, CREATE, COPY, SET or any other non-SELECT statement.
+
+Here are some examples of how to interepret user questions:
+
+1. "Show me everything about Apple" -> SELECT * FROM {TABLE_NAME} WHERE "Company" = 'Apple'
+2. "Show me the revenue of Tesla" -> SELECT "Company", "Revenue" FROM {TABLE_NAME} WHERE "Company" = 'Tesla'
+3. "Which 3 companies have the highest revenue" -> SELECT * FROM {TABLE_NAME} ORDER BY "Revenue" DESC LIMIT 3
+"""
+
+PIPELINE_MODES = ('multi', 'fused')
+
+QUERY_ENGINES = ('pandas', 'duckdb')
+
+# Pruned schemas list at most this many of the columns they leave out
+MAX_OMITTED_COLUMN_NAMES = 100
+
 class ExcelQuerySystem:
-    def __init__(self, model, csv_path, api_key):
+    def __init__(self, model, csv_path, api_key, query_cache=None,
+                 pipeline_mode='multi', use_summary_template=False,
+                 llm_timeout=60, llm_max_concurrency=32, speculative_codegen=True,
+                 dataset_cache_dir=None, dataset_cache_hash=False, dataset_watch_interval=None,
+                 query_max_rows=None, query_timeout=None, result_cache=None,
+                 query_engine='pandas', duckdb_threads=None, duckdb_memory_limit=None,
+                 summary_max_tokens=800, schema_max_tokens=1500, schema_max_columns=40,
+                 client=None, async_client=None, llm_gateway=None,
+                 filter_index_min_rows=100000, filter_index_min_filters=3, filter_index_max_columns=8,
+                 session_store=None, query_pool=None, dataset_compact_dtypes=False):
         """
         Initialize the query system with an Excel file and OpenAI API key
         
         Args:
-            excel_path (str): Path to the Excel file
+            model (str): OpenAI model name
+            csv_path (str): Path to the CSV file
             api_key (str): OpenAI API key
+            query_cache (QueryCache): Optional cache of generated query plans
+            pipeline_mode (str): 'multi' for separate classify/codegen calls or
+                'fused' for a single structured JSON completion
+            use_summary_template (bool): In fused mode, answer with the returned
+                summary template instead of a separate summary call
+            llm_timeout (float): Seconds before an LLM call attempt is abandoned and
+                retried (used when no llm_gateway is given)
+            llm_max_concurrency (int): Maximum in-flight LLM calls made by aquery
+            speculative_codegen (bool): In aquery, generate code concurrently with
+                classification instead of waiting for the question type
+            dataset_cache_dir (str): Directory for the memory-mapped columnar copy
+                of the CSV (None parses the CSV on every start)
+            dataset_cache_hash (bool): Rebuild the columnar copy when the CSV's
+                content hash changes instead of its size or mtime
+            dataset_watch_interval (float): Seconds between checks of the CSV for
+                changes, reloading it in the background (None disables watching)
+            dataset_compact_dtypes (bool): Downcast integers and turn repetitive
+                text into categoricals to save memory, at the cost of integer
+                overflow and categorical semantics in generated code
+            query_max_rows (int): Truncate query results to this many rows
+            query_timeout (float): Seconds a generated query may run
+            result_cache (ResultCache): Optional cache of query results
+            query_engine (str): 'pandas' to generate and run pandas code on the
+                in-memory DataFrame, or 'duckdb' to generate SQL and run it on
+                DuckDB directly over the dataset file
+            duckdb_threads (int): DuckDB worker threads (None uses every core)
+            duckdb_memory_limit (str): DuckDB memory limit, e.g. '4GB'
+            summary_max_tokens (int): Approximate token budget for the result
+                digest sent to the LLM to explain a query result
+            schema_max_tokens (int): Schema prompts larger than this are pruned to
+                the columns most relevant to the question (None never prunes)
+            schema_max_columns (int): Most columns a pruned schema describes
+            client (OpenAI): Chat client to use instead of an OpenAI client built
+                from api_key, e.g. the local stand-in used by the benchmarks
+            async_client (AsyncOpenAI): Async chat client to use on every event
+                loop instead of an AsyncOpenAI client per loop
+            llm_gateway (LLMGateway): Gateway shared with other query systems for
+                request coalescing, rate limiting and retries (by default each
+                system gets its own, built from api_key, client and async_client)
+            filter_index_min_rows (int): With the pandas engine, datasets with at
+                least this many rows get secondary indexes on the columns queries
+                filter on most (None disables filter indexes)
+            filter_index_min_filters (int): Filters on a column, counted from the
+                query cache and the queries run since, before it is indexed
+            filter_index_max_columns (int): Most columns indexed per dataset
+            session_store (SessionStore): Conversation state shared with other
+                query systems; questions asked with a session_id then see the
+                earlier turns and can build on the previous result (None makes
+                every question stand alone)
+            query_pool (QueryPool): With the pandas engine, worker processes
+                shared with other query systems that run generated code outside
+                this process, so a runaway query is killed at the timeout
+                instead of occupying a web worker (None runs queries in-process)
         """
         # Set up logging using common configuration
         self.logger = setup_logging('ExcelQuerySystem')
         
         self.logger.info("Initializing ExcelQuerySystem")
         
-        self.logger.info(f"Loading CSV file from: {csv_path}")
-        
-        self.df = pd.read_csv(csv_path)
-        self.client = OpenAI(api_key=api_key)
+        self.api_key = api_key
+        self.llm_timeout = llm_timeout
+        if llm_gateway is None:
+            llm_gateway = LLMGateway(api_key, timeout=llm_timeout, client=client, async_client=async_client)
+        self.llm = llm_gateway
         self.model = model
+        self.query_cache = query_cache
+        self.result_cache = result_cache
+        self.session_store = session_store
+        if pipeline_mode not in PIPELINE_MODES:
+            raise ValueError(f"Unknown pipeline mode: {pipeline_mode}")
+        self.pipeline_mode = pipeline_mode
+        self.use_summary_template = use_summary_template
+        self.llm_max_concurrency = llm_max_concurrency
+        self.speculative_codegen = speculative_codegen
+        self.summary_max_tokens = summary_max_tokens
+        self.schema_max_tokens = schema_max_tokens
+        self.schema_max_columns = schema_max_columns
+        if query_engine not in QUERY_ENGINES:
+            raise ValueError(f"Unknown query engine: {query_engine}")
+        self.query_engine = query_engine
+        if query_engine == 'duckdb':
+            self.executor = SqlQueryEngine(
+                csv_path,
+                cache_dir=dataset_cache_dir,
+                max_rows=query_max_rows,
+                timeout=query_timeout,
+                threads=duckdb_threads,
+                memory_limit=duckdb_memory_limit
+            )
+        elif query_pool is not None:
+            self.executor = PooledQueryExecutor(query_pool, max_rows=query_max_rows, timeout=query_timeout)
+        else:
+            self.executor = QueryExecutor(max_rows=query_max_rows, timeout=query_timeout)
+        self.query_pool = query_pool if query_engine == 'pandas' else None
 
-        # Create a schema description of the dataframe
-        self.schema = self._create_schema_description()
+        # The semaphore belongs to the event loop that created it
+        self._async_loop = None
+        self._llm_semaphore = None
+
+        # Filter counts survive reloads, so a new version is indexed like the old one
+        filter_index = None
+        self.filter_stats = None
+        if query_engine == 'pandas' and filter_index_min_rows is not None:
+            self.filter_stats = FilterStats()
+            self._seed_filter_stats()
+            settings = {'min_filters': filter_index_min_filters, 'max_columns': filter_index_max_columns,
+                        'min_rows': filter_index_min_rows}
+            if self.query_pool is not None:
+                # Workers index their own mapping of the dataset
+                self.executor.filter_stats = self.filter_stats
+                self.executor.filter_index_settings = settings
+            else:
+                def filter_index(df):
+                    return FilterIndex(df, self.filter_stats, **settings)
+
+        # Load, profile and describe the dataset; later versions are swapped in by the manager
+        self.dataset = DatasetManager(
+            csv_path,
+            describe=self._create_schema_description,
+            cache_dir=dataset_cache_dir,
+            use_hash=dataset_cache_hash,
+            watch_interval=dataset_watch_interval,
+            index=ColumnIndex,
+            filter_index=filter_index,
+            compact_dtypes=dataset_compact_dtypes,
+            # DuckDB profiles the file itself, so the dataset never goes through pandas
+            profiler=self.executor.profile if query_engine == 'duckdb' else None
+        )
+        self.dataset.add_listener(self._on_dataset_reload)
+        self._attach(self.dataset.current)
         self.logger.info("Initialization complete")
+
+    def _seed_filter_stats(self):
+        """Count the columns filtered on by the plans in the query cache"""
+        if self.query_cache is None:
+            return
+        for query_code in self.query_cache.query_codes():
+            try:
+                filters = self.executor.compile(query_code).filters
+            except QueryValidationError:
+                continue
+            for plan in filters:
+                self.filter_stats.record(plan_columns(plan))
     
     
 
-    def _create_schema_description(self):
-        """Create a description of the dataframe schema for the LLM"""
+    @property
+    def df(self):
+        """DataFrame of the current dataset snapshot (None with the duckdb engine)"""
+        return self.dataset.current.df
+
+    @property
+    def schema(self):
+        """Schema prompt of the current dataset snapshot"""
+        return self.dataset.current.schema
+
+    @property
+    def profile(self):
+        """Profile of the current dataset snapshot"""
+        return self.dataset.current.profile
+
+    @property
+    def dataset_fingerprint(self):
+        """Fingerprint of the current dataset snapshot"""
+        return self.dataset.current.fingerprint
+
+    def _attach(self, snapshot):
+        """Point an executor that reads the dataset by itself at a snapshot"""
+        if self.query_engine == 'duckdb':
+            self.executor.attach(snapshot.fingerprint)
+        elif self.query_pool is not None:
+            self.executor.attach(snapshot.df, snapshot.cache_path)
+
+    def _on_dataset_reload(self, old, new):
+        """Drop cached plans and results that depend on the previous dataset version"""
+        self._attach(new)
+        if self.query_cache is not None and old.schema != new.schema:
+            self.query_cache.discard_schema(old.schema)
+        if self.result_cache is not None and old.fingerprint != new.fingerprint:
+            self.result_cache.discard_fingerprint(old.fingerprint)
+
+    def _chat(self, request):
+        """Send a chat completion request built by one of the *_request methods"""
+        return self.llm.create(self.model, request)
+
+    def _semaphore(self):
+        """Return the concurrency limit for the running event loop"""
+        loop = asyncio.get_running_loop()
+        if self._async_loop is not loop:
+            self._async_loop = loop
+            self._llm_semaphore = asyncio.Semaphore(self.llm_max_concurrency)
+        return self._llm_semaphore
+
+    async def _achat(self, request):
+        """Async version of _chat, bounded by the concurrency limit"""
+        # The gateway times out and retries each attempt itself
+        async with self._semaphore():
+            return await self.llm.acreate(self.model, request)
+
+    def _create_schema_description(self, profile):
+        """Create a description of the dataframe schema for the LLM from the dataset profile"""
         self.logger.info("Creating schema description")
+        schema = self._render_schema(profile)
+        self.logger.debug("Generated schema:\n%s", schema)
+        return schema
+
+    def _render_schema(self, profile, columns=None):
+        """
+        Render the schema prompt for a dataset profile
         
-        columns = self.df.columns.tolist()
-        dtypes = self.df.dtypes.to_dict()
+        Args:
+            profile (dict): Dataset profile
+            columns (list): Describe only these columns and list the rest by name
+                (None describes every column)
+        """
+        omitted = []
+        if columns is not None:
+            selected = set(columns)
+            omitted = [column['name'] for column in profile['columns'] if column['name'] not in selected]
+            profile = dict(profile, columns=[column for column in profile['columns'] if column['name'] in selected])
         
-        schema = "DataFrame Schema:\n"
-        schema += f"Total rows: {len(self.df)}\n"
+        if self.query_engine == 'duckdb':
+            schema = f"SQL table '{TABLE_NAME}' schema:\n"
+        else:
+            schema = "DataFrame Schema:\n"
+        schema += f"Total rows: {profile['rows']}\n"
         schema += "Columns:\n"
-        for col in columns:
-            schema += f"- {col} (Type: {dtypes[col]})\n"
+        for column in profile['columns']:
+            details = [f"Type: {column['dtype']}", f"~{column['cardinality']} distinct"]
+            if column['null_ratio']:
+                details.append(f"{column['null_ratio']:.1%} null")
+            if column['min'] is not None:
+                details.append(f"range {column['min']} to {column['max']}")
+            schema += f"- {column['name']} ({', '.join(details)})\n"
         
         # Add sample values for each column
         schema += "\nSample values for each column:\n"
-        for col in columns:
-            sample_values = self.df[col].dropna().unique()[:3]
-            schema += f"- {col}: {', '.join(map(str, sample_values))}\n"
+        for column in profile['columns']:
+            schema += f"- {column['name']}: {', '.join(map(str, column['samples']))}\n"
+        
+        # Frequent values help the LLM spell filter values the way the data does
+        frequent = [column for column in profile['columns']
+                    if column['min'] is None and column['top_values'] and column['top_values'][0][1] > 1]
+        if frequent:
+            schema += "\nMost common values:\n"
+            for column in frequent:
+                values = ', '.join(f"{value} ({count})" for value, count in column['top_values'])
+                schema += f"- {column['name']}: {values}\n"
         
-        self.logger.debug(f"Generated schema:\n{schema}")
+        if omitted:
+            names = ', '.join(map(str, omitted[:MAX_OMITTED_COLUMN_NAMES]))
+            if len(omitted) > MAX_OMITTED_COLUMN_NAMES:
+                names += f" and {len(omitted) - MAX_OMITTED_COLUMN_NAMES} more"
+            schema += f"\nOther columns (not described here): {names}\n"
         return schema
 
-    def _determine_question_type(self, question):
-        """Determine if the question requires data filtering or just explanation"""
-        self.logger.info(f"Determining question type for: {question}")
+    def _select_schema(self, question, snapshot):
+        """
+        Choose the schema prompt for a question
+        
+        Small schemas are used whole. Larger ones are cut down to the columns the
+        column index ranks most relevant to the question, as many as fit in
+        schema_max_tokens, up to schema_max_columns.
+        
+        Returns:
+            SchemaSelection
+        """
+        all_columns = [column['name'] for column in snapshot.profile['columns']]
+        if (self.schema_max_tokens is None or snapshot.column_index is None
+                or estimate_tokens(snapshot.schema) <= self.schema_max_tokens):
+            return SchemaSelection(snapshot.schema, all_columns, pruned=False)
+        
+        chosen, text = [], None
+        for name in snapshot.column_index.rank(question)[:self.schema_max_columns]:
+            candidate = [column for column in all_columns if column in chosen or column == name]
+            candidate_text = self._render_schema(snapshot.profile, candidate)
+            if text is not None and estimate_tokens(candidate_text) > self.schema_max_tokens:
+                break
+            chosen, text = candidate, candidate_text
+        self.logger.info(f"Pruned schema to {len(chosen)} of {len(all_columns)} columns")
+        return SchemaSelection(text, chosen, pruned=True)
+
+    def _widen_schema(self, snapshot, selection, query_code, context=None):
+        """
+        Return a wider schema if the code uses columns the pruned schema left out
+        
+        Columns the code names that exist but weren't described are added, and
+        names that don't exist at all pull in the columns that best match them.
+        Columns of a conversation's previous result count as known.
+        
+        Returns:
+            SchemaSelection, or None if the code only uses described columns
+        """
+        if not selection.pruned:
+            return None
+        all_columns = [column['name'] for column in snapshot.profile['columns']]
+        known = set(all_columns)
+        shown = set(selection.columns)
+        references = column_references(query_code, all_columns, self.query_engine)
+        missing = [name for name in references if name in known and name not in shown]
+        previous = set()
+        if context is not None and context.prev is not None:
+            previous = {str(column) for column in context.prev.columns}
+        unknown = [name for name in references if name not in known and name not in previous]
+        if not missing and not unknown:
+            return None
+        
+        extra = set(missing)
+        for name in unknown:
+            # Best matches for a guessed name, e.g. 'revenue' -> 'Total Revenue (USD)'
+            scores = snapshot.column_index.scores(name)
+            matches = [column for column, score in zip(all_columns, scores) if score > 0 and column not in shown]
+            extra.update(sorted(matches, key=lambda column: -scores[all_columns.index(column)])[:3])
+        if not extra:
+            return None
+        self.logger.info(f"Widening schema for columns the code referenced: {', '.join(map(str, missing + unknown))}")
+        columns = [column for column in all_columns if column in shown or column in extra]
+        return SchemaSelection(
+            self._render_schema(snapshot.profile, columns),
+            columns,
+            pruned=len(columns) < len(all_columns)
+        )
+
+    def _conversation_prompt(self, context, with_prev=False):
+        """
+        Prompt section describing the earlier turns of a conversation
         
+        Args:
+            context (ConversationContext): The conversation, or None for a standalone question
+            with_prev (bool): Also offer the previous result to the generated code
+        """
+        if context is None:
+            return ""
+        section = f"\n{context.digest}\n"
+        if with_prev and context.prev is not None:
+            if self.query_engine == 'duckdb':
+                source, usage = 'table', f"select FROM {PREVIOUS_RESULT_NAME} instead of {TABLE_NAME}"
+            else:
+                source, usage = 'DataFrame', f"write code that starts from {PREVIOUS_RESULT_NAME} instead of df"
+            section += (
+                f"\nThe result of the previous question is available as the {source} "
+                f"{PREVIOUS_RESULT_NAME} ({describe_result(context.prev)}). If this question refines "
+                f"that result, e.g. 'sort those by revenue' or 'only the ones from 2023', {usage}.\n"
+            )
+        return section
+
+    def _question_type_request(self, question, schema, context=None):
+        """Build the chat request that classifies a question"""
         prompt = f"""
 Analyze the following question and determine if it requires filtering/querying data from the DataFrame or just needs a general explanation.
 
 DataFrame Context:
-{self.schema}
-
+{schema}
+{self._conversation_prompt(context)}
 Question: {question}
 
 Classify this question as either:
@@ -71,230 +447,716 @@ Classify this question as either:
 Return ONLY one of these exactly: 'filter' or 'explain'
 """
         
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=[
+        return {
+            'messages': [
                 {"role": "system", "content": "You are an expert at classifying questions. Respond only with 'filter' or 'explain'."},
                 {"role": "user", "content": prompt}
             ],
-            temperature=0
-        )
+            'temperature': 0
+        }
+
+    def _determine_question_type(self, question, schema, context=None):
+        """Determine if the question requires data filtering or just explanation"""
+        self.logger.info(f"Determining question type for: {question}")
+        
+        with span('classify'):
+            response = self._chat(self._question_type_request(question, schema, context))
         
         question_type = response.choices[0].message.content.strip().lower()
         self.logger.info(f"Question type determined: {question_type}")
         return question_type
 
-    def _generate_query_code(self, user_question):
-        """Generate pandas code to answer the user's question"""
-        self.logger.info("Generating query code")
+    async def _adetermine_question_type(self, question, schema, context=None):
+        """Async version of _determine_question_type"""
+        self.logger.info(f"Determining question type for: {question}")
+        
+        with span('classify'):
+            response = await self._achat(self._question_type_request(question, schema, context))
         
+        question_type = response.choices[0].message.content.strip().lower()
+        self.logger.info(f"Question type determined: {question_type}")
+        return question_type
+
+    def _code_guidelines(self):
+        """Code generation rules for the configured query engine"""
+        return SQL_CODE_GUIDELINES if self.query_engine == 'duckdb' else QUERY_CODE_GUIDELINES
+
+    def _query_code_request(self, user_question, schema, context=None):
+        """Build the chat request that generates pandas code for a question"""
+        if self.query_engine == 'duckdb':
+            return self._sql_code_request(user_question, schema, context)
         prompt = f"""
 You are an expert in pandas and data analysis. Given the following DataFrame schema and user question, 
 generate ONLY the python code (without any explanation) that would answer the question.
 The code should return a pandas DataFrame with the filtered results.
 
-{self.schema}
-
+{schema}
+{self._conversation_prompt(context, with_prev=True)}
 User Question: {user_question}
 
-Important: Only use these pandas operations:
-- Basic indexing and selection: df[...], df.loc[...], df.iloc[...]
-- Filtering: df[df['column'] condition]
-- Grouping: df.groupby()
-- Aggregation: .count(), .sum(), .mean(), .min(), .max()
-- Sorting: .sort_values()
-- Basic arithmetic: +, -, *, /
-- Comparisons: >, <, >=, <=, ==, !=
-- String operations: .str.contains(), .str.startswith(), .str.endswith()
+{QUERY_CODE_GUIDELINES}"""
+        
+        return {
+            'messages': [
+                {"role": "system", "content": "You are a data analysis expert. Generate only pandas code without any explanation."},
+                {"role": "user", "content": prompt}
+            ],
+            'temperature': 0
+        }
 
-Return only the python code that starts with 'df' and uses proper python syntax. 
-The code should NOT be wrapped in any other code or comments.
-When the code is executed using eval(), it should return a pandas DataFrame with the filtered results.
-Don't include any explanations or print statements.
+    def _sql_code_request(self, user_question, schema, context=None):
+        """Build the chat request that generates a SQL query for a question"""
+        prompt = f"""
+You are an expert in SQL and data analysis. Given the following table schema and user question,
+generate ONLY the SQL query (without any explanation) that would answer the question.
 
-Here are some examples of how to interepret user questions:
+{schema}
+{self._conversation_prompt(context, with_prev=True)}
+User Question: {user_question}
 
-1. "Show me everything about Apple" -> df = df['Apple']
-2. "Show me the revenue of Tesla" -> df[df['Company'] == 'Tesla']['Revenue']
-3. "What is the market capitalization of Alphabet" -> df[df['Company'] == 'Alphabet']['Market Capitalization']
-"""
+{SQL_CODE_GUIDELINES}"""
         
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=[
-                {"role": "system", "content": "You are a data analysis expert. Generate only pandas code without any explanation."},
+        return {
+            'messages': [
+                {"role": "system", "content": "You are a data analysis expert. Generate only DuckDB SQL without any explanation."},
                 {"role": "user", "content": prompt}
             ],
-            temperature=0
-        )
+            'temperature': 0
+        }
+
+    def _generate_query_code(self, user_question, schema, context=None):
+        """Generate pandas code to answer the user's question"""
+        self.logger.info("Generating query code")
+        
+        with span('codegen'):
+            response = self._chat(self._query_code_request(user_question, schema, context))
+        
+        query_code = response.choices[0].message.content.strip()
+        self.logger.debug(f"Generated query code:\n{query_code}")
+        return query_code
+
+    async def _agenerate_query_code(self, user_question, schema, context=None):
+        """Async version of _generate_query_code"""
+        self.logger.info("Generating query code")
+        
+        with span('codegen'):
+            response = await self._achat(self._query_code_request(user_question, schema, context))
         
         query_code = response.choices[0].message.content.strip()
         self.logger.debug(f"Generated query code:\n{query_code}")
         return query_code
     
-    def _safe_execute_query(self, query_code, df):
-        """Safely execute the generated pandas query"""
-        self.logger.info("Safely executing query code")
+    def _safe_execute_query(self, query_code, df, fingerprint=None, index=None, variables=None, cancel=None):
+        """
+        Safely execute the generated query
         
-        # Dictionary of allowed functions and their implementations
-        allowed_operations = {
-            'groupby': df.groupby,
-            'sort_values': df.sort_values,
-            'mean': df.mean,
-            'sum': df.sum,
-            'count': df.count,
-            'max': df.max,
-            'min': df.min,
-        }
+        Args:
+            query_code (str): Generated pandas code, or SQL for the duckdb engine
+            df (DataFrame): Data the code runs against
+            fingerprint (str): Dataset fingerprint of df; enables the result cache
+            index (FilterIndex): Filter indexes over df
+            variables (dict): Further DataFrames the code may read, e.g. the
+                previous result of a conversation; such results aren't cached
+            cancel (threading.Event): Set to stop a query running in the query pool
+        """
+        self.logger.info("Safely executing query code")
         
         try:
-            # Basic safety checks
-            if not query_code.startswith('df'):
-                raise ValueError("Query must start with 'df'")
-            
-            # Remove any potentially dangerous operations
-            dangerous_ops = ['eval', 'exec', 'import', 'open', 'read', 'write', 'delete', 'remove', 'system']
-            if any(op in query_code.lower() for op in dangerous_ops):
-                raise ValueError("Query contains unauthorized operations")
-
-            # Create a local namespace with only the DataFrame and allowed operations
-            local_namespace = {
-                'df': df,
-                'pd': pd,  # needed for some pandas operations
-                **allowed_operations
-            }
-            
-            # Handle different types of queries
-            if '=' in query_code:
-                # For assignment operations, split into parts
-                parts = query_code.split('=')
-                if len(parts) != 2:
-                    raise ValueError("Invalid assignment operation")
-                
-                # Execute the right side of the assignment
-                right_side = parts[1].strip()
-                result = eval(right_side, {"__builtins__": {}}, local_namespace)
+            with span('execute', engine=self.query_engine):
+                cache_key = None
+                if self.result_cache is not None and fingerprint is not None and not variables:
+                    cache_key = self.executor.compile(query_code).source
+                    result = self.result_cache.get(fingerprint, cache_key)
+                    record_cache('result', result is not None)
+                    if result is not None:
+                        self.logger.info(f"Result cache hit. Result shape: {result.shape}")
+                        if index is not None:
+                            # Still counts towards which columns are worth indexing
+                            index.observe(self.executor.compile(query_code).filters)
+                        return result
                 
-                # Update the local namespace
-                local_namespace['df'] = result
-                self.logger.debug(f"Assignment operation completed. New shape: {result.shape}")
-            else:
-                # For direct queries
-                result = eval(query_code, {"__builtins__": {}}, local_namespace)
-            
-            # Get the final result from the namespace
-            final_result = local_namespace['df']
-            
-            # Ensure the result is a DataFrame
-            if not isinstance(final_result, pd.DataFrame):
-                if isinstance(final_result, pd.Series):
-                    final_result = final_result.to_frame()
-                else:
-                    final_result = pd.DataFrame(final_result)
-            
-            self.logger.info(f"Query executed successfully. Result shape: {result.shape}")
-            return result
+                result = self.executor.execute(query_code, df, index=index, variables=variables, cancel=cancel)
+                self.logger.info(f"Query executed successfully. Result shape: {result.shape}")
+                if cache_key is not None:
+                    self.result_cache.put(fingerprint, cache_key, result)
+                return result
             
         except Exception as e:
             self.logger.error(f"Error executing query: {str(e)}", exc_info=True)
             raise ValueError(f"Error executing query: {str(e)}")
         
-    def generate_explanation(self, question):
-        """Generate a general explanation for questions that don't require data filtering"""
-        self.logger.info("Generating general explanation")
-        
+    def _explanation_request(self, question, schema, context=None):
+        """Build the chat request that explains a general question"""
         prompt = f"""
 Provide a clear and informative answer to the following question. Consider the context of our DataFrame but focus on giving a general explanation.
 
 DataFrame Context:
-{self.schema}
-
+{schema}
+{self._conversation_prompt(context)}
 Question: {question}
 
 Provide a clear, comprehensive explanation in 2-3 sentences.
 """
         
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=[
+        return {
+            'messages': [
                 {"role": "system", "content": "You are a helpful data analyst providing clear explanations."},
                 {"role": "user", "content": prompt}
             ],
-            temperature=0
-        )
+            'temperature': 0
+        }
+
+    def generate_explanation(self, question, schema=None, context=None):
+        """Generate a general explanation for questions that don't require data filtering"""
+        self.logger.info("Generating general explanation")
+        
+        with span('explain'):
+            response = self._chat(self._explanation_request(question, schema or self.schema, context))
+        
+        explanation = response.choices[0].message.content.strip()
+        self.logger.debug(f"Generated explanation:\n{explanation}")
+        return explanation
+
+    async def agenerate_explanation(self, question, schema=None, context=None):
+        """Async version of generate_explanation"""
+        self.logger.info("Generating general explanation")
+        
+        with span('explain'):
+            response = await self._achat(self._explanation_request(question, schema or self.schema, context))
         
         explanation = response.choices[0].message.content.strip()
         self.logger.debug(f"Generated explanation:\n{explanation}")
         return explanation
     
-    def generate_natural_language_response(self, question, result_df):
-        """Generate a natural language explanation of the filtered data results"""
+    def _results_summary_request(self, question, result_df, context=None):
+        """Build the chat request that explains the filtered data results"""
+        # Statistics over the whole result rather than its first rows, within a token budget
+        data_summary = digest_result(result_df, max_tokens=self.summary_max_tokens)
         prompt = f"""
 Given the following question and the resulting data, provide a natural language explanation of the findings.
 Keep the explanation clear and concise.
-
+{self._conversation_prompt(context)}
 Question: {question}
 
 Data Summary:
-{result_df.to_string() if len(result_df) < 10 else result_df.head().to_string() + "[...more rows...]"}
+{data_summary}
 
 Explain what we can learn from this data in 2-3 sentences.
 """
         
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=[
+        return {
+            'messages': [
                 {"role": "system", "content": "You are a data analyst providing clear, concise explanations of data findings."},
                 {"role": "user", "content": prompt}
             ],
-            temperature=0
-        )
-        
+            'temperature': 0
+        }
+
+    def generate_natural_language_response(self, question, result_df, context=None):
+        """Generate a natural language explanation of the filtered data results"""
+        with span('summarize'):
+            response = self._chat(self._results_summary_request(question, result_df, context))
+        return response.choices[0].message.content.strip()
+
+    async def agenerate_natural_language_response(self, question, result_df, context=None):
+        """Async version of generate_natural_language_response"""
+        with span('summarize'):
+            response = await self._achat(self._results_summary_request(question, result_df, context))
         return response.choices[0].message.content.strip()
     
-    def query(self, question):
-        """Process user question and return appropriate response"""
+    def _fused_plan_request(self, question, schema, context=None):
+        """Build the structured chat request that classifies and plans a question"""
+        prompt = f"""
+You are an expert in pandas and data analysis. Given the following DataFrame schema and user question,
+decide whether the question requires filtering/querying data from the DataFrame or just needs a general explanation.
+
+{schema}
+{self._conversation_prompt(context, with_prev=True)}
+User Question: {question}
+
+Respond with a JSON object with these keys:
+- "question_type": 'filter' if it requires searching, filtering, or analyzing specific data from the DataFrame,
+  'explain' if it's asking for general explanation, terminology, or questions not requiring specific data filtering
+- "query_code": for 'filter' questions, the code that answers the question, otherwise null
+- "explanation": for 'explain' questions, a clear, comprehensive explanation in 2-3 sentences, otherwise null
+- "summary_template": for 'filter' questions, a one sentence answer template that may use the
+  placeholders {{row_count}} and {{columns}}, otherwise null
+
+Rules for query_code:
+{self._code_guidelines()}"""
+        
+        return {
+            'messages': [
+                {"role": "system", "content": "You are a data analysis expert. Respond only with a valid JSON object."},
+                {"role": "user", "content": prompt}
+            ],
+            'response_format': {"type": "json_object"},
+            'temperature': 0
+        }
+
+    def _plan_question_fused(self, question, schema, context=None):
+        """
+        Classify the question and generate its code or explanation in one call
+
+        Returns:
+            dict: Plan with question_type, query_code, explanation and
+                summary_template, or None if the structured output is malformed
+        """
+        self.logger.info("Planning question with fused completion")
+        with span('plan'):
+            response = self._chat(self._fused_plan_request(question, schema, context))
+        return self._parse_fused_plan(response.choices[0].message.content)
+
+    async def _aplan_question_fused(self, question, schema, context=None):
+        """Async version of _plan_question_fused"""
+        self.logger.info("Planning question with fused completion")
+        with span('plan'):
+            response = await self._achat(self._fused_plan_request(question, schema, context))
+        return self._parse_fused_plan(response.choices[0].message.content)
+
+    def _parse_fused_plan(self, content):
+        """Validate the JSON returned by a fused completion"""
+        try:
+            plan = json.loads(content)
+        except (TypeError, ValueError):
+            self.logger.warning(f"Fused completion returned invalid JSON:\n{content}")
+            return None
+        
+        if not isinstance(plan, dict):
+            self.logger.warning(f"Fused completion did not return an object:\n{content}")
+            return None
+        question_type = str(plan.get('question_type') or '').strip().strip("'").lower()
+        query_code = plan.get('query_code')
+        explanation = plan.get('explanation')
+        summary_template = plan.get('summary_template')
+        if question_type not in ('filter', 'explain'):
+            self.logger.warning(f"Fused completion returned unknown question type: {question_type}")
+            return None
+        if question_type == 'filter' and not (isinstance(query_code, str) and query_code.strip()):
+            self.logger.warning("Fused completion returned a filter question without query code")
+            return None
+        
+        self.logger.info(f"Fused plan question type: {question_type}")
+        return {
+            'question_type': question_type,
+            'query_code': query_code.strip() if question_type == 'filter' else None,
+            'explanation': explanation.strip() if isinstance(explanation, str) and explanation.strip() else None,
+            'summary_template': summary_template if isinstance(summary_template, str) else None,
+        }
+
+    def _plan_question(self, question, snapshot, context=None):
+        """
+        Work out how to answer a question against a dataset snapshot
+
+        Questions that read as follow-ups (see is_follow_up) depend on the
+        earlier turns, so they aren't looked up in the query cache; other
+        questions asked in a conversation use it like standalone ones.
+
+        Returns:
+            tuple: (plan dict, whether it came from the query cache)
+        """
+        cached_plan = None
+        if self.query_cache is not None and not self._is_follow_up(question, context):
+            cached_plan = self.query_cache.get(question, snapshot.schema)
+            record_cache('plan', cached_plan is not None)
+        if cached_plan:
+            question_type, query_code = cached_plan
+            self.logger.info(f"Using cached plan. Question type: {question_type}")
+            return {'question_type': question_type, 'query_code': query_code,
+                    'explanation': None, 'summary_template': None, 'schema': None}, True
+        
+        schema = self._select_schema(question, snapshot)
+        if self.pipeline_mode == 'fused':
+            try:
+                plan = self._plan_question_fused(question, schema.text, context)
+            except Exception as e:
+                self.logger.warning(f"Fused completion failed: {str(e)}")
+                plan = None
+            if plan is not None:
+                plan['schema'] = schema
+                return plan, False
+            self.logger.info("Falling back to separate classify and codegen calls")
+        
+        # Determine question type
+        question_type = self._determine_question_type(question, schema.text, context)
+        self.logger.info(f"Question type: {question_type}")
+        return {'question_type': question_type, 'query_code': None,
+                'explanation': None, 'summary_template': None, 'schema': schema}, False
+
+    async def _aplan_question(self, question, snapshot, context=None):
+        """Async version of _plan_question"""
+        cached_plan = None
+        if self.query_cache is not None and not self._is_follow_up(question, context):
+            cached_plan = self.query_cache.get(question, snapshot.schema)
+            record_cache('plan', cached_plan is not None)
+        if cached_plan:
+            question_type, query_code = cached_plan
+            self.logger.info(f"Using cached plan. Question type: {question_type}")
+            return {'question_type': question_type, 'query_code': query_code,
+                    'explanation': None, 'summary_template': None, 'schema': None}, True
+        
+        schema = self._select_schema(question, snapshot)
+        if self.pipeline_mode == 'fused':
+            try:
+                plan = await self._aplan_question_fused(question, schema.text, context)
+            except Exception as e:
+                self.logger.warning(f"Fused completion failed: {str(e)}")
+                plan = None
+            if plan is not None:
+                plan['schema'] = schema
+                return plan, False
+            self.logger.info("Falling back to separate classify and codegen calls")
+        
+        query_code = None
+        if self.speculative_codegen:
+            # Codegen doesn't depend on the classification, so run both at once
+            # and drop the code if the question turns out to need an explanation
+            question_type, query_code = await asyncio.gather(
+                self._adetermine_question_type(question, schema.text, context),
+                self._agenerate_query_code(question, schema.text, context),
+                return_exceptions=True
+            )
+            if isinstance(question_type, BaseException):
+                raise question_type
+            if isinstance(query_code, BaseException):
+                self.logger.warning(f"Speculative code generation failed: {str(query_code)}")
+                query_code = None
+        else:
+            question_type = await self._adetermine_question_type(question, schema.text, context)
+        self.logger.info(f"Question type: {question_type}")
+        return {'question_type': question_type, 'query_code': query_code,
+                'explanation': None, 'summary_template': None, 'schema': schema}, False
+
+    def _render_summary_template(self, template, result_df):
+        """Fill in a fused-mode summary template, or return None if it doesn't render"""
+        try:
+            summary = template.format(
+                row_count=len(result_df),
+                columns=", ".join(map(str, result_df.columns))
+            ).strip()
+        except (KeyError, IndexError, ValueError) as e:
+            self.logger.warning(f"Could not render summary template: {str(e)}")
+            return None
+        return summary or None
+    
+    def _session_key(self, session_id):
+        # Sessions are per dataset; the store may be shared by every dataset's system
+        return self.dataset.csv_path, session_id
+
+    def _conversation(self, session_id):
+        """Conversation context of a session, or None for a standalone question"""
+        if self.session_store is None or not session_id:
+            return None
+        return self.session_store.context(self._session_key(session_id))
+
+    @staticmethod
+    def _is_follow_up(question, context):
+        """Whether a question asked in a conversation depends on it, which keeps it out of the query cache"""
+        return context is not None and is_follow_up(question)
+
+    @staticmethod
+    def _is_standalone(question, context, query_code):
+        """Whether a plan made in a conversation can be cached for the question asked on its own"""
+        if context is None:
+            return True
+        return not is_follow_up(question) and not reads_previous_result(query_code)
+
+    @staticmethod
+    def _variables(context, query_code):
+        """
+        Variables for code that reads the previous result
+
+        Other code runs as a standalone query, so its result is looked up in
+        and added to the result cache under the same key as without a session.
+        """
+        if context is None or not reads_previous_result(query_code):
+            return None
+        return context.variables
+
+    def _remember(self, session_id, question, question_type, query_code=None, result=None, answer=None):
+        """Add an answered question to its session"""
+        if self.session_store is None or not session_id:
+            return
+        turn = Turn(
+            question, question_type, query_code,
+            result_shape=result.shape if result is not None else None,
+            result_columns=[str(col) for col in result.columns] if result is not None else None,
+            answer=answer
+        )
+        self.session_store.record(self._session_key(session_id), turn, result)
+
+    def _query_events(self, question, stream_answer=False, session_id=None):
+        """
+        Run the query pipeline one stage at a time
+
+        Yields (stage, payload) tuples as each stage finishes:
+        ('plan', question_type), ('code', query_code), ('result', result DataFrame),
+        ('token', text) for each piece of a streamed answer when stream_answer
+        is set, and finally ('answer', explanation).
+        """
+        # Pin the dataset version so a reload can't change it mid-question
+        snapshot = self.dataset.current
+        context = self._conversation(session_id)
+        
+        # Work out the question type and code (cached, fused or multi-call)
+        plan, cached_plan = self._plan_question(question, snapshot, context)
+        question_type = plan['question_type']
+        query_code = plan['query_code']
+        annotate(question_type=question_type, plan_cached=cached_plan, follow_up=context is not None)
+        yield 'plan', question_type
+        
+        if question_type == 'explain':
+            # For questions that don't require data filtering
+            if self.query_cache is not None and not cached_plan and not self._is_follow_up(question, context):
+                self.query_cache.put(question, snapshot.schema, question_type)
+            explanation = plan['explanation']
+            if explanation is None:
+                self.logger.info("Generating explanation for general question")
+                # Cached plans skip schema selection until a prompt needs it
+                schema = plan['schema'] or self._select_schema(question, snapshot)
+                if stream_answer:
+                    with span('explain', streamed=True):
+                        explanation = yield from self._stream_tokens(
+                            self._explanation_request(question, schema.text, context)
+                        )
+                else:
+                    explanation = self.generate_explanation(question, schema.text, context)
+            elif stream_answer:
+                yield 'token', explanation
+            self.logger.info("Explanation generated successfully")
+            self.logger.debug(f"Explanation content:\n{explanation}")
+            self._remember(session_id, question, question_type, answer=explanation)
+            yield 'answer', explanation
+            return
+        
+        # For questions that require data filtering
+        self.logger.info("Processing data filtering question")
+        
+        # Generate the pandas code
+        schema = plan['schema']
+        if query_code is None:
+            schema = schema or self._select_schema(question, snapshot)
+            query_code = self._generate_query_code(question, schema.text, context)
+            self.logger.info("Query code generated")
+        if not cached_plan:
+            widened = self._widen_schema(snapshot, schema, query_code, context)
+            if widened is not None:
+                query_code = self._generate_query_code(question, widened.text, context)
+        self.logger.debug(f"Query code:\n{query_code}")
+        annotate(query_code=query_code)
+        yield 'code', query_code
+        
+        # Create a local copy of the dataframe named 'df' (None when DuckDB reads the file)
+        df = snapshot.df
+        if df is not None:
+            self.logger.debug(f"Working with DataFrame of shape: {df.shape}")
+
+        # Safely execute the query
+        try:
+            result = self._safe_execute_query(
+                query_code, df, snapshot.fingerprint, snapshot.filter_index, self._variables(context, query_code)
+            )
+        except ValueError:
+            # Don't keep serving code that no longer runs
+            if self.query_cache is not None and cached_plan:
+                self.query_cache.invalidate(question, snapshot.schema)
+            raise
+        self.logger.info(f"Query executed. Result shape: {result.shape}")
+        self.logger.debug("Query result preview:\n%s", FramePreview(result))
+        annotate(result_rows=result.shape[0], result_columns=result.shape[1])
+        
+        # Only cache plans whose code executed successfully
+        if self.query_cache is not None and not cached_plan and self._is_standalone(question, context, query_code):
+            self.query_cache.put(question, snapshot.schema, 'filter', query_code)
+        yield 'result', result
+        
+        # Generate natural language explanation
+        explanation = None
+        if self.use_summary_template and plan['summary_template']:
+            explanation = self._render_summary_template(plan['summary_template'], result)
+            if explanation is not None and stream_answer:
+                yield 'token', explanation
+        if explanation is None:
+            self.logger.info("Generating explanation for query results")
+            if stream_answer:
+                with span('summarize', streamed=True):
+                    explanation = yield from self._stream_tokens(
+                        self._results_summary_request(question, result, context)
+                    )
+            else:
+                explanation = self.generate_natural_language_response(question, result, context)
+        self.logger.debug(f"Generated explanation:\n{explanation}")
+        self._remember(session_id, question, 'filter', query_code, result, explanation)
+        
+        self.logger.info("Query processing completed successfully")
+        yield 'answer', explanation
+
+    def _stream_tokens(self, request):
+        """Stream a chat completion, yielding ('token', text) and returning the full text"""
+        parts = []
+        stream = self.llm.stream(self.model, {**request, 'stream_options': {'include_usage': True}})
+        for chunk in stream:
+            # The final chunk has no choices, only the token usage
+            record_tokens(getattr(chunk, 'usage', None))
+            if not chunk.choices:
+                continue
+            text = chunk.choices[0].delta.content
+            if text:
+                parts.append(text)
+                yield 'token', text
+        return "".join(parts).strip()
+
+    def query(self, question, session_id=None):
+        """
+        Process user question and return appropriate response
+        
+        Args:
+            question (str): The user's question
+            session_id (str): Conversation the question belongs to; follow-ups
+                see the earlier turns and can build on the previous result
+        """
         self.logger.info(f"\n{'='*50}\nProcessing new query: {question}\n{'='*50}")
         
         try:
-            # Determine question type
-            question_type = self._determine_question_type(question)
-            self.logger.info(f"Question type: {question_type}")
+            result, explanation = None, None
+            for stage, payload in self._query_events(question, session_id=session_id):
+                if stage == 'result':
+                    result = payload
+                elif stage == 'answer':
+                    explanation = payload
+            return result, explanation
+        
+        except Exception as e:
+            self.logger.error(f"Error processing query: {str(e)}", exc_info=True)
+            annotate(error=str(e))
+            return None, f"Error processing question: {str(e)}"
+
+    def query_stream(self, question, chunk_size=100, result_store=None, page_size=None, session_id=None):
+        """
+        Process user question, yielding each stage's output as soon as it's ready
+
+        Yields (event, data) tuples: ('plan', {'question_type'}), ('code', {'query_code'}),
+        ('table', {'result_id', 'total_rows', 'limit', 'columns'}), ('rows', {'offset', 'data'})
+        with chunk_size rows of columnar data at a time, ('token', {'text'}) for the
+        streamed answer, then ('done', {'answer'}) or ('error', {'error'}).
+        
+        Args:
+            question (str): The user's question
+            chunk_size (int): Rows per 'rows' event
+            result_store (ResultStore): Keeps the full result so later pages can be fetched by id
+            page_size (int): Stream only this many leading rows (None streams them all)
+            session_id (str): Conversation the question belongs to
+        """
+        self.logger.info(f"\n{'='*50}\nProcessing new streamed query: {question}\n{'='*50}")
+        
+        try:
+            for stage, payload in self._query_events(question, stream_answer=True, session_id=session_id):
+                if stage == 'plan':
+                    yield 'plan', {'question_type': payload}
+                elif stage == 'code':
+                    yield 'code', {'query_code': payload}
+                elif stage == 'result':
+                    result_id = result_store.put(payload) if result_store is not None else None
+                    yield 'table', {
+                        'result_id': result_id,
+                        'total_rows': len(payload),
+                        # Rows streamed now, and the page size for fetching the rest
+                        'limit': len(payload) if page_size is None else page_size,
+                        'columns': [str(col) for col in payload.columns]
+                    }
+                    rows = payload if page_size is None else payload.head(page_size)
+                    for start in range(0, len(rows), chunk_size):
+                        with span('serialize'):
+                            data = encode_columnar(rows.iloc[start:start + chunk_size])['data']
+                        yield 'rows', {'offset': start, 'data': data}
+                elif stage == 'token':
+                    yield 'token', {'text': payload}
+                elif stage == 'answer':
+                    yield 'done', {'answer': payload}
+        
+        except Exception as e:
+            self.logger.error(f"Error processing query: {str(e)}", exc_info=True)
+            annotate(error=str(e))
+            yield 'error', {'error': f"Error processing question: {str(e)}"}
+
+    async def aquery(self, question, session_id=None):
+        """Async version of query, safe to run many times concurrently on one event loop"""
+        self.logger.info(f"\n{'='*50}\nProcessing new async query: {question}\n{'='*50}")
+        
+        try:
+            # Pin the dataset version so a reload can't change it mid-question
+            snapshot = self.dataset.current
+            context = self._conversation(session_id)
+            
+            # Work out the question type and code (cached, fused or multi-call)
+            plan, cached_plan = await self._aplan_question(question, snapshot, context)
+            question_type = plan['question_type']
+            query_code = plan['query_code']
+            annotate(question_type=question_type, plan_cached=cached_plan, follow_up=context is not None)
             
             if question_type == 'explain':
                 # For questions that don't require data filtering
-                self.logger.info("Generating explanation for general question")
-                explanation = self.generate_explanation(question)
+                if self.query_cache is not None and not cached_plan and not self._is_follow_up(question, context):
+                    self.query_cache.put(question, snapshot.schema, question_type)
+                explanation = plan['explanation']
+                if explanation is None:
+                    self.logger.info("Generating explanation for general question")
+                    explanation = await self.agenerate_explanation(
+                        question, (plan['schema'] or self._select_schema(question, snapshot)).text, context
+                    )
                 self.logger.info("Explanation generated successfully")
-                self.logger.debug(f"Explanation content:\n{explanation}")
+                self._remember(session_id, question, question_type, answer=explanation)
                 return None, explanation
-            else:
-                # For questions that require data filtering
-                self.logger.info("Processing data filtering question")
-                
-                # Generate the pandas code
-                query_code = self._generate_query_code(question)
+            
+            # For questions that require data filtering
+            self.logger.info("Processing data filtering question")
+            schema = plan['schema']
+            if query_code is None:
+                schema = schema or self._select_schema(question, snapshot)
+                query_code = await self._agenerate_query_code(question, schema.text, context)
                 self.logger.info("Query code generated")
-                self.logger.debug(f"Query code:\n{query_code}")
-                
-                # Create a local copy of the dataframe named 'df'
-                df = self.df
-                self.logger.debug(f"Working with DataFrame of shape: {df.shape}")
-                self.logger.debug(f"Working with DataFrame: \n{df}")
-
-                # Safely execute the query
-                result = self._safe_execute_query(query_code, self.df)
-                self.logger.info(f"Query executed. Result shape: {result.shape}")
-                self.logger.debug(f"Query result preview:\n{result.head() if not result.empty else 'Empty DataFrame'}")
-                
-                # Generate natural language explanation
+            if not cached_plan:
+                widened = self._widen_schema(snapshot, schema, query_code, context)
+                if widened is not None:
+                    query_code = await self._agenerate_query_code(question, widened.text, context)
+            self.logger.debug(f"Query code:\n{query_code}")
+            annotate(query_code=query_code)
+            
+            # Run pandas off the event loop so other questions keep moving
+            cancel = threading.Event()
+            try:
+                result = await asyncio.to_thread(
+                    self._safe_execute_query, query_code, snapshot.df, snapshot.fingerprint, snapshot.filter_index,
+                    self._variables(context, query_code), cancel
+                )
+            except asyncio.CancelledError:
+                # Stop a pooled query instead of leaving it running
+                cancel.set()
+                raise
+            except ValueError:
+                # Don't keep serving code that no longer runs
+                if self.query_cache is not None and cached_plan:
+                    self.query_cache.invalidate(question, snapshot.schema)
+                raise
+            self.logger.info(f"Query executed. Result shape: {result.shape}")
+            annotate(result_rows=result.shape[0], result_columns=result.shape[1])
+            
+            # Only cache plans whose code executed successfully
+            if self.query_cache is not None and not cached_plan and self._is_standalone(question, context, query_code):
+                self.query_cache.put(question, snapshot.schema, 'filter', query_code)
+            
+            explanation = None
+            if self.use_summary_template and plan['summary_template']:
+                explanation = self._render_summary_template(plan['summary_template'], result)
+            if explanation is None:
                 self.logger.info("Generating explanation for query results")
-                explanation = self.generate_natural_language_response(question, result)
-                self.logger.debug(f"Generated explanation:\n{explanation}")
-                
-                self.logger.info("Query processing completed successfully")
-                return result, explanation
+                explanation = await self.agenerate_natural_language_response(question, result, context)
+            
+            self._remember(session_id, question, 'filter', query_code, result, explanation)
+            self.logger.info("Async query processing completed successfully")
+            return result, explanation
         
         except Exception as e:
             self.logger.error(f"Error processing query: {str(e)}", exc_info=True)
+            annotate(error=str(e))
             return None, f"Error processing question: {str(e)}"
\ No newline at end of file
@@ -0,0 +1,80 @@
+import threading
+from collections import OrderedDict
+
+from .logger_config import setup_logging
+
+
+class ResultCache:
+    """
+    Memory-bounded cache of query results keyed by (dataset fingerprint, query source)
+
+    Different questions often compile to the same pandas code, so results are
+    keyed on the executor's canonical source rather than the question. Entries
+    are evicted least recently used first once their combined deep memory
+    usage exceeds max_bytes. Because the dataset fingerprint is part of the
+    key, results computed on an older version of the data are never served;
+    discard_fingerprint frees them as soon as the dataset is reloaded.
+
+    Cached DataFrames are shared between callers and must not be modified.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        """
+        Args:
+            max_bytes (int): Upper bound on the total memory of cached results
+        """
+        self.logger = setup_logging('ExcelQuerySystem')
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, fingerprint, source):
+        """Return the cached result DataFrame, or None on a miss"""
+        key = (fingerprint, source)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, fingerprint, source, result):
+        """Cache a result, evicting older ones to stay within max_bytes"""
+        size = int(result.memory_usage(deep=True, index=True).sum())
+        if size > self.max_bytes:
+            self.logger.debug(f"Result of {size} bytes is too large to cache")
+            return
+
+        key = (fingerprint, source)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= previous[1]
+            self._entries[key] = (result, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+
+    def discard_fingerprint(self, fingerprint):
+        """Drop every result computed on a dataset version"""
+        with self._lock:
+            stale = [key for key in self._entries if key[0] == fingerprint]
+            for key in stale:
+                self.current_bytes -= self._entries.pop(key)[1]
+        if stale:
+            self.logger.info(f"Discarded {len(stale)} cached results for dataset {fingerprint}")
+
+    def clear(self):
+        """Remove every cached result"""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,175 @@
+import numpy as np
+import pandas as pd
+
+# Rough size of an LLM token in characters, good enough for budgeting prompts
+CHARS_PER_TOKEN = 4
+# Longest rendering of a single value in the digest
+MAX_VALUE_CHARS = 40
+
+
+def estimate_tokens(text):
+    """Approximate the number of LLM tokens in text"""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def _format_value(value):
+    if isinstance(value, (float, np.floating)):
+        if np.isnan(value):
+            return 'null'
+        return f"{value:.6g}"
+    text = str(value)
+    return text if len(text) <= MAX_VALUE_CHARS else text[:MAX_VALUE_CHARS - 3] + '...'
+
+
+def _is_numeric(series):
+    return pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series)
+
+
+def _distinct_count(series):
+    try:
+        return series.nunique()
+    except TypeError:
+        # Lists and other unhashable values
+        return series.astype(str).nunique()
+
+
+def _value_counts(series):
+    try:
+        counts = series.value_counts()
+    except TypeError:
+        counts = series.astype(str).value_counts()
+    # Categoricals report every category, including ones absent from the result
+    return counts[counts > 0]
+
+
+def _column_stats(df):
+    """
+    One line of whole-column statistics per column
+
+    Numeric statistics come from a single describe() over every numeric
+    column, so the full result is scanned once however wide it is. Columns
+    are taken by position, as results can repeat a column name.
+
+    Returns:
+        list: (column name, line) per column, in column order
+    """
+    numeric = [i for i in range(df.shape[1]) if _is_numeric(df.iloc[:, i])]
+    described = df.iloc[:, numeric].describe().T if numeric else None
+    # Row of described for each numeric column position
+    described_rows = {position: row for row, position in enumerate(numeric)}
+    nulls = df.isna().sum().to_numpy()
+
+    lines = []
+    for i, col in enumerate(df.columns):
+        series = df.iloc[:, i]
+        details = [str(series.dtype)]
+        if nulls[i]:
+            details.append(f"{int(nulls[i])} null")
+        if i in described_rows:
+            stats = described.iloc[described_rows[i]]
+            details.append(
+                f"mean {_format_value(stats['mean'])}, std {_format_value(stats['std'])}, "
+                f"min {_format_value(stats['min'])}, median {_format_value(stats['50%'])}, "
+                f"max {_format_value(stats['max'])}, sum {_format_value(series.sum())}"
+            )
+        elif pd.api.types.is_datetime64_any_dtype(series):
+            details.append(f"from {_format_value(series.min())} to {_format_value(series.max())}")
+        else:
+            details.append(f"{_distinct_count(series)} distinct")
+        lines.append((col, f"- {col}: {', '.join(details)}"))
+    return lines
+
+
+def _column_detail(series, top_k, bins):
+    """Top values for categorical columns, a histogram for numeric ones"""
+    non_null = series.dropna()
+    if non_null.empty:
+        return None
+    if _is_numeric(series):
+        if non_null.nunique() <= top_k:
+            counts = _value_counts(non_null)
+        else:
+            counts, edges = np.histogram(non_null.to_numpy(dtype=float), bins=bins)
+            ranges = ', '.join(f"[{_format_value(edges[i])}, {_format_value(edges[i + 1])}]: {int(count)}"
+                               for i, count in enumerate(counts))
+            return f"- {series.name} distribution: {ranges}"
+    elif pd.api.types.is_datetime64_any_dtype(series):
+        return None
+    else:
+        counts = _value_counts(non_null)
+    top = counts.head(top_k)
+    values = ', '.join(f"{_format_value(value)} ({int(count)})" for value, count in top.items())
+    rest = len(counts) - len(top)
+    if rest > 0:
+        values += f", ... {rest} more values ({int(counts.iloc[len(top):].sum())} rows)"
+    return f"- {series.name} top values: {values}"
+
+
+def digest_result(df, max_tokens=800, top_k=5, bins=5, sample_rows=3):
+    """
+    Describe a query result for the LLM within a token budget
+
+    Results that fit the budget are sent verbatim. Larger ones are summarised
+    from the full result instead of the first few rows: whole-column
+    statistics first, then top values or histograms, then a few sample rows,
+    each added only while the budget allows. Columns that don't fit at all
+    are listed by name.
+
+    Args:
+        df (DataFrame): The query result
+        max_tokens (int): Approximate token budget for the digest
+        top_k (int): Values listed per categorical column
+        bins (int): Histogram buckets per numeric column
+        sample_rows (int): Example rows included when there is room
+
+    Returns:
+        str: Text to send to the LLM in place of the raw rows
+    """
+    if df.empty:
+        return f"The result is empty (columns: {', '.join(map(str, df.columns))})"
+
+    # Cheap size check before rendering a large frame in full
+    if df.size <= max_tokens:
+        full = df.to_string()
+        if estimate_tokens(full) <= max_tokens:
+            return full
+
+    budget = max_tokens * CHARS_PER_TOKEN
+    parts = [f"{len(df)} rows x {len(df.columns)} columns. Statistics over all rows:"]
+    used = len(parts[0])
+
+    omitted = set()
+    for i, (col, line) in enumerate(_column_stats(df)):
+        if used + len(line) + 1 > budget:
+            omitted.add(i)
+            continue
+        parts.append(line)
+        used += len(line) + 1
+    if omitted:
+        line = f"- ... {len(omitted)} more columns: {', '.join(str(df.columns[i]) for i in sorted(omitted))}"
+        if used + len(line) + 1 > budget:
+            line = f"- ... {len(omitted)} more columns"
+        parts.append(line)
+        used += len(line) + 1
+
+    details = []
+    used += 25  # "Value distributions:" heading
+    for i in range(df.shape[1]):
+        if used >= budget:
+            break
+        if i in omitted:
+            continue
+        line = _column_detail(df.iloc[:, i], top_k, bins)
+        if line is not None and used + len(line) + 1 <= budget:
+            details.append(line)
+            used += len(line) + 1
+    if details:
+        parts.append("\nValue distributions:")
+        parts.extend(details)
+
+    sample = df.head(sample_rows).to_string(max_colwidth=MAX_VALUE_CHARS)
+    if used + len(sample) + 20 <= budget:
+        parts.append("\nFirst rows:")
+        parts.append(sample)
+
+    return '\n'.join(parts)
@@ -0,0 +1,142 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from .logger_config import setup_logging
+from .serializer import encode_columnar
+
+
+class StoredResult:
+    """A query result held for paging, with the row orders computed for sorting"""
+
+    def __init__(self, df):
+        self.df = df
+        self.size = int(df.memory_usage(deep=True, index=True).sum())
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        # (column, ascending) -> row positions in sorted order
+        self.orders = {}
+
+
+class ResultStore:
+    """
+    Holds query results server-side so clients can page through them
+
+    A query response carries only the first page of rows plus a result_id;
+    further pages are fetched by id with an offset and limit, optionally
+    sorted on a column. Results expire ttl seconds after their last use and
+    the least recently used ones are dropped once their total memory exceeds
+    max_bytes.
+    """
+
+    def __init__(self, max_bytes=512 * 1024 * 1024, ttl=1800):
+        """
+        Args:
+            max_bytes (int): Upper bound on the total memory of stored results
+            ttl (int): Seconds a result stays available after it was last read
+        """
+        self.logger = setup_logging('FlaskApp')
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.current_bytes = 0
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        while self._results:
+            result_id, entry = next(iter(self._results.items()))
+            if self.current_bytes <= self.max_bytes and now - entry.last_used <= self.ttl:
+                break
+            del self._results[result_id]
+            self.current_bytes -= entry.size
+
+    def put(self, df):
+        """Store a result and return its id, or None if it's too large to keep"""
+        entry = StoredResult(df)
+        if entry.size > self.max_bytes:
+            self.logger.warning(f"Result of {entry.size} bytes exceeds the result store budget")
+            return None
+        result_id = uuid.uuid4().hex
+        with self._lock:
+            self._results[result_id] = entry
+            self.current_bytes += entry.size
+            self._evict(time.time())
+        return result_id
+
+    def get(self, result_id):
+        """Return the stored DataFrame, or None if it expired or never existed"""
+        entry = self._entry(result_id)
+        return entry.df if entry is not None else None
+
+    def _entry(self, result_id):
+        now = time.time()
+        with self._lock:
+            self._evict(now)
+            entry = self._results.get(result_id)
+            if entry is None:
+                return None
+            entry.last_used = now
+            self._results.move_to_end(result_id)
+            return entry
+
+    def page(self, result_id, offset=0, limit=100, sort_by=None, ascending=True, as_frame=False):
+        """
+        Return one page of a stored result as a columnar JSON-ready dict
+
+        With as_frame the page's rows are returned as a DataFrame under 'rows'
+        instead of being encoded, for responses sent as Arrow.
+
+        Raises:
+            KeyError: If the result expired or doesn't exist
+            ValueError: If sort_by isn't one of the result's columns
+        """
+        entry = self._entry(result_id)
+        if entry is None:
+            raise KeyError(result_id)
+        return self._page(result_id, entry, offset, limit, sort_by, ascending, as_frame)
+
+    def _page(self, result_id, entry, offset, limit, sort_by, ascending, as_frame=False):
+        df = entry.df
+        offset = max(int(offset), 0)
+        limit = max(int(limit), 0)
+
+        if sort_by is not None:
+            columns = {str(col): col for col in df.columns}
+            if sort_by not in columns:
+                raise ValueError(f"Unknown sort column: {sort_by}")
+            key = (sort_by, ascending)
+            order = entry.orders.get(key)
+            if order is None:
+                # Sort once per column and direction; later pages just slice
+                order = (df[columns[sort_by]].reset_index(drop=True)
+                         .sort_values(ascending=ascending, kind='stable', na_position='last')
+                         .index.to_numpy())
+                entry.orders[key] = order
+            rows = df.iloc[order[offset:offset + limit]]
+        else:
+            rows = df.iloc[offset:offset + limit]
+
+        page = {
+            'result_id': result_id,
+            'total_rows': len(df),
+            'offset': offset,
+            'limit': limit,
+            'sort_by': sort_by,
+            'ascending': ascending,
+        }
+        if as_frame:
+            page['rows'] = rows
+        else:
+            page.update(encode_columnar(rows))
+        return page
+
+    def put_and_page(self, df, limit=100, as_frame=False):
+        """Store a result and return its first page"""
+        result_id = self.put(df)
+        entry = self._entry(result_id) if result_id is not None else None
+        if entry is None:
+            # Too large to keep; still return the first page inline
+            entry = StoredResult(df)
+            result_id = None
+        return self._page(result_id, entry, 0, limit, None, True, as_frame)
@@ -0,0 +1,168 @@
+import ast
+import math
+import re
+from collections import Counter
+
+from .query_cache import STOPWORDS
+from .query_executor import ALLOWED_ATTRIBUTES, FRAME_NAMES, is_column_attribute, strip_code_fences
+from .sql_engine import strip_sql_fences
+
+# Column name terms count this many times more than sample values
+NAME_WEIGHT = 3
+
+# Call arguments and keywords that name columns in generated pandas code
+COLUMN_METHODS = {'groupby', 'sort_values', 'set_index', 'drop_duplicates', 'dropna',
+                  'pivot_table', 'pivot', 'melt', 'nlargest', 'nsmallest'}
+COLUMN_KEYWORDS = {'by', 'columns', 'subset', 'on', 'values', 'index', 'id_vars', 'value_vars'}
+
+SQL_IDENTIFIER = re.compile(r'"((?:[^"]|"")+)"')
+SQL_ALIAS = re.compile(r'\bAS\s+"(?:[^"]|"")+"', re.IGNORECASE)
+SQL_STRING = re.compile(r"'(?:[^']|'')*'")
+SQL_WORD = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+def tokenize(text):
+    """
+    Split text into lowercase search terms
+
+    camelCase, snake_case and letter/digit boundaries are split so that
+    'totalRevenue_2023' matches a question about 'total revenue in 2023'.
+    """
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", str(text))
+    text = re.sub(r"([A-Za-z])([0-9])|([0-9])([A-Za-z])", r"\1\3 \2\4", text)
+    terms = []
+    for term in re.findall(r"[a-z0-9]+", text.lower()):
+        if term in STOPWORDS:
+            continue
+        # Crude plural folding so 'companies' and 'company' meet halfway
+        if len(term) > 3 and term.endswith('ies'):
+            term = term[:-3] + 'y'
+        elif len(term) > 3 and term.endswith('s') and not term.endswith('ss'):
+            term = term[:-1]
+        terms.append(term)
+    return terms
+
+
+class ColumnIndex:
+    """
+    BM25 index over a dataset's columns, built from its profile
+
+    Each column is a document made of its name (weighted up), dtype, sample
+    values and most common values. Built once per dataset version, so ranking
+    the columns for a question is a dictionary lookup per question term.
+    """
+
+    def __init__(self, profile, k1=1.2, b=0.75):
+        """
+        Args:
+            profile (dict): Dataset profile from profiler.profile_dataframe
+            k1 (float): BM25 term frequency saturation
+            b (float): BM25 document length normalisation
+        """
+        self.columns = [column['name'] for column in profile['columns']]
+        self.k1 = k1
+        self.b = b
+        self._terms = []
+        for column in profile['columns']:
+            terms = tokenize(column['name']) * NAME_WEIGHT + tokenize(column['dtype'])
+            for value in column['samples']:
+                terms += tokenize(value)
+            for value, _ in column['top_values']:
+                terms += tokenize(value)
+            self._terms.append(Counter(terms))
+        self._lengths = [sum(terms.values()) for terms in self._terms]
+        self._average_length = (sum(self._lengths) / len(self._lengths)) if self._lengths else 0
+        document_frequency = Counter(term for terms in self._terms for term in terms)
+        count = len(self._terms)
+        self._idf = {term: math.log(1 + (count - frequency + 0.5) / (frequency + 0.5))
+                     for term, frequency in document_frequency.items()}
+
+    def scores(self, text):
+        """Return the BM25 score of every column for text, in column order"""
+        terms = [term for term in tokenize(text) if term in self._idf]
+        scores = []
+        for terms_in_column, length in zip(self._terms, self._lengths):
+            score = 0.0
+            for term in terms:
+                frequency = terms_in_column.get(term)
+                if frequency:
+                    norm = self.k1 * (1 - self.b + self.b * length / (self._average_length or 1))
+                    score += self._idf[term] * frequency * (self.k1 + 1) / (frequency + norm)
+            scores.append(score)
+        return scores
+
+    def rank(self, text):
+        """Return column names, most relevant to text first; ties keep dataset order"""
+        scores = self.scores(text)
+        order = sorted(range(len(self.columns)), key=lambda index: -scores[index])
+        return [self.columns[index] for index in order]
+
+
+class SchemaSelection:
+    """The schema prompt shown to the LLM for one question"""
+
+    def __init__(self, text, columns, pruned):
+        self.text = text
+        # Columns described in text, in dataset order
+        self.columns = columns
+        # Whether some of the dataset's columns were left out
+        self.pruned = pruned
+
+
+def _pandas_column_references(code):
+    try:
+        tree = ast.parse(strip_code_fences(code))
+    except SyntaxError:
+        return []
+
+    def constants(node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            return [node.value]
+        if isinstance(node, (ast.List, ast.Tuple)):
+            return [value for element in node.elts for value in constants(element)]
+        return []
+
+    references = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Subscript):
+            references += constants(node.slice)
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+            if node.func.attr in COLUMN_METHODS and node.args:
+                references += constants(node.args[0])
+            for keyword in node.keywords:
+                if keyword.arg in COLUMN_KEYWORDS:
+                    references += constants(keyword.value)
+        elif isinstance(node, ast.Attribute) and node.attr not in ALLOWED_ATTRIBUTES \
+                and is_column_attribute(node.attr) and isinstance(node.value, ast.Name) and node.value.id in FRAME_NAMES:
+            references.append(node.attr)
+    return references
+
+
+def _sql_column_references(code, columns):
+    # String literals hold values, and aliases name output columns, not dataset columns
+    sql = SQL_ALIAS.sub(' ', SQL_STRING.sub(' ', strip_sql_fences(code)))
+    references = [name.replace('""', '"') for name in SQL_IDENTIFIER.findall(sql)]
+    # Unquoted words can only be matched against real column names
+    by_lower = {str(column).lower(): column for column in columns}
+    unquoted = SQL_IDENTIFIER.sub(' ', sql)
+    references += [by_lower[word.lower()] for word in SQL_WORD.findall(unquoted) if word.lower() in by_lower]
+    return references
+
+
+def column_references(code, columns, engine='pandas'):
+    """
+    Return the column names generated code refers to, in order of appearance
+
+    Names that aren't columns of the dataset are included too, since they
+    usually mean the LLM guessed at a column it wasn't shown.
+
+    Args:
+        code (str): Generated pandas code or SQL
+        columns (list): Column names of the dataset
+        engine (str): 'pandas' or 'duckdb'
+    """
+    if engine == 'duckdb':
+        references = _sql_column_references(code, columns)
+    else:
+        references = _pandas_column_references(code)
+    return list(dict.fromkeys(references))
@@ -0,0 +1,176 @@
+import datetime
+import decimal
+import gzip
+import json
+
+import numpy as np
+import pandas as pd
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+
+try:
+    import pyarrow as pa
+except ImportError:  # pragma: no cover - pyarrow is optional
+    pa = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+# Media type of Arrow IPC streams, sent instead of JSON to clients that ask for it
+ARROW_STREAM_TYPE = 'application/vnd.apache.arrow.stream'
+
+# Schema metadata key holding the JSON fields of an Arrow response
+ARROW_METADATA_KEY = b'response'
+
+# Low settings: higher ones cost far more CPU than they save on JSON
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+
+def _default(value):
+    """Encode the values neither orjson nor the json module know"""
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is pd.NaT or value is pd.NA:
+        return None
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    return str(value)
+
+
+def dumps(obj):
+    """
+    Encode obj as JSON bytes
+
+    Uses orjson when it's installed, which also encodes the NumPy arrays
+    column_values returns without converting them to lists first.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=_default, separators=(',', ':')).encode('utf-8')
+
+
+def _with_nulls(values, missing):
+    values = values.astype(object)
+    values[missing] = None
+    return values.tolist()
+
+
+def _timestamps(values):
+    """ISO strings with milliseconds, as DataFrame.to_json(date_format='iso') writes them"""
+    return _with_nulls(np.datetime_as_string(values, unit='ms'), np.isnat(values))
+
+
+def column_values(series):
+    """
+    Return the JSON-ready values of one column
+
+    Numeric columns come back as NumPy arrays when orjson is installed, which
+    it encodes directly with NaN and infinity as null; everything else is a
+    list with missing values as None. Timestamps become ISO strings (UTC for
+    time zone aware columns) and categoricals are encoded once per category.
+    """
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        lookup = np.empty(len(dtype.categories) + 1, dtype=object)
+        lookup[:-1] = column_values(pd.Series(dtype.categories))
+        # Code -1 (missing) takes the trailing None
+        return lookup[series.cat.codes.to_numpy()].tolist()
+    if isinstance(dtype, pd.DatetimeTZDtype):
+        return _timestamps(series.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy())
+
+    if isinstance(dtype, np.dtype):
+        values = series.to_numpy()
+        if dtype.kind == 'M':
+            return _timestamps(values)
+        if dtype.kind in 'biuf':
+            if dtype == np.float16:
+                # orjson encodes float32 and wider only
+                values = values.astype(np.float32)
+            if orjson is not None:
+                return np.ascontiguousarray(values)
+            if dtype.kind == 'f':
+                return _with_nulls(values, ~np.isfinite(values))
+            return values.tolist()
+        if dtype.kind == 'O':
+            return _with_nulls(values, series.isna().to_numpy())
+    elif isinstance(dtype, pd.StringDtype) or pd.api.types.is_numeric_dtype(dtype):
+        # Nullable integers, floats, booleans and strings
+        return _with_nulls(series.to_numpy(dtype=object), series.isna().to_numpy())
+
+    # Timedeltas, periods, intervals: let pandas render them
+    return json.loads(series.to_json(orient='values', date_format='iso'))
+
+
+def encode_columnar(df):
+    """
+    Encode a DataFrame as column names plus one value list per column
+
+    Column-major lists repeat no keys per row, so they are much smaller than
+    records, and NaN, timestamps and numpy scalars become valid JSON.
+    """
+    return {
+        'columns': [str(col) for col in df.columns],
+        'data': [column_values(df.iloc[:, i]) for i in range(df.shape[1])],
+    }
+
+
+def arrow_stream(df, metadata=None):
+    """
+    Encode a DataFrame as an Arrow IPC stream
+
+    Args:
+        df (DataFrame): Rows to send
+        metadata (dict): JSON-ready fields stored in the schema metadata under
+            ARROW_METADATA_KEY, e.g. the answer and result id
+
+    Returns:
+        bytes, or None if pyarrow is missing or can't convert the frame
+    """
+    if pa is None:
+        return None
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowException, ValueError, TypeError):
+        return None
+    if metadata is not None:
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), ARROW_METADATA_KEY: dumps(metadata)})
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def choose_encoding(accepted):
+    """
+    Pick the response compression a client accepts
+
+    Args:
+        accepted: Accept-Encoding qualities, e.g. Flask's request.accept_encodings
+
+    Returns:
+        'br', 'gzip' or None
+    """
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress(body, encoding):
+    """Compress a response body with the encoding choose_encoding picked"""
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
@@ -0,0 +1,222 @@
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+from .logger_config import setup_logging
+from .result_digest import estimate_tokens
+
+# Name follow-up code uses for the previous result of a conversation
+PREVIOUS_RESULT_NAME = 'prev'
+
+# Longest answer, and most result columns, quoted per turn in a conversation digest
+DIGEST_ANSWER_CHARS = 200
+DIGEST_MAX_COLUMNS = 20
+
+# Words that point back at earlier turns, as in "sort those by date" or "what about Ford?"
+FOLLOW_UP_PATTERN = re.compile(
+    r"\b(it|its|they|them|their|those|these|that|this|same|previous|above|earlier|instead|also|too|"
+    r"else|again|ones?|only|then|what about|how about)\b|^\W*(and|but|or|now|so)\b",
+    re.IGNORECASE
+)
+# Questions this short are usually elliptical, e.g. "By month?"
+FOLLOW_UP_MAX_WORDS = 3
+
+PREVIOUS_RESULT_REFERENCE = re.compile(rf"\b{PREVIOUS_RESULT_NAME}\b")
+
+
+def is_follow_up(question):
+    """
+    Whether a question reads as depending on the conversation before it
+
+    Errs towards yes: a follow-up answered from a plan cached for the same
+    words asked on their own would be wrong, while a standalone question
+    taken for a follow-up only misses the cache.
+    """
+    return len(question.split()) <= FOLLOW_UP_MAX_WORDS or FOLLOW_UP_PATTERN.search(question) is not None
+
+
+def reads_previous_result(query_code):
+    """Whether generated code (pandas or SQL) mentions the previous result"""
+    return PREVIOUS_RESULT_REFERENCE.search(query_code) is not None
+
+
+class Turn:
+    """One answered question of a conversation"""
+
+    def __init__(self, question, question_type, query_code=None, result_shape=None, result_columns=None,
+                 answer=None):
+        self.question = question
+        self.question_type = question_type
+        self.query_code = query_code
+        self.result_shape = result_shape
+        self.result_columns = result_columns
+        self.answer = answer
+
+    def describe(self, number):
+        """Render the turn as a few lines of a conversation digest"""
+        lines = [f"{number}. Q: {self.question}"]
+        if self.query_code:
+            lines.append(f"   Code: {' '.join(self.query_code.split())}")
+        if self.result_shape is not None:
+            columns = ', '.join(map(str, self.result_columns[:DIGEST_MAX_COLUMNS]))
+            if len(self.result_columns) > DIGEST_MAX_COLUMNS:
+                columns += f" and {len(self.result_columns) - DIGEST_MAX_COLUMNS} more"
+            lines.append(f"   Result: {self.result_shape[0]} rows; columns: {columns}")
+        elif self.answer:
+            answer = ' '.join(self.answer.split())
+            if len(answer) > DIGEST_ANSWER_CHARS:
+                answer = answer[:DIGEST_ANSWER_CHARS].rstrip() + '...'
+            lines.append(f"   Answer: {answer}")
+        return '\n'.join(lines)
+
+
+def describe_result(df, max_columns=40):
+    """One-line description of a previous result for follow-up prompts"""
+    columns = ', '.join(f"{column} ({dtype})" for column, dtype in list(df.dtypes.items())[:max_columns])
+    if df.shape[1] > max_columns:
+        columns += f" and {df.shape[1] - max_columns} more"
+    return f"{len(df)} rows; columns: {columns}"
+
+
+class ConversationContext:
+    """What a follow-up question knows of its conversation"""
+
+    def __init__(self, digest, prev=None):
+        """
+        Args:
+            digest (str): Compact description of the earlier turns
+            prev (DataFrame): Result of the most recent data question, if kept
+        """
+        self.digest = digest
+        self.prev = prev
+
+    @property
+    def variables(self):
+        """Names follow-up code may read besides df and pd"""
+        return {PREVIOUS_RESULT_NAME: self.prev} if self.prev is not None else None
+
+
+class Session:
+    """Turns of one conversation and the last result it produced"""
+
+    def __init__(self, max_turns):
+        self.turns = deque(maxlen=max_turns)
+        self.result = None
+        self.result_size = 0
+        self.last_used = time.time()
+
+
+class SessionStore:
+    """
+    Conversation state for multi-turn questions
+
+    Each session keeps its most recent turns (question, generated code and
+    the shape of the result or a clipped answer) and the DataFrame of its
+    last data question. Follow-up questions get a compact digest of those
+    turns in their prompts and can be answered with code that reads the
+    previous result as `prev`, which is usually far smaller than the dataset.
+
+    Sessions expire ttl seconds after their last question; the least recently
+    used ones are dropped when there are more than max_sessions or their kept
+    results use more than max_bytes.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, max_sessions=1000, ttl=3600, max_turns=10,
+                 digest_max_tokens=400):
+        """
+        Args:
+            max_bytes (int): Upper bound on the total memory of kept results
+            max_sessions (int): Most sessions kept at once
+            ttl (int): Seconds a session survives without a question
+            max_turns (int): Turns remembered per session
+            digest_max_tokens (int): Approximate token budget for a conversation digest
+        """
+        self.logger = setup_logging('ExcelQuerySystem')
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_turns = max_turns
+        self.digest_max_tokens = digest_max_tokens
+        self.current_bytes = 0
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _drop(self, key):
+        session = self._sessions.pop(key)
+        self.current_bytes -= session.result_size
+
+    def _evict(self, now):
+        while self._sessions:
+            key, session = next(iter(self._sessions.items()))
+            if (len(self._sessions) <= self.max_sessions and self.current_bytes <= self.max_bytes
+                    and now - session.last_used <= self.ttl):
+                break
+            self._drop(key)
+
+    def _digest(self, turns):
+        """Describe the most recent turns that fit in the token budget, oldest first"""
+        described = []
+        for number, turn in reversed(list(enumerate(turns, 1))):
+            candidate = [turn.describe(number)] + described
+            if described and estimate_tokens('\n'.join(candidate)) > self.digest_max_tokens:
+                break
+            described = candidate
+        return "Earlier in this conversation:\n" + '\n'.join(described)
+
+    def context(self, key):
+        """
+        Return what the next question of a session knows of the conversation
+
+        Returns:
+            ConversationContext, or None for a new or expired session
+        """
+        now = time.time()
+        with self._lock:
+            self._evict(now)
+            session = self._sessions.get(key)
+            if session is None or not session.turns:
+                return None
+            session.last_used = now
+            self._sessions.move_to_end(key)
+            turns, result = list(session.turns), session.result
+        return ConversationContext(self._digest(turns), result)
+
+    def record(self, key, turn, result=None):
+        """
+        Add an answered question to a session, creating the session if needed
+
+        Args:
+            key: Session key
+            turn (Turn): The question and how it was answered
+            result (DataFrame): Result of a data question; becomes the session's
+                previous result (None keeps the one from an earlier turn)
+        """
+        size = int(result.memory_usage(deep=True, index=True).sum()) if result is not None else 0
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = self._sessions[key] = Session(self.max_turns)
+            session.turns.append(turn)
+            session.last_used = now
+            self._sessions.move_to_end(key)
+            if result is not None:
+                self.current_bytes -= session.result_size
+                session.result, session.result_size = None, 0
+                if size <= self.max_bytes:
+                    session.result, session.result_size = result, size
+                    self.current_bytes += size
+                else:
+                    self.logger.warning(f"Result of {size} bytes exceeds the session budget; "
+                                        f"follow-ups will query the full dataset")
+            self._evict(now)
+
+    def discard(self, key):
+        """Forget a session"""
+        with self._lock:
+            if key in self._sessions:
+                self._drop(key)
+
+    def __len__(self):
+        return len(self._sessions)
@@ -0,0 +1,234 @@
+import glob
+import os
+import re
+import threading
+
+from .dataset_store import cache_file_prefix
+from .logger_config import setup_logging
+from .profiler import profile_sql
+from .query_executor import QueryTimeoutError, QueryValidationError
+
+try:
+    import duckdb
+except ImportError:  # pragma: no cover - duckdb is optional
+    duckdb = None
+
+# Name of the view generated SQL queries read from
+TABLE_NAME = 'data'
+
+SQL_CODE_FENCE = re.compile(r"^\s*```(?:sql)?\s*\n?(.*?)\n?\s*```\s*$", re.DOTALL | re.IGNORECASE)
+
+
+def strip_sql_fences(query_code):
+    """Remove the markdown code fence and trailing semicolon LLMs add to SQL"""
+    match = SQL_CODE_FENCE.match(query_code)
+    sql = match.group(1) if match else query_code
+    return sql.strip().rstrip(';').strip()
+
+
+class CompiledSql:
+    """Validated form of a generated SQL query"""
+
+    def __init__(self, sql, source):
+        self.sql = sql
+        # Canonical source; whitespace differences in the generated SQL don't change it
+        self.source = source
+
+
+class SqlQueryEngine:
+    """
+    Validates and runs LLM-generated SQL on DuckDB
+
+    Queries run against a view named `data` over the dataset file, so DuckDB
+    scans it with all cores and can spill large aggregations to disk instead
+    of holding the whole dataset in memory. When a cache directory is given
+    the CSV is converted once per dataset fingerprint to Parquet, which DuckDB
+    reads column by column. Only a single SELECT statement is accepted, and
+    the connection can read nothing but the dataset file.
+
+    Has the same compile/execute interface as QueryExecutor, so it can stand
+    in for it; execute ignores the DataFrame it's given. The dataset profile
+    behind the schema prompt comes from DuckDB as well, so the dataset is
+    never loaded into pandas.
+    """
+
+    def __init__(self, source_path, cache_dir=None, max_rows=None, timeout=None, threads=None, memory_limit=None):
+        """
+        Args:
+            source_path (str): Path to the CSV or Parquet file
+            cache_dir (str): Directory for the Parquet copy of a CSV (None scans the CSV directly)
+            max_rows (int): Results longer than this are truncated (None for no limit)
+            timeout (float): Seconds a query may run before it is interrupted (None for no limit)
+            threads (int): DuckDB worker threads (None uses every core)
+            memory_limit (str): DuckDB memory limit such as '4GB'; larger operations spill to disk
+        """
+        if duckdb is None:
+            raise ValueError("The duckdb query engine requires the duckdb package")
+        self.logger = setup_logging('ExcelQuerySystem')
+        self.source_path = source_path
+        self.cache_dir = cache_dir
+        self.max_rows = max_rows
+        self.timeout = timeout
+        self.threads = threads
+        self.memory_limit = memory_limit
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _parquet_path(self, fingerprint):
+        return os.path.join(self.cache_dir, f"{cache_file_prefix(self.source_path)}-{fingerprint}.parquet")
+
+    def _build_parquet(self, path):
+        """Convert the CSV to Parquet, replacing copies of older versions"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        conn = duckdb.connect()
+        try:
+            conn.execute(
+                "COPY (SELECT * FROM read_csv_auto(?)) TO '" + tmp_path.replace("'", "''") + "' (FORMAT parquet)",
+                [self.source_path]
+            )
+        finally:
+            conn.close()
+        os.replace(tmp_path, path)
+        self.logger.info(f"Parquet copy written to {path}")
+
+        # Drop copies of older versions of the same source file
+        prefix = os.path.join(self.cache_dir, cache_file_prefix(self.source_path))
+        for stale_path in glob.glob(f"{glob.escape(prefix)}-{'?' * 16}.parquet"):
+            if stale_path != path:
+                os.remove(stale_path)
+
+    def _scan_path(self, fingerprint):
+        """Return the file queries should scan for a dataset version"""
+        if self.source_path.lower().endswith('.parquet') or self.cache_dir is None or fingerprint is None:
+            return self.source_path
+        path = self._parquet_path(fingerprint)
+        if not os.path.exists(path):
+            try:
+                self._build_parquet(path)
+            except (OSError, duckdb.Error) as e:
+                self.logger.warning(f"Could not build Parquet copy, scanning the CSV instead: {str(e)}")
+                return self.source_path
+        return path
+
+    def _connect(self, path):
+        config = {}
+        if self.threads:
+            config['threads'] = self.threads
+        if self.memory_limit:
+            config['memory_limit'] = self.memory_limit
+        if self.cache_dir is not None:
+            config['temp_directory'] = os.path.join(self.cache_dir, 'duckdb_tmp')
+        conn = duckdb.connect(config=config)
+
+        reader = 'read_parquet' if path.lower().endswith('.parquet') else 'read_csv_auto'
+        quoted = path.replace("'", "''")
+        conn.execute(f"CREATE VIEW {TABLE_NAME} AS SELECT * FROM {reader}('{quoted}')")
+        # Generated SQL may read the dataset file and nothing else
+        conn.execute(f"SET allowed_paths = ['{quoted}']")
+        conn.execute("SET enable_external_access = false")
+        conn.execute("SET lock_configuration = true")
+        return conn
+
+    def attach(self, fingerprint=None):
+        """
+        Point the `data` view at a dataset version
+
+        Queries already running keep the connection they started on.
+
+        Args:
+            fingerprint (str): Dataset fingerprint from dataset_store.dataset_fingerprint
+        """
+        path = self._scan_path(fingerprint)
+        conn = self._connect(path)
+        with self._lock:
+            # Not closed explicitly: cursors still running on it keep it alive
+            self._conn = conn
+        self.logger.info(f"SQL engine attached to {path}")
+
+    def profile(self, fingerprint=None):
+        """
+        Profile a dataset version with DuckDB (see profiler.profile_sql)
+
+        Builds the Parquet copy for the version if needed but leaves the
+        attached version alone, so a reload can profile the new file while
+        queries still run on the old one.
+
+        Args:
+            fingerprint (str): Dataset fingerprint from dataset_store.dataset_fingerprint
+        """
+        path = self._scan_path(fingerprint)
+        self.logger.info(f"Profiling {path} with DuckDB")
+        conn = self._connect(path)
+        try:
+            return profile_sql(conn, TABLE_NAME)
+        finally:
+            conn.close()
+
+    def compile(self, query_code, names=()):
+        """
+        Check that generated code is a single SELECT statement
+
+        names is accepted for symmetry with QueryExecutor; tables the query
+        names are resolved by DuckDB when it runs.
+
+        Returns:
+            CompiledSql
+        """
+        sql = strip_sql_fences(query_code)
+        if not sql:
+            raise QueryValidationError("Query is empty")
+
+        try:
+            statements = duckdb.extract_statements(sql)
+        except duckdb.Error as e:
+            raise QueryValidationError(f"Invalid SQL: {str(e)}")
+        if len(statements) != 1:
+            raise QueryValidationError("Only a single SQL statement is allowed")
+        if statements[0].type != duckdb.StatementType.SELECT:
+            raise QueryValidationError("Only SELECT statements are allowed")
+        return CompiledSql(sql, ' '.join(sql.split()))
+
+    def execute(self, query_code, df=None, index=None, variables=None, cancel=None):
+        """
+        Run generated SQL against the attached dataset
+
+        df, index and cancel are accepted for symmetry with QueryExecutor and
+        ignored; DuckDB reads the attached dataset and plans its own filters.
+
+        Args:
+            variables (dict): DataFrames the query may read as tables by name,
+                e.g. {'prev': previous_result} for a follow-up question
+
+        Returns:
+            DataFrame: The query result, truncated to max_rows
+        """
+        compiled = self.compile(query_code)
+        with self._lock:
+            if self._conn is None:
+                raise ValueError("SQL engine has no dataset attached")
+            cursor = self._conn.cursor()
+        for name, frame in (variables or {}).items():
+            cursor.register(name, frame)
+
+        timer = None
+        if self.timeout:
+            timer = threading.Timer(self.timeout, cursor.interrupt)
+            timer.daemon = True
+            timer.start()
+        try:
+            relation = cursor.sql(compiled.sql)
+            if self.max_rows is not None:
+                relation = relation.limit(self.max_rows + 1)
+            result = relation.df()
+        except duckdb.InterruptException:
+            raise QueryTimeoutError(f"Query exceeded the {self.timeout}s time limit")
+        finally:
+            if timer is not None:
+                timer.cancel()
+            cursor.close()
+
+        if self.max_rows is not None and len(result) > self.max_rows:
+            self.logger.warning(f"Truncating query result to {self.max_rows} rows")
+            result = result.head(self.max_rows)
+        return result
@@ -0,0 +1,227 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .logger_config import SharedRotatingFileHandler, setup_logging
+
+try:
+    import prometheus_client
+except ImportError:  # pragma: no cover - prometheus_client is optional
+    prometheus_client = None
+
+# Histogram buckets in seconds, from cached pandas lookups up to slow LLM calls
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_current_trace = contextvars.ContextVar('trace', default=None)
+_current_span = contextvars.ContextVar('span', default=None)
+
+
+class Span:
+    """One timed stage of a request, such as classify, codegen or execute"""
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.duration = None
+
+    def to_dict(self, origin):
+        return {
+            'stage': self.name,
+            'start_ms': round((self.start - origin) * 1000, 2),
+            'duration_ms': round(self.duration * 1000, 2) if self.duration is not None else None,
+            **self.attributes,
+        }
+
+
+class Trace:
+    """The spans and attributes recorded for one request"""
+
+    def __init__(self, telemetry, request_id, endpoint, attributes):
+        self.telemetry = telemetry
+        self.request_id = request_id
+        self.endpoint = endpoint
+        self.attributes = attributes
+        self.spans = []
+        self.start = time.perf_counter()
+        self.duration = None
+        self._lock = threading.Lock()
+
+    def add_span(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def to_dict(self):
+        with self._lock:
+            spans = [span.to_dict(self.start) for span in self.spans]
+        return {
+            'request_id': self.request_id,
+            'endpoint': self.endpoint,
+            'duration_ms': round(self.duration * 1000, 2) if self.duration is not None else None,
+            **self.attributes,
+            'spans': spans,
+        }
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Time a stage of the current request
+
+    Does nothing outside a trace, so the query system works the same when it's
+    used without the web app. Spans follow the request across threads and
+    event loops through context variables.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    current = Span(name, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    finally:
+        current.duration = time.perf_counter() - current.start
+        _current_span.reset(token)
+        trace.add_span(current)
+        trace.telemetry.observe_stage(name, current.duration)
+
+
+def record_tokens(usage):
+    """Add an LLM response's token usage to the current span"""
+    current = _current_span.get()
+    trace = _current_trace.get()
+    if usage is None or trace is None:
+        return
+    prompt = getattr(usage, 'prompt_tokens', 0) or 0
+    completion = getattr(usage, 'completion_tokens', 0) or 0
+    stage = current.name if current is not None else 'other'
+    if current is not None:
+        current.attributes['prompt_tokens'] = current.attributes.get('prompt_tokens', 0) + prompt
+        current.attributes['completion_tokens'] = current.attributes.get('completion_tokens', 0) + completion
+    trace.telemetry.count_tokens(stage, prompt, completion)
+
+
+def record_cache(cache, hit):
+    """Count a plan or result cache lookup and label the current span with it"""
+    current = _current_span.get()
+    if current is not None:
+        current.attributes[f'{cache}_cache'] = 'hit' if hit else 'miss'
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.telemetry.count_cache(cache, hit)
+
+
+def annotate(**attributes):
+    """Attach attributes such as the generated code or result shape to the current request"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attributes.update(attributes)
+
+
+class Telemetry:
+    """
+    Collects per-stage latency, token and cache metrics for Prometheus
+
+    Requests are wrapped in trace(), and the query system marks its stages
+    with span(). Each finished span feeds the stage latency histogram, each
+    finished trace is logged as one JSON line, and traces slower than
+    slow_query_seconds are also written to the slow query log along with the
+    generated code and result shape. Metrics are only exported when
+    prometheus_client is installed; traces and the slow query log work
+    without it.
+    """
+
+    def __init__(self, slow_query_seconds=None, slow_query_log=None):
+        """
+        Args:
+            slow_query_seconds (float): Log requests slower than this (None disables)
+            slow_query_log (str): File the slow query log is written to
+        """
+        self.logger = setup_logging('FlaskApp')
+        self.slow_query_seconds = slow_query_seconds
+        self.slow_logger = None
+        if slow_query_seconds and slow_query_log:
+            self.slow_logger = logging.getLogger('SlowQueries')
+            if not self.slow_logger.handlers:
+                os.makedirs(os.path.dirname(slow_query_log) or '.', exist_ok=True)
+                handler = SharedRotatingFileHandler(slow_query_log, maxBytes=10485760, backupCount=5)
+                handler.setFormatter(logging.Formatter('%(message)s'))
+                self.slow_logger.addHandler(handler)
+                self.slow_logger.setLevel(logging.INFO)
+                self.slow_logger.propagate = False
+
+        self.registry = None
+        if prometheus_client is not None:
+            # A registry of our own, so a second instance doesn't collide with the first
+            self.registry = prometheus_client.CollectorRegistry()
+            self.stage_seconds = prometheus_client.Histogram(
+                'query_stage_seconds', 'Time spent in each query stage',
+                ['stage'], buckets=LATENCY_BUCKETS, registry=self.registry
+            )
+            self.request_seconds = prometheus_client.Histogram(
+                'query_request_seconds', 'End-to-end request latency',
+                ['endpoint', 'status'], buckets=LATENCY_BUCKETS, registry=self.registry
+            )
+            self.llm_tokens = prometheus_client.Counter(
+                'llm_tokens', 'LLM tokens used per stage',
+                ['stage', 'kind'], registry=self.registry
+            )
+            self.cache_lookups = prometheus_client.Counter(
+                'query_cache_lookups', 'Plan and result cache lookups',
+                ['cache', 'result'], registry=self.registry
+            )
+        else:
+            self.logger.info("prometheus_client is not installed; /metrics is disabled")
+
+    @contextmanager
+    def trace(self, request_id, endpoint, **attributes):
+        """Record every span of one request, then export and log it"""
+        trace = Trace(self, request_id, endpoint, attributes)
+        token = _current_trace.set(trace)
+        try:
+            yield trace
+        except Exception as e:
+            trace.attributes.setdefault('error', str(e))
+            raise
+        finally:
+            trace.duration = time.perf_counter() - trace.start
+            _current_trace.reset(token)
+            self._finish(trace)
+
+    def _finish(self, trace):
+        status = 'error' if trace.attributes.get('error') else 'ok'
+        if self.registry is not None:
+            self.request_seconds.labels(trace.endpoint, status).observe(trace.duration)
+        record = trace.to_dict()
+        self.logger.info(f"Request ID {trace.request_id}: Trace {json.dumps(record, default=str)}")
+        if self.slow_logger is not None and trace.duration >= self.slow_query_seconds:
+            self.slow_logger.info(json.dumps(record, default=str))
+
+    def observe_stage(self, stage, seconds):
+        if self.registry is not None:
+            self.stage_seconds.labels(stage).observe(seconds)
+
+    def count_tokens(self, stage, prompt, completion):
+        if self.registry is not None:
+            self.llm_tokens.labels(stage, 'prompt').inc(prompt)
+            self.llm_tokens.labels(stage, 'completion').inc(completion)
+
+    def count_cache(self, cache, hit):
+        if self.registry is not None:
+            self.cache_lookups.labels(cache, 'hit' if hit else 'miss').inc()
+
+    def render(self):
+        """
+        Return the metrics in the Prometheus text format
+
+        Returns:
+            tuple: (body bytes, content type), or None without prometheus_client
+        """
+        if self.registry is None:
+            return None
+        return prometheus_client.generate_latest(self.registry), prometheus_client.CONTENT_TYPE_LATEST
@@ -0,0 +1,60 @@
+import pandas as pd
+import pytest
+
+from benchmarks.fake_llm import SCENARIOS, FakeLLM
+from src.query_cache import QueryCache
+from src.query_system import ExcelQuerySystem
+from src.result_cache import ResultCache
+from src.session_store import SessionStore, is_follow_up, reads_previous_result
+
+QUESTION = "What is the total revenue by region?"
+FOLLOW_UP = "Now only those with more than 1300 revenue"
+
+
+@pytest.fixture
+def system(tmp_path):
+    csv_path = tmp_path / 'orders.csv'
+    pd.DataFrame({
+        'region': ['North', 'South', 'North', 'East'],
+        'revenue': [500.0, 1500.0, 700.0, 2500.0],
+    }).to_csv(csv_path, index=False)
+    responses = {
+        QUESTION: SCENARIOS[QUESTION],
+        FOLLOW_UP: {'question_type': 'filter', 'query_code': "prev[prev['revenue'] > 1300]"},
+    }
+    client = FakeLLM(responses)
+    return ExcelQuerySystem(
+        'gpt-4', str(csv_path), 'test', query_cache=QueryCache(), result_cache=ResultCache(),
+        session_store=SessionStore(), client=client, async_client=client
+    ), client
+
+
+def test_follow_up_detection():
+    assert is_follow_up("now sort those by revenue")
+    assert is_follow_up("And for Tesla?")
+    assert is_follow_up("By month?")
+    assert not is_follow_up(QUESTION)
+    assert reads_previous_result("prev.nlargest(5, 'revenue')")
+    assert not reads_previous_result("df.groupby('region')['revenue'].sum()")
+
+
+def test_standalone_questions_in_a_session_use_the_caches(system):
+    system, client = system
+    system.query(QUESTION)
+    system.query("Show me the first row of the data", session_id='s1')
+
+    calls = client.calls
+    result, _ = system.query(QUESTION, session_id='s1')
+
+    # The plan came from the query cache; only the answer needed a call
+    assert client.calls - calls == 1
+    assert dict(zip(result['region'], result['revenue'])) == {'East': 2500.0, 'North': 1200.0, 'South': 1500.0}
+
+
+def test_follow_ups_read_the_previous_result_and_skip_the_caches(system):
+    system, _ = system
+    system.query(QUESTION, session_id='s1')
+    result, _ = system.query(FOLLOW_UP, session_id='s1')
+
+    assert set(result['region']) == {'East', 'South'}
+    assert system.query_cache.get(FOLLOW_UP, system.dataset.current.schema) is None
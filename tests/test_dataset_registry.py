@@ -0,0 +1,43 @@
+import os
+
+import pandas as pd
+import pytest
+
+from benchmarks.fake_llm import FakeLLM
+from src.dataset_registry import DatasetRegistry
+from src.query_system import ExcelQuerySystem
+
+
+@pytest.mark.parametrize('query_engine', ['pandas', 'duckdb'])
+def test_same_named_files_in_different_directories_keep_their_caches(tmp_path, query_engine):
+    if query_engine == 'duckdb':
+        pytest.importorskip('duckdb')
+    cache_dir = tmp_path / 'cache'
+    paths = {}
+    for name, revenue in [('east', 100.0), ('west', 900.0)]:
+        (tmp_path / name).mkdir()
+        paths[name] = str(tmp_path / name / 'orders.csv')
+        pd.DataFrame({'region': [name] * 3, 'revenue': [revenue] * 3}).to_csv(paths[name], index=False)
+
+    def build(csv_path):
+        return ExcelQuerySystem('gpt-4', csv_path, 'test', client=FakeLLM({}), async_client=FakeLLM({}),
+                                dataset_cache_dir=str(cache_dir), query_engine=query_engine)
+
+    registry = DatasetRegistry(paths, build)
+    fingerprints = {}
+    for name in paths:
+        with registry.acquire(name) as system:
+            fingerprints[name] = system.dataset.current.fingerprint
+    cached = sorted(os.listdir(cache_dir))
+
+    # Loading one dataset never cleans up the other's files
+    for name in paths:
+        with registry.acquire(name) as system:
+            profile = system.dataset.current.profile
+            assert profile['fingerprint'] == fingerprints[name]
+            revenue = next(column for column in profile['columns'] if column['name'] == 'revenue')
+            assert revenue['max'] == (100.0 if name == 'east' else 900.0)
+    assert sorted(os.listdir(cache_dir)) == cached
+    assert len([path for path in cached if path.endswith('.profile.json')]) == 2
+    assert len([path for path in cached if path.endswith(('.arrow', '.parquet'))]) == 2
+    registry.stop()
@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.filter_index import FilterIndex, FilterStats
+from src.query_executor import QueryExecutor
+
+COLUMNS = ['Company', 'Sector', 'Ticker', 'Units', 'Price', 'Rank']
+
+
+@pytest.fixture(scope='module')
+def df():
+    rng = np.random.default_rng(0)
+    rows = 5000
+    company = rng.choice(['Tesla', 'Ford', 'GM', 'tesla motors', 'Rivian', 'Nio'], rows).astype(object)
+    company[rng.random(rows) < 0.05] = None
+    price = rng.normal(100, 30, rows).round(2)
+    price[rng.random(rows) < 0.05] = np.nan
+    return pd.DataFrame({
+        'Company': company,
+        'Sector': pd.Categorical(rng.choice(['Auto', 'Energy', 'Tech'], rows)),
+        'Ticker': rng.choice(['TSLA', 'F', 'GM', 'RIVN', 'NIO'], rows),
+        'Units': rng.integers(-50, 500, rows),
+        'Price': price,
+        'Rank': rng.integers(0, 5, rows).astype('uint8'),
+    })
+
+
+@pytest.fixture(scope='module')
+def index(df):
+    stats = FilterStats()
+    for _ in range(5):
+        stats.record(COLUMNS)
+    index = FilterIndex(df, stats, min_filters=1, max_columns=len(COLUMNS), min_rows=0)
+    assert sorted(index.columns) == sorted(COLUMNS)
+    return index
+
+
+# Filters the index answers; the indexed result must match a full scan exactly
+INDEXED = [
+    "df[df['Company'] == 'Tesla']",
+    "df[df['Company'] == 'Missing']",
+    "df[df.Company == 'Ford']",
+    "df[df['Ticker'] == 'TSLA']",
+    "df[df['Sector'] == 'Energy']",
+    "df[df['Units'] == 42]",
+    "df[df['Units'] > 250]",
+    "df[df['Units'] >= 250]",
+    "df[df['Units'] < 0]",
+    "df[df['Units'] <= -50]",
+    "df[df['Units'] > 1000]",
+    "df[100 < df['Units']]",
+    "df[df['Price'] > 120.5]",
+    "df[df['Price'] <= 80]",
+    "df[df['Price'] == 100.0]",
+    "df[df['Rank'] >= 3]",
+    "df[df['Units'].between(10, 20)]",
+    "df[df['Price'].between(90, 110, inclusive='both')]",
+    "df[df['Company'].isin(['Tesla', 'GM'])]",
+    "df[df['Units'].isin([1, 2, 3, 500])]",
+    "df[df['Sector'].isin(['Auto'])]",
+    "df[df['Company'].str.contains('esl', na=False)]",
+    "df[df['Company'].str.contains('tesla', case=False, na=False)]",
+    "df[df['Ticker'].str.contains('T')]",
+    "df[df['Ticker'].str.contains('.', regex=False)]",
+    "df[(df['Company'] == 'Tesla') & (df['Units'] > 100)]",
+    "df[(df['Company'] == 'Tesla') | (df['Ticker'] == 'GM')]",
+    "df[(df['Units'] > 100) & (df['Units'] < 200) & (df['Sector'] == 'Tech')]",
+    "df[((df['Price'] > 150) | (df['Price'] < 50)) & (df['Rank'] == 0)]",
+    "df.loc[df['Company'] == 'Nio', ['Company', 'Units']]",
+    "df.loc[df['Units'] > 400]",
+    "df[df['Company'] == 'Tesla'].groupby('Sector', observed=True)['Units'].sum()",
+    "df = df[df['Ticker'] == 'F']\ndf['Price'].mean()",
+]
+
+# Filters the index can't answer exactly; they must fall back to a scan
+NOT_INDEXED = [
+    "df[df['Units'].isin([1, 'two'])]",
+    "df[df['Company'] > 'M']",
+    "df[df['Company'].str.contains('Tesla')]",
+    "df[df['Company'].str.contains('T.s', regex=True, na=False)]",
+    "df[df['Units'] != 42]",
+]
+
+
+def _compare(executor, df, index, code):
+    indexed = executor.execute(code, df, index=index)
+    scanned = executor.execute(code, df)
+    pd.testing.assert_frame_equal(indexed, scanned)
+
+
+@pytest.mark.parametrize('code', INDEXED)
+def test_indexed_results_match_a_scan(df, index, code):
+    executor = QueryExecutor()
+    compiled = executor.compile(code)
+    assert compiled.filters and all(index.covers(plan) for plan in compiled.filters)
+    _compare(executor, df, index, code)
+
+
+@pytest.mark.parametrize('code', NOT_INDEXED)
+def test_uncovered_filters_fall_back_to_a_scan(df, index, code):
+    executor = QueryExecutor()
+    compiled = executor.compile(code)
+    assert not compiled.filters or not all(index.covers(plan) for plan in compiled.filters)
+    try:
+        scanned = executor.execute(code, df)
+    except Exception as e:
+        # pandas rejects it too; the indexed path must fail the same way
+        with pytest.raises(type(e)):
+            executor.execute(code, df, index=index)
+        return
+    pd.testing.assert_frame_equal(executor.execute(code, df, index=index), scanned)
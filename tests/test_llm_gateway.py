@@ -0,0 +1,53 @@
+import asyncio
+
+from benchmarks.fake_llm import AsyncFakeCompletions, AsyncFakeLLM
+from src.llm_gateway import LLMGateway
+
+REQUEST = {'messages': [{'role': 'system', 'content': 'You explain data'},
+                        {'role': 'user', 'content': 'Question: What is the total revenue?'}]}
+
+
+class SlowFirstCall(AsyncFakeCompletions):
+    """Hangs on the first call, then answers straight away"""
+
+    async def create(self, model=None, messages=None, stream=False, **kwargs):
+        if self.calls == 0:
+            self.calls += 1
+            await asyncio.sleep(60)
+        return await super().create(model, messages, stream, **kwargs)
+
+
+class SlowFirstCallLLM(AsyncFakeLLM):
+    completions_class = SlowFirstCall
+
+
+def test_timed_out_attempt_is_retried():
+    client = SlowFirstCallLLM()
+    gateway = LLMGateway(client=client, async_client=client, timeout=0.1, retry_base=0)
+    response = asyncio.run(gateway.acreate('gpt-4', REQUEST))
+    assert response.choices[0].message.content
+    assert client.calls == 2
+
+
+def test_call_is_cancelled_when_every_caller_gives_up():
+    client = AsyncFakeLLM(latency=60)
+    gateway = LLMGateway(client=client, async_client=client, timeout=120)
+
+    async def give_up():
+        callers = [asyncio.create_task(gateway.acreate('gpt-4', REQUEST)) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        inflight = gateway._async_inflight[asyncio.get_running_loop()]
+        flight = inflight[next(iter(inflight))]
+        assert flight.waiters == 2
+
+        callers[0].cancel()
+        await asyncio.sleep(0.01)
+        assert not flight.task.done()
+
+        callers[1].cancel()
+        await asyncio.sleep(0.01)
+        assert flight.task.cancelled()
+        assert not inflight
+
+    asyncio.run(give_up())
+    assert client.calls == 1
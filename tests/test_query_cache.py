@@ -0,0 +1,21 @@
+from src.query_cache import QueryCache
+
+SCHEMA = 'Columns: Company (text), Revenue (number)'
+
+
+def make_cache():
+    return QueryCache(similarity_threshold=0.9)
+
+
+def test_paraphrase_reuses_the_cached_plan():
+    cache = make_cache()
+    cache.put('What is the revenue of Tesla?', SCHEMA, 'filter', "df[df.Company == 'Tesla'].Revenue")
+    assert cache.get('Tesla revenues', SCHEMA) == ('filter', "df[df.Company == 'Tesla'].Revenue")
+
+
+def test_one_different_content_word_is_a_miss():
+    cache = make_cache()
+    cache.put('Show companies sorted by revenue descending', SCHEMA, 'sort',
+              "df.sort_values('Revenue', ascending=False)")
+    assert cache.get('Show companies sorted by revenue ascending', SCHEMA) is None
+    assert cache.get('Show companies sorted by profit descending', SCHEMA) is None
@@ -0,0 +1,97 @@
+import pandas as pd
+import pytest
+
+from src.query_executor import QueryExecutor, QueryValidationError
+
+
+@pytest.fixture
+def df():
+    return pd.DataFrame({
+        'Company': ['Tesla', 'Ford', 'Tesla', 'GM'],
+        'Revenue': [10, 20, 30, 40],
+    })
+
+
+@pytest.fixture
+def executor():
+    return QueryExecutor()
+
+
+@pytest.mark.parametrize('code', [
+    "'{0.__class__.__init__.__globals__[sys].modules[os].environ[OPENAI_API_KEY]}'.format(df)",
+    "'{0.shape}'.format(df)",
+    "'{x.shape}'.format_map({'x': df})",
+    "df.Company.format",
+    "'{}'.format(df)",
+    "df['__class__']",
+    "df.values.tofile('/tmp/escape')",
+    "v = df.values\nv.tofile('/tmp/escape')",
+    "df = df.values\ndf.tofile('/tmp/escape')",
+    "df = df.loc[0, 'Revenue']\ndf.tofile('/tmp/escape')",
+    "df.Revenue.sum().tofile('/tmp/escape')",
+    "df.to_csv('/tmp/escape')",
+    "df.__class__",
+    "pd.read_csv('/etc/passwd')",
+    "open('/etc/passwd')",
+    "prev.values.tofile('/tmp/escape')",
+])
+def test_rejects_sandbox_escapes(executor, df, code):
+    with pytest.raises(QueryValidationError):
+        executor.execute(code, df, variables={'prev': df})
+
+
+@pytest.mark.parametrize('code, expected', [
+    ("df.Revenue.sum()", 100),
+    ("df[df.Company == 'Tesla'].Revenue.sum()", 40),
+    ("df = df[df['Revenue'] > 15]\ndf.Revenue.sum()", 90),
+    ("tesla = df.loc[df.Company.isin(['Tesla'])]\ntesla.Revenue.max()", 30),
+    ("prev.Revenue.sum()", 100),
+])
+def test_allows_column_attributes_on_dataframes(executor, df, code, expected):
+    result = executor.execute(code, df, variables={'prev': df})
+    assert result['value'].iloc[0] == expected
+
+
+def test_column_attribute_on_reassigned_name_is_rejected(executor, df):
+    # After df = df['Revenue'] df is a Series, so .anything is no longer a column
+    with pytest.raises(QueryValidationError):
+        executor.execute("df = df['Revenue']\ndf.Company", df)
+
+
+def test_allows_columns_of_grouped_rows(executor, df):
+    result = executor.execute("df[df.Revenue > 15].groupby('Company').Revenue.sum()", df)
+    assert dict(zip(result['Company'], result['Revenue'])) == {'GM': 40, 'Ford': 20, 'Tesla': 30}
+
+
+@pytest.mark.parametrize('code', [
+    "df.agg('to_csv', 0, '{path}')",
+    "df.agg('to_pickle', 0, '{path}')",
+    "df.aggregate('to_csv', 0, '{path}')",
+    "df['Revenue'].agg('to_csv', 0, '{path}')",
+    "df.agg('to_csv', path_or_buf='{path}')",
+    "df.agg(func='to_csv', path_or_buf='{path}')",
+    "df.agg(['sum', 'to_csv'], 0, '{path}')",
+    "df.agg({{'Revenue': 'to_csv'}})",
+    "df.groupby('Company').agg(out=('Revenue', 'to_csv'))",
+    "df.groupby('Company')['Revenue'].agg('to_pickle', '{path}')",
+    "name = 'to_csv'\ndf.agg(name, 0, '{path}')",
+    "df.pivot_table(index='Company', values='Revenue', aggfunc='to_csv')",
+    "df.pivot_table('Revenue', 'Company', None, 'to_csv')",
+])
+def test_rejects_methods_named_by_string(executor, df, tmp_path, code):
+    path = tmp_path / 'escape.py'
+    with pytest.raises(QueryValidationError):
+        executor.execute(code.format(path=path), df)
+    assert not path.exists()
+
+
+@pytest.mark.parametrize('code', [
+    "df.agg('sum')",
+    "df['Revenue'].agg(['min', 'max'])",
+    "df.groupby('Company').agg({'Revenue': ['sum', 'mean']})",
+    "df.groupby('Company').agg(total=('Revenue', 'sum'), orders=('Revenue', 'count'))",
+    "df.pivot_table(index='Company', values='Revenue', aggfunc='sum')",
+    "df.pivot_table(index='Company', values='Revenue')",
+])
+def test_allows_reductions_by_name(executor, df, code):
+    assert not executor.execute(code, df).empty
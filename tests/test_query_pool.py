@@ -0,0 +1,142 @@
+import os
+import signal
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.dataset_store import load_dataset
+from src.query_executor import QueryCancelledError, QueryExecutor, QueryMemoryError, QueryTimeoutError
+from src.query_pool import PooledQueryExecutor, QueryPool
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason="the query pool needs POSIX")
+
+pytest.importorskip('pyarrow')
+
+# Runs for seconds: sorts a few million rows by a text column
+SLOW_QUERY = "pd.concat([df] * 200).sort_values(['Company', 'Units'])"
+
+
+@pytest.fixture(scope='module')
+def dataset(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('pool')
+    rng = np.random.default_rng(0)
+    rows = 20000
+    pd.DataFrame({
+        'Company': rng.choice(['Tesla', 'Ford', 'GM', 'Rivian'], rows),
+        'Units': rng.integers(0, 500, rows),
+        'Price': rng.normal(100, 30, rows).round(2),
+    }).to_csv(directory / 'orders.csv', index=False)
+    df, _, cache_path = load_dataset(str(directory / 'orders.csv'), cache_dir=str(directory / 'cache'))
+    return df, cache_path
+
+
+@pytest.fixture
+def pool():
+    pool = QueryPool(workers=1)
+    yield pool
+    pool.close()
+
+
+def _executor(pool, dataset, timeout=None):
+    df, cache_path = dataset
+    executor = PooledQueryExecutor(pool, timeout=timeout)
+    executor.attach(df, cache_path)
+    return executor
+
+
+def _worker(pool):
+    """The pool's only worker"""
+    (worker,) = pool._workers
+    return worker
+
+
+def _gone(pid):
+    """Whether a process has exited and been reaped, so it is neither running nor a zombie"""
+    return not os.path.exists(f"/proc/{pid}") if os.path.isdir('/proc') else True
+
+
+def test_results_match_the_web_process(pool, dataset):
+    df, _ = dataset
+    code = "df[df['Company'] == 'Tesla'].groupby('Units', as_index=False)['Price'].sum()"
+    pooled = _executor(pool, dataset).execute(code, df)
+    pd.testing.assert_frame_equal(pooled, QueryExecutor().execute(code, df))
+
+
+def test_timeout_kills_and_replaces_the_worker(pool, dataset):
+    df, _ = dataset
+    # Start the worker first; its start-up counts towards a query's time limit
+    executor = _executor(pool, dataset)
+    executor.execute("df.head(1)", df)
+    old = _worker(pool)
+
+    start = time.monotonic()
+    with pytest.raises(QueryTimeoutError):
+        _executor(pool, dataset, timeout=0.2).execute(SLOW_QUERY, df)
+    assert time.monotonic() - start < 5
+
+    assert old.process.poll() == -signal.SIGKILL and _gone(old.pid)
+    assert _worker(pool) is not old
+    assert len(executor.execute("df.head(3)", df)) == 3
+
+
+def test_cancel_kills_and_replaces_the_worker(pool, dataset):
+    df, _ = dataset
+    executor = _executor(pool, dataset)
+    executor.execute("df.head(1)", df)
+    old = _worker(pool)
+
+    cancel = threading.Event()
+    threading.Timer(0.3, cancel.set).start()
+    with pytest.raises(QueryCancelledError):
+        executor.execute(SLOW_QUERY, df, cancel=cancel)
+
+    assert old.process.poll() == -signal.SIGKILL and _gone(old.pid)
+    assert len(executor.execute("df.head(3)", df)) == 3
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason="relies on RLIMIT_DATA")
+def test_memory_limit_fails_the_query_not_the_pool(dataset):
+    df, _ = dataset
+    pool = QueryPool(workers=1, memory_limit=512 * 1024 * 1024)
+    try:
+        executor = _executor(pool, dataset)
+        with pytest.raises(QueryMemoryError):
+            # About 5 GB
+            executor.execute("pd.concat([df] * 10000)", df)
+        assert len(executor.execute("df.head(3)", df)) == 3
+    finally:
+        pool.close()
+
+
+def test_a_worker_killed_while_idle_is_replaced(pool, dataset):
+    df, _ = dataset
+    executor = _executor(pool, dataset)
+    executor.execute("df.head(1)", df)
+    old = _worker(pool)
+    os.kill(old.pid, signal.SIGKILL)
+    old.process.wait()
+
+    assert len(executor.execute("df.head(3)", df)) == 3
+    assert _worker(pool) is not old
+
+
+def test_close_leaves_no_workers_behind(dataset):
+    df, _ = dataset
+    pool = QueryPool(workers=2)
+    executor = _executor(pool, dataset)
+    executor.execute("df.head(1)", df)
+    with pytest.raises(QueryTimeoutError):
+        _executor(pool, dataset, timeout=0.2).execute(SLOW_QUERY, df)
+    executor.execute("df.head(1)", df)
+    workers = list(pool._workers)
+    assert 1 <= len(workers) <= 2
+
+    pool.close()
+
+    assert not pool._workers
+    for worker in workers:
+        assert worker.process.poll() is not None and _gone(worker.pid)
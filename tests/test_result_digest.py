@@ -0,0 +1,24 @@
+import numpy as np
+import pandas as pd
+
+from src.result_digest import digest_result
+
+
+def test_digest_handles_duplicate_column_names():
+    df = pd.DataFrame(np.arange(3000).reshape(1000, 3), columns=['total', 'total', 'region'])
+    df['region'] = ['North', 'South'] * 500
+
+    digest = digest_result(df, max_tokens=300)
+
+    assert '- total: int64, mean 1498.5' in digest
+    assert '- total: int64, mean 1499.5' in digest
+    assert '- region top values: North (500), South (500)' in digest
+
+
+def test_digest_lists_omitted_duplicate_columns_once_each():
+    df = pd.concat([pd.DataFrame({'a': range(1000), 'b': [1.5] * 1000})] * 20, axis=1)
+
+    digest = digest_result(df, max_tokens=150)
+
+    assert digest.startswith('1000 rows x 40 columns')
+    assert 'more columns' in digest
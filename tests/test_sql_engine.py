@@ -0,0 +1,76 @@
+import pandas as pd
+import pytest
+
+duckdb = pytest.importorskip('duckdb')
+
+from benchmarks.fake_llm import FakeLLM  # noqa: E402
+from src.query_executor import QueryValidationError  # noqa: E402
+from src.query_system import ExcelQuerySystem  # noqa: E402
+from src.sql_engine import SqlQueryEngine  # noqa: E402
+
+
+@pytest.fixture
+def csv_path(tmp_path):
+    path = tmp_path / 'orders.csv'
+    pd.DataFrame({
+        'region': ['North', 'South', 'North', 'East'],
+        'revenue': [500.0, 1500.0, 700.0, 2500.0],
+    }).to_csv(path, index=False)
+    return path
+
+
+@pytest.fixture(params=[False, True], ids=['csv', 'parquet'])
+def engine(request, csv_path, tmp_path):
+    engine = SqlQueryEngine(str(csv_path), cache_dir=str(tmp_path / 'cache') if request.param else None)
+    engine.attach('0123456789abcdef')
+    return engine
+
+
+def test_runs_select_on_the_dataset(engine):
+    result = engine.execute('SELECT region, SUM(revenue) AS revenue FROM data GROUP BY region ORDER BY region')
+    assert list(result['revenue']) == [2500.0, 1200.0, 1500.0]
+
+
+@pytest.mark.parametrize('path', ['/etc/passwd', 'secret.csv'])
+@pytest.mark.parametrize('reader', ['read_csv_auto', 'read_text', 'read_parquet', 'glob'])
+def test_rejects_reading_other_files(engine, tmp_path, reader, path):
+    # A file right next to the dataset is as out of bounds as one elsewhere
+    (tmp_path / 'secret.csv').write_text('key\nsecret\n')
+    path = str(tmp_path / path) if not path.startswith('/') else path
+    with pytest.raises(duckdb.Error):
+        engine.execute(f"SELECT * FROM {reader}('{path}')")
+
+
+@pytest.mark.parametrize('sql', [
+    "DROP VIEW data",
+    "CREATE TABLE copy AS SELECT * FROM data",
+    "COPY data TO '/tmp/escape.csv'",
+    "COPY (SELECT * FROM data) TO '/tmp/escape.csv'",
+    "ATTACH '/tmp/escape.db'",
+    "INSTALL httpfs",
+    "LOAD httpfs",
+    "SET enable_external_access = true",
+    "PRAGMA enable_profiling",
+    "SELECT 1; DROP VIEW data",
+    "EXPORT DATABASE '/tmp/escape'",
+])
+def test_rejects_statements_other_than_one_select(engine, sql):
+    with pytest.raises(QueryValidationError):
+        engine.execute(sql)
+
+
+def test_duckdb_engine_never_loads_the_csv_into_pandas(csv_path, tmp_path, monkeypatch):
+    def read_csv(*args, **kwargs):
+        raise AssertionError("the dataset was read with pandas")
+
+    monkeypatch.setattr(pd, 'read_csv', read_csv)
+    client = FakeLLM({'Total revenue?': {'question_type': 'filter', 'sql': 'SELECT SUM(revenue) AS total FROM data'}})
+    system = ExcelQuerySystem('gpt-4', str(csv_path), 'test', dataset_cache_dir=str(tmp_path / 'cache'),
+                              query_engine='duckdb', client=client, async_client=client)
+
+    assert system.df is None
+    assert system.profile['rows'] == 4
+    region = next(column for column in system.profile['columns'] if column['name'] == 'region')
+    assert region['top_values'][0] == ['North', 2]
+    result, _ = system.query('Total revenue?')
+    assert result['total'].iloc[0] == 5200.0